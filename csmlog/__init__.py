@@ -3,18 +3,33 @@ This file is part of csmlog. Python logger setup... the way I like it.
 MIT License (2021) - Charles Machalow
 """
 
+import importlib
 import logging
 import logging.handlers
 import os
 import shutil
 import sys
 import uuid
+import warnings
 from pathlib import Path
 
-from csmlog.google_sheets_handler import GSheetsHandler
-from csmlog.system_call import LoggedSystemCall
-from csmlog.udp_handler import UdpHandler
-from csmlog.udp_handler_receiver import UdpHandlerReceiver
+from csmlog.async_handler import (
+    DEFAULT_ASYNC_QUEUE_MAX_SIZE,
+    FULL_QUEUE_BLOCK,
+    FULL_QUEUE_DROP_BELOW_LEVEL,
+    FULL_QUEUE_DROP_OLDEST,
+    AsyncForwardingHandler,
+    AsyncHandlerPipeline,
+)
+from csmlog.formatter import FastFormatter, SharedFormatCacheMixin
+from csmlog.rotating_file_handler import (
+    DEFAULT_BACKUP_COUNT,
+    DEFAULT_MAX_BYTES,
+    MultiProcessRotatingFileHandler,
+    RotatingFileHandlerThatWillKeepWorkingOnPermissionErrorDuringRotate,
+    isMultiProcessRotationSupported,
+)
+from csmlog.system_call import AsyncLoggedSystemCall, LoggedSystemCall
 
 __version__ = "0.28.0"
 
@@ -22,11 +37,47 @@ DEFAULT_LOG_FORMAT = "%(asctime)s - %(name)s:%(lineno)d - %(levelname)s - %(mess
 CSMLOG_DEFAULT_SAVE_DIRECTORY = "CSMLOG_DEFAULT_SAVE_DIRECTORY"
 
 
+# name -> module it is lazily imported from (by __getattr__). Transports (and gspread for the google sheets
+#   handler) are only imported if they are actually used, so `import csmlog` stays fast.
+_LAZY_ATTRIBUTES = {
+    "GSheetsHandler": "csmlog.google_sheets_handler",
+    "RotatedBackupWorker": "csmlog.backup_worker",
+    "BINARY_LOG_EXTENSION": "csmlog.binary_log",
+    "BinaryRotatingFileHandler": "csmlog.binary_log",
+    "ShmRingHandler": "csmlog.shm_ring_handler",
+    "getShmRingPath": "csmlog.shm_ring_handler",
+    "getShmRingPaths": "csmlog.shm_ring_handler",
+    "DEFAULT_BLOCK_SECONDS": "csmlog.tcp_handler",
+    "TcpHandler": "csmlog.tcp_handler",
+    "UDP_LOGGING_TCP": "csmlog.udp_handler",
+    "UDP_LOGGING_UNIX": "csmlog.udp_handler",
+    "UdpHandler": "csmlog.udp_handler",
+    "getUnixSocketPath": "csmlog.udp_handler",
+    "UdpHandlerReceiver": "csmlog.udp_handler_receiver",
+}
+
+
+def __getattr__(name):
+    """lazily imports the names in _LAZY_ATTRIBUTES only if they are actually used (PEP 562, Python 3.7+)"""
+    moduleName = _LAZY_ATTRIBUTES.get(name)
+    if moduleName is None:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+    return getattr(importlib.import_module(moduleName), name)
+
+
+class ConsoleStreamHandler(SharedFormatCacheMixin, logging.StreamHandler):
+    """the StreamHandler used by enableConsoleLogging()"""
+
+
 class CSMLogger(object):
     """
     object to wrap logging logic
     """
 
+    # (appName, save directory override) -> save directory
+    _defaultSaveDirectoryCache = {}
+
     def __init__(
         self,
         appName,
@@ -35,16 +86,93 @@ class CSMLogger(object):
         googleSheetShareEmail=None,
         formatter=None,
         modifyChildLoggersFunc=None,
+        asyncHandlers=False,
+        asyncQueueMaxSize=DEFAULT_ASYNC_QUEUE_MAX_SIZE,
+        asyncQueueFullPolicy=FULL_QUEUE_BLOCK,
+        asyncQueueDropLevel=logging.WARNING,
+        consolidateLogFiles=False,
+        multiProcessSafeRotation=False,
+        compressBackups=None,
+        maxTotalBytes=None,
+        binaryLogFiles=False,
+        udpNonBlocking=False,
+        shmRingLogging=False,
+        tcpBlockSeconds=1.0,
     ):
+        if binaryLogFiles and multiProcessSafeRotation:
+            raise ValueError(
+                "binaryLogFiles can't be used with multiProcessSafeRotation"
+            )
+
+        if multiProcessSafeRotation and not isMultiProcessRotationSupported():
+            warnings.warn(
+                "multiProcessSafeRotation isn't supported on this platform (it needs POSIX file locks). "
+                "Log files will only be safe to write/rotate from one process.",
+                RuntimeWarning,
+                stacklevel=3,
+            )
+            multiProcessSafeRotation = False
+
+        if isinstance(udpLogging, str):
+            from csmlog.udp_handler import UDP_LOGGING_TCP, UDP_LOGGING_UNIX
+
+            if udpLogging not in (UDP_LOGGING_UNIX, UDP_LOGGING_TCP):
+                raise ValueError(
+                    "udpLogging should be True, False, UDP_LOGGING_UNIX or UDP_LOGGING_TCP, not %r"
+                    % udpLogging
+                )
+
         self.appName = appName
+
+        # True to send live logs over UDP, UDP_LOGGING_UNIX to send them over a unix socket for this app
+        #   (see getUnixSocketPath()) instead, or UDP_LOGGING_TCP to stream them over TCP (see TcpHandler)
         self.udpLogging = udpLogging
+
+        # if True, the UdpHandler never makes the logging thread wait. It drops (and counts) records instead.
+        self.udpNonBlocking = udpNonBlocking
+
+        # with UDP_LOGGING_TCP: how long logging waits for room when the TcpHandler's buffer is full (None: forever).
+        #   Defaults to csmlog.tcp_handler.DEFAULT_BLOCK_SECONDS (not imported here, so the tcp handler isn't
+        #   imported unless it is used).
+        self.tcpBlockSeconds = tcpBlockSeconds
+
+        # if True, live logs are also written to a shared memory ring (see getShmRingPath()) for csmlogshm to tail
+        self.shmRingLogging = shmRingLogging
         self.googleSheetShareEmail = googleSheetShareEmail
 
+        # if True, child loggers don't get their own log file. Everything is written (and formatted) once
+        # to the parent's log file. Use csmlog.log_splitter to get per-logger files later, if needed.
+        self.consolidateLogFiles = consolidateLogFiles
+
+        # if True, log files can be safely written/rotated by multiple processes at once (POSIX only: elsewhere
+        #   this is warned about and the usual handler is used)
+        self.multiProcessSafeRotation = multiProcessSafeRotation
+
+        # if True, log files are written as binary frames (<loggerName>.clog) and only formatted when read
+        #   via csmlog-decode (see csmlog.binary_log)
+        self.binaryLogFiles = binaryLogFiles
+
         # A function to call when creating a child logger. This is useful for adding in
         # things like handlers to all child loggers.
         self.modifyChildLoggersFunc = modifyChildLoggersFunc
 
-        self._loggers = []
+        # keep track of all loggers, keyed by logger name
+        self._loggers = {}
+
+        # counters for getLoggerStats()
+        self._getLoggerCalls = 0
+        self._getLoggerCacheHits = 0
+
+        # if set, handler work happens on the pipeline's thread instead of the logging thread.
+        self._asyncPipeline = None
+        self._asyncForwarders = {}
+        if asyncHandlers:
+            self._asyncPipeline = AsyncHandlerPipeline(
+                maxSize=asyncQueueMaxSize,
+                fullQueuePolicy=asyncQueueFullPolicy,
+                dropLevel=asyncQueueDropLevel,
+            )
+            self._asyncPipeline.start()
 
         # sets self._formatter
         self.setFormatter(formatter)
@@ -52,17 +180,86 @@ class CSMLogger(object):
         if clearLogs:
             self.clearLogs()
 
+        # if set, rotated backups are compressed ("gzip" or "zstd") and/or trimmed to fit in maxTotalBytes
+        #  on a background thread.
+        self._backupWorker = None
+        if compressBackups or maxTotalBytes is not None:
+            from csmlog.backup_worker import RotatedBackupWorker
+
+            self._backupWorker = RotatedBackupWorker(
+                self.getDefaultSaveDirectory(),
+                compression=compressBackups,
+                maxTotalBytes=maxTotalBytes,
+            )
+            self._backupWorker.start()
+
         self.parentLogger = self.__getParentLogger()
         self.consoleLoggingStream = None
-        self._loggers = [self.parentLogger]  # keep track of all loggers
+        self._loggers = {self.parentLogger.name: self.parentLogger}
 
     def close(self):
-        for logger in self._loggers:
+        if self._asyncPipeline:
+            # let everything queued so far make it to the real handlers before closing them
+            self._asyncPipeline.stop()
+
+        for logger in self._loggers.values():
             for handler in logger.handlers[:]:
+                if isinstance(handler, AsyncForwardingHandler):
+                    for target in handler.targets:
+                        target.close()
+
                 handler.close()
                 logger.removeHandler(handler)
 
-        self._loggers = []
+        self._loggers = {}
+        self._asyncForwarders = {}
+
+        if self._backupWorker:
+            # finish compressing anything already rotated
+            self._backupWorker.stop()
+
+    def flush(self):
+        """waits for queued records (if using asyncHandlers) to be handled, then flushes all handlers"""
+        if self._asyncPipeline:
+            self._asyncPipeline.flush()
+
+        for logger in self._loggers.values():
+            for handler in self._getHandlers(logger):
+                handler.flush()
+
+        if self._backupWorker:
+            self._backupWorker.flush()
+
+    def _addHandler(self, logger, handler):
+        """adds a handler to the logger (or to the logger's async forwarder if using asyncHandlers)"""
+        if self._asyncPipeline is None:
+            logger.addHandler(handler)
+            return
+
+        forwarder = self._asyncForwarders.get(logger.name)
+        if forwarder is None:
+            forwarder = AsyncForwardingHandler(self._asyncPipeline)
+            self._asyncForwarders[logger.name] = forwarder
+            logger.addHandler(forwarder)
+
+        forwarder.addTarget(handler)
+
+    def _removeHandler(self, logger, handler):
+        logger.removeHandler(handler)
+
+        forwarder = self._asyncForwarders.get(logger.name)
+        if forwarder is not None:
+            forwarder.removeTarget(handler)
+
+    def _getHandlers(self, logger):
+        """returns the real handlers for the logger (looking through async forwarders)"""
+        handlers = []
+        for handler in logger.handlers:
+            if isinstance(handler, AsyncForwardingHandler):
+                handlers.extend(handler.targets)
+            else:
+                handlers.append(handler)
+        return handlers
 
     def getLogger(self, name):
         name = os.path.basename(name)
@@ -70,66 +267,128 @@ class CSMLogger(object):
             self.appName,
             name,
         )  # make this a sublogger of the whole app
-        logger = self.__getLoggerWithName(loggerName)
-        self._loggers.append(logger)
+        self._getLoggerCalls += 1
+
+        # already setup? don't add (and later write to) another set of handlers
+        logger = self._loggers.get(loggerName)
+        if logger is not None:
+            self._getLoggerCacheHits += 1
+            return logger
+
+        logger = self.__getLoggerWithName(
+            loggerName, addFileHandler=not self.consolidateLogFiles
+        )
+        self._loggers[loggerName] = logger
         logger.sysCall = LoggedSystemCall(logger)
+        logger.asyncSysCall = AsyncLoggedSystemCall(logger)
 
         if self.modifyChildLoggersFunc:
             self.modifyChildLoggersFunc(logger)
 
         return logger
 
+    def getLoggerStats(self):
+        """returns counters for the loggers/handlers managed by this CSMLogger"""
+        return {
+            "loggers": len(self._loggers),
+            "handlers": sum(len(self._getHandlers(l)) for l in self._loggers.values()),
+            "getLoggerCalls": self._getLoggerCalls,
+            "getLoggerCacheHits": self._getLoggerCacheHits,
+        }
+
     def __getParentLogger(self):
         logger = self.__getLoggerWithName(self.appName)
         if self.udpLogging:
-            handler = UdpHandler()
+            from csmlog.udp_handler import (
+                UDP_LOGGING_TCP,
+                UDP_LOGGING_UNIX,
+                UdpHandler,
+                getUnixSocketPath,
+            )
+
+            if self.udpLogging == UDP_LOGGING_TCP:
+                from csmlog.tcp_handler import TcpHandler
+
+                handler = TcpHandler(blockSeconds=self.tcpBlockSeconds)
+            else:
+                unixSocketPath = None
+                if self.udpLogging == UDP_LOGGING_UNIX:
+                    unixSocketPath = getUnixSocketPath(self.appName)
+
+                handler = UdpHandler(
+                    nonBlocking=self.udpNonBlocking, unixSocketPath=unixSocketPath
+                )
             handler.setFormatter(self.getFormatter())
-            logger.addHandler(handler)
+            self._addHandler(logger, handler)
+
+        if self.shmRingLogging:
+            from csmlog.shm_ring_handler import ShmRingHandler
+
+            handler = ShmRingHandler(appName=self.appName)
+            handler.setFormatter(self.getFormatter())
+            self._addHandler(logger, handler)
 
         if self.googleSheetShareEmail:
+            # imported here since gspread (and friends) are slow to import and rarely needed
+            from csmlog.google_sheets_handler import GSheetsHandler
+
             handler = GSheetsHandler(self.appName, self.googleSheetShareEmail)
             handler.setFormatter(self.getFormatter())
-            logger.addHandler(handler)
+            self._addHandler(logger, handler)
 
         return logger
 
-    def __getLoggerWithName(self, loggerName):
+    def __getLoggerWithName(self, loggerName, addFileHandler=True):
         logger = logging.getLogger(loggerName)
         logger.setLevel(1)  # log all
 
         logFolder = self.getDefaultSaveDirectory()
 
-        logFile = os.path.join(logFolder, loggerName + ".txt")
+        if not addFileHandler:
+            # records propagate to (and are only written to) the parent's log file
+            logger.logFile = self.parentLogger.logFile
+            logger.logFolder = logFolder
+            logger.loggerName = loggerName
+            return logger
+
+        if self.binaryLogFiles:
+            from csmlog.binary_log import (
+                BINARY_LOG_EXTENSION,
+                BinaryRotatingFileHandler,
+            )
+
+            logFile = os.path.join(logFolder, loggerName + BINARY_LOG_EXTENSION)
+        else:
+            logFile = os.path.join(logFolder, loggerName + ".txt")
 
         formatter = self.getFormatter()
 
-        class RotatingFileHandlerThatWillKeepWorkingOnPermissionErrorDuringRotate(
-            logging.handlers.RotatingFileHandler
-        ):
-            """
-            This class is special, it exists because on Windows, file names can't be changed while files are open.
-                So ultimately we can't rotate if 2 processes are writing to a given log file.
-                The default RotatingFileHandler will just throw the PermissionError and stop writing
-                        (since it closed the stream already)
-                By throwing away the PermissionError (since logging it on every log statement would be too much),
-                    and using the delay=True parameter to RotatingFileHandler, we will just continue writing to the
-                    original file without rotating, via reopening the original file. If the other process closes the file,
-                    it will rotate on the next log statement
-            """
-
-            # todo: probably write test cases for rotation with multiple processes writing to one log file.
-            #   ensure some sort of semi-deterministic behavior
-            def rotate(self, source, dest):
-                try:
-                    logging.handlers.RotatingFileHandler.rotate(self, source, dest)
-                except PermissionError:
-                    pass
+        if self.binaryLogFiles:
+            rfh = BinaryRotatingFileHandler(
+                logFile,
+                maxBytes=DEFAULT_MAX_BYTES,
+                backupCount=DEFAULT_BACKUP_COUNT,
+                delay=True,
+            )
+        elif self.multiProcessSafeRotation:
+            rfh = MultiProcessRotatingFileHandler(
+                logFile,
+                maxBytes=DEFAULT_MAX_BYTES,
+                backupCount=DEFAULT_BACKUP_COUNT,
+                delay=True,
+            )
+        else:
+            rfh = RotatingFileHandlerThatWillKeepWorkingOnPermissionErrorDuringRotate(
+                logFile,
+                maxBytes=DEFAULT_MAX_BYTES,
+                backupCount=DEFAULT_BACKUP_COUNT,
+                delay=True,
+            )
+        if self._backupWorker:
+            self._backupWorker.attach(rfh)
 
-        rfh = RotatingFileHandlerThatWillKeepWorkingOnPermissionErrorDuringRotate(
-            logFile, maxBytes=1024 * 1024 * 8, backupCount=10, delay=True
-        )
         rfh.setFormatter(formatter)
-        logger.addHandler(rfh)
+        self._addHandler(logger, rfh)
 
         # add the log file path / folder for easy access elsewhere
         logger.logFile = logFile
@@ -155,9 +414,9 @@ class CSMLogger(object):
             # recursive
             return self.enableConsoleLogging(level=level, stream=stream)
         else:
-            self.consoleLoggingStream = logging.StreamHandler(stream)
+            self.consoleLoggingStream = ConsoleStreamHandler(stream)
             self.consoleLoggingStream.setFormatter(self.getFormatter())
-            self.parentLogger.addHandler(self.consoleLoggingStream)
+            self._addHandler(self.parentLogger, self.consoleLoggingStream)
 
         self.consoleLoggingStream.setLevel(level)
 
@@ -165,25 +424,34 @@ class CSMLogger(object):
         if not self.consoleLoggingStream:
             raise RuntimeError("Managed console logging is not active")
 
-        self.parentLogger.removeHandler(self.consoleLoggingStream)
+        self._removeHandler(self.parentLogger, self.consoleLoggingStream)
         self.consoleLoggingStream = None
 
     def setFormatter(self, formatter=None):
         if formatter is None:
-            formatter = logging.Formatter(DEFAULT_LOG_FORMAT)
+            formatter = FastFormatter(DEFAULT_LOG_FORMAT)
 
         if isinstance(formatter, str):
-            formatter = logging.Formatter(formatter)
+            formatter = FastFormatter(formatter)
 
         self._formatter = formatter
 
-        for logger in self._loggers:
-            for handler in logger.handlers:
-                handler.setFormatter(formatter)
+        for logger in self._loggers.values():
+            for handler in self._getHandlers(logger):
+                # opted out of the shared format cache: it has its own formatter
+                if getattr(handler, "useSharedFormatCache", True):
+                    handler.setFormatter(formatter)
 
     @classmethod
     def getDefaultSaveDirectoryWithName(cls, appName):
         override = os.environ.get(CSMLOG_DEFAULT_SAVE_DIRECTORY, None)
+
+        # probing/creating the folder is a handful of filesystem calls, only do it once per appName/override
+        cacheKey = (appName, override)
+        logFolder = cls._defaultSaveDirectoryCache.get(cacheKey)
+        if logFolder is not None:
+            return logFolder
+
         if override:
             logFolder = os.path.join(override, appName)
         else:
@@ -205,10 +473,17 @@ class CSMLogger(object):
         if not os.path.isdir(logFolder):
             os.makedirs(logFolder)
 
+        cls._defaultSaveDirectoryCache[cacheKey] = logFolder
         return logFolder
 
+    @classmethod
+    def clearDefaultSaveDirectoryCache(cls):
+        """forget the save directories found by getDefaultSaveDirectoryWithName() so they are found again on next use"""
+        cls._defaultSaveDirectoryCache.clear()
+
     def clearLogs(self):
         shutil.rmtree(self.getDefaultSaveDirectory())
+        self.clearDefaultSaveDirectoryCache()
 
         # recreate empty folder
         self.getDefaultSaveDirectory()
@@ -253,6 +528,12 @@ class _CSMLoggerManager:
     def getCSMLogger(self):
         return self._activeCsmLogger
 
+    def flush(self):
+        if not self._activeCsmLogger:
+            raise RuntimeError("(csmlog) setup() must be called first!")
+
+        self._activeCsmLogger.flush()
+
     def enableConsoleLogging(self, *args, **kwargs):
         if not self._activeCsmLogger:
             raise RuntimeError("(csmlog) setup() must be called first!")
@@ -281,6 +562,18 @@ class _CSMLoggerManager:
         googleSheetShareEmail=None,
         formatter=None,
         modifyChildLoggersFunc=None,
+        asyncHandlers=False,
+        asyncQueueMaxSize=DEFAULT_ASYNC_QUEUE_MAX_SIZE,
+        asyncQueueFullPolicy=FULL_QUEUE_BLOCK,
+        asyncQueueDropLevel=logging.WARNING,
+        consolidateLogFiles=False,
+        multiProcessSafeRotation=False,
+        compressBackups=None,
+        maxTotalBytes=None,
+        binaryLogFiles=False,
+        udpNonBlocking=False,
+        shmRingLogging=False,
+        tcpBlockSeconds=1.0,
     ):
         """must be called to setup the logger. Passes args to CSMLogger's constructor"""
 
@@ -297,6 +590,18 @@ class _CSMLoggerManager:
             googleSheetShareEmail,
             formatter=formatter,
             modifyChildLoggersFunc=modifyChildLoggersFunc,
+            asyncHandlers=asyncHandlers,
+            asyncQueueMaxSize=asyncQueueMaxSize,
+            asyncQueueFullPolicy=asyncQueueFullPolicy,
+            asyncQueueDropLevel=asyncQueueDropLevel,
+            consolidateLogFiles=consolidateLogFiles,
+            multiProcessSafeRotation=multiProcessSafeRotation,
+            compressBackups=compressBackups,
+            maxTotalBytes=maxTotalBytes,
+            binaryLogFiles=binaryLogFiles,
+            udpNonBlocking=udpNonBlocking,
+            shmRingLogging=shmRingLogging,
+            tcpBlockSeconds=tcpBlockSeconds,
         )
         self._activeCsmLogger.parentLogger.debug("==== %s is starting ====" % appName)
 
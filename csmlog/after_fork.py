@@ -0,0 +1,50 @@
+"""
+This file is part of csmlog. Python logger setup... the way I like it.
+MIT License (2021) - Charles Machalow
+"""
+
+import os
+import threading
+import weakref
+
+# weak references to the methods to call in the child after a fork (an object going away drops its method)
+_afterForkInChild = []
+_afterForkInChildLock = threading.Lock()
+_registered = False
+
+
+def _runAfterForkInChild():
+    # the parent may have been registering something when it forked
+    global _afterForkInChildLock
+    _afterForkInChildLock = threading.Lock()
+
+    for ref in list(_afterForkInChild):
+        method = ref()
+        if method is None:
+            _afterForkInChild.remove(ref)
+        else:
+            try:
+                method()
+            except Exception:
+                # one broken object shouldn't keep the rest from working in the child
+                pass
+
+
+def registerAfterForkInChild(method):
+    """
+    calls the given bound method in the child process after each os.fork(), for as long as its object is alive.
+        Used to replace background threads (which only the parent keeps) and locks (which may have been held
+        by one of those threads) in the child.
+    """
+    if not hasattr(os, "register_at_fork"):
+        # no fork() (Windows)
+        return
+
+    global _registered
+    with _afterForkInChildLock:
+        if not _registered:
+            os.register_at_fork(after_in_child=_runAfterForkInChild)
+            _registered = True
+
+        _afterForkInChild[:] = [ref for ref in _afterForkInChild if ref() is not None]
+        _afterForkInChild.append(weakref.WeakMethod(method))
@@ -0,0 +1,254 @@
+"""
+This file is part of csmlog. Python logger setup... the way I like it.
+MIT License (2021) - Charles Machalow
+"""
+
+import atexit
+import logging
+import queue
+import threading
+
+from csmlog.after_fork import registerAfterForkInChild
+
+# args of these types can't be changed by the caller, so a record with only these doesn't need to be rendered early
+_IMMUTABLE_ARG_TYPES = frozenset((type(None), bool, int, float, str, bytes))
+
+# what to do when the queue is full
+FULL_QUEUE_BLOCK = "block"
+FULL_QUEUE_DROP_OLDEST = "dropOldest"
+FULL_QUEUE_DROP_BELOW_LEVEL = "dropBelowLevel"
+FULL_QUEUE_POLICIES = (
+    FULL_QUEUE_BLOCK,
+    FULL_QUEUE_DROP_OLDEST,
+    FULL_QUEUE_DROP_BELOW_LEVEL,
+)
+
+DEFAULT_ASYNC_QUEUE_MAX_SIZE = 10000
+
+# placed on the queue to tell the listener thread to exit (after draining everything before it)
+_STOP = object()
+
+
+class AsyncHandlerPipeline(object):
+    """
+    A bounded queue with a background listener thread. Records placed on the queue are handled by their
+        target handlers on the listener thread, so the calling thread never waits on disk/socket I/O
+        (unless the queue is full and the policy is to block).
+
+    fullQueuePolicy can be one of:
+        FULL_QUEUE_BLOCK: wait for room on the queue
+        FULL_QUEUE_DROP_OLDEST: throw away the oldest queued record to make room
+        FULL_QUEUE_DROP_BELOW_LEVEL: throw away the new record if it is below dropLevel, otherwise wait for room
+
+    Once stopped, records are handled on the calling thread instead of queued (nothing would ever take them off
+        the queue). In a child process after os.fork(), a running pipeline starts over with an empty queue and a
+        new listener thread, since the parent's thread doesn't exist there.
+    """
+
+    def __init__(
+        self,
+        maxSize=DEFAULT_ASYNC_QUEUE_MAX_SIZE,
+        fullQueuePolicy=FULL_QUEUE_BLOCK,
+        dropLevel=logging.WARNING,
+    ):
+        if fullQueuePolicy not in FULL_QUEUE_POLICIES:
+            raise ValueError(
+                "fullQueuePolicy must be one of %s, not %s"
+                % (FULL_QUEUE_POLICIES, fullQueuePolicy)
+            )
+
+        self.maxSize = maxSize
+        self.fullQueuePolicy = fullQueuePolicy
+        self.dropLevel = dropLevel
+
+        # number of records thrown away because the queue was full
+        self.droppedRecords = 0
+
+        self._queue = queue.Queue(maxSize)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = False
+
+        registerAfterForkInChild(self._afterForkInChild)
+
+    def __repr__(self):
+        return "<AsyncHandlerPipeline %s/%s (%s)>" % (
+            self._queue.qsize(),
+            self.maxSize,
+            self.fullQueuePolicy,
+        )
+
+    def isRunning(self):
+        return self._thread is not None
+
+    def start(self):
+        with self._lock:
+            self._stopped = False
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._processQueue, name="csmlog-async-handlers", daemon=True
+                )
+                self._thread.start()
+
+                # don't lose queued records if the process exits without closing the CSMLogger
+                atexit.register(self.stop)
+
+    def stop(self):
+        """drains everything queued so far, then stops the listener thread"""
+        with self._lock:
+            thread = self._thread
+            if thread is None:
+                return
+
+            self._thread = None
+            self._stopped = True
+            atexit.unregister(self.stop)
+
+        self._queue.put(_STOP)
+        thread.join()
+
+    def _afterForkInChild(self):
+        # records queued in the parent are the parent's to handle
+        wasRunning = self._thread is not None
+        self._queue = queue.Queue(self.maxSize)
+        self._lock = threading.Lock()
+        self._thread = None
+        atexit.unregister(self.stop)
+
+        if wasRunning:
+            self.start()
+
+    def _countDropped(self):
+        with self._lock:
+            self.droppedRecords += 1
+
+    def flush(self):
+        """waits until every record queued so far has been handled"""
+        if self.isRunning():
+            self._queue.join()
+
+    def enqueue(self, forwarder, record):
+        if self._stopped:
+            forwarder.dispatch(record)
+            return
+
+        item = (forwarder, record)
+
+        if self.fullQueuePolicy == FULL_QUEUE_BLOCK:
+            self._queue.put(item)
+            return
+
+        try:
+            self._queue.put_nowait(item)
+            return
+        except queue.Full:
+            pass
+
+        if self.fullQueuePolicy == FULL_QUEUE_DROP_BELOW_LEVEL:
+            if record.levelno < self.dropLevel:
+                self._countDropped()
+            else:
+                self._queue.put(item)
+            return
+
+        # FULL_QUEUE_DROP_OLDEST
+        while True:
+            try:
+                oldest = self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            else:
+                if oldest is _STOP:
+                    # never lose the stop request... let this record go instead.
+                    self._queue.task_done()
+                    self._queue.put(_STOP)
+                    self._countDropped()
+                    return
+
+                self._queue.task_done()
+                self._countDropped()
+
+            try:
+                self._queue.put_nowait(item)
+                return
+            except queue.Full:
+                continue
+
+    def _processQueue(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP:
+                    self._drainAfterStop()
+                    return
+
+                forwarder, record = item
+                forwarder.dispatch(record)
+            finally:
+                self._queue.task_done()
+
+    def _drainAfterStop(self):
+        """handles records that were queued (by a thread racing stop()) after the stop request"""
+        while True:
+            try:
+                forwarder, record = self._queue.get_nowait()
+            except queue.Empty:
+                return
+
+            try:
+                forwarder.dispatch(record)
+            finally:
+                self._queue.task_done()
+
+
+class AsyncForwardingHandler(logging.Handler):
+    """
+    Handler that sits on a logger in place of that logger's real handlers. Records are sent through the given
+        AsyncHandlerPipeline and handed to the real (target) handlers on the pipeline's listener thread.
+    """
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.targets = []
+        logging.Handler.__init__(self)
+
+    def __repr__(self):
+        return "<AsyncForwardingHandler -> %s>" % self.targets
+
+    def addTarget(self, handler):
+        if handler not in self.targets:
+            self.targets.append(handler)
+
+    def removeTarget(self, handler):
+        if handler in self.targets:
+            self.targets.remove(handler)
+
+    def prepare(self, record):
+        """
+        Merges the args into the message now since they may be changed by the caller before the
+            listener thread gets to the record. Records with only immutable args are left as they are (so
+            handlers that render later, like the binary log handler, still get the raw args).
+        """
+        args = record.args
+        if (
+            type(record.msg) is str
+            and type(args) is tuple
+            and all(type(arg) in _IMMUTABLE_ARG_TYPES for arg in args)
+        ):
+            return record
+
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.pipeline.enqueue(self, self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+    def dispatch(self, record):
+        """called on the listener thread to run the real handlers (like Logger.callHandlers would)"""
+        for handler in self.targets[:]:
+            if record.levelno >= handler.level:
+                handler.handle(record)
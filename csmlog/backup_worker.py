@@ -0,0 +1,372 @@
+"""
+This file is part of csmlog. Python logger setup... the way I like it.
+MIT License (2021) - Charles Machalow
+"""
+
+import atexit
+import contextlib
+import functools
+import gzip
+import io
+import logging
+import os
+import queue
+import re
+import shutil
+import sys
+import threading
+import traceback
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    # not on Windows
+    fcntl = None
+
+COMPRESSION_GZIP = "gzip"
+COMPRESSION_ZSTD = "zstd"
+
+# compression -> file extension added to rotated backups
+COMPRESSION_EXTENSIONS = {
+    COMPRESSION_GZIP: ".gz",
+    COMPRESSION_ZSTD: ".zst",
+}
+
+# matches rotated backups (compressed or not) like: appName.txt.3 or appName.txt.3.gz (or binary: appName.clog.3)
+BACKUP_FILE_REGEX = re.compile(r"^.+\.(txt|clog)\.(?P<index>\d+)(\.gz|\.zst)?$")
+
+# a rotated log file waiting to be compressed: <the .1 slot it was rotated to>.<pid>.<uuid>.pending
+PENDING_FILE_REGEX = re.compile(r"^(?P<dest>.+)\.(?P<pid>\d+)\.[0-9a-f]{32}\.pending$")
+
+# placed on the queue to tell the worker thread to exit (after draining everything before it)
+_STOP = object()
+
+
+def _getZstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(
+            "zstd compression of backups requires the zstandard package: pip install csmlog[zstd]"
+        )
+    return zstandard
+
+
+def _isProcessRunning(pid):
+    if pid == os.getpid():
+        return True
+
+    if os.name == "nt":
+        # logging from multiple processes to one folder isn't supported here... it must be from an earlier run
+        return False
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def openLogFile(path, binary=False):
+    """opens a log file (or rotated backup, compressed or not) for reading text (or bytes if binary is True)"""
+    if path.endswith(COMPRESSION_EXTENSIONS[COMPRESSION_GZIP]):
+        return gzip.open(path, "rb" if binary else "rt")
+
+    if path.endswith(COMPRESSION_EXTENSIONS[COMPRESSION_ZSTD]):
+        f = _getZstandard().ZstdDecompressor().stream_reader(open(path, "rb"))
+        return f if binary else io.TextIOWrapper(f)
+
+    return open(path, "rb" if binary else "r")
+
+
+class RotatedBackupWorker(object):
+    """
+    Handles rotated log backups on a background thread so the thread that triggered the rotation
+        only has to do a rename.
+
+    compression can be None, COMPRESSION_GZIP or COMPRESSION_ZSTD.
+    If maxTotalBytes is given, the oldest backups in logFolder are deleted until all files in logFolder
+        (including the active log files) fit in maxTotalBytes. That is done with the rotation lock of every
+        attached handler held, so no backup is deleted in the middle of a rotation.
+
+    Errors are printed to stderr (like logging.Handler.handleError() does). A rotated file that failed to be
+        compressed is tried again on the next rotation. One left behind by a process that is gone (like one
+        that crashed while compressing) is put in the oldest free backup slot when a handler is attached.
+    """
+
+    def __init__(self, logFolder, compression=None, maxTotalBytes=None):
+        if compression is not None and compression not in COMPRESSION_EXTENSIONS:
+            raise ValueError(
+                "compression must be None or one of %s, not %s"
+                % (tuple(COMPRESSION_EXTENSIONS), compression)
+            )
+
+        if compression == COMPRESSION_ZSTD:
+            # fail now instead of on the first rotation
+            _getZstandard()
+
+        self.logFolder = str(logFolder)
+        self.compression = compression
+        self.maxTotalBytes = maxTotalBytes
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+        # (handler, pending file, rotation count) for compressions that failed, tried again on the next rotation
+        self._failedBackups = []
+
+        # the attached handlers
+        self._handlers = []
+
+    def __repr__(self):
+        return "<RotatedBackupWorker %s (%s)>" % (self.logFolder, self.compression)
+
+    def attach(self, handler):
+        """makes the given rotating file handler send its rotated backups to this worker"""
+        if self.compression:
+            extension = COMPRESSION_EXTENSIONS[self.compression]
+            handler.namer = lambda name: name + extension
+
+        handler.rotator = lambda source, dest: self._rotate(handler, source, dest)
+        with self._lock:
+            self._handlers.append(handler)
+        self._queue.put(functools.partial(self._recoverLeftoverBackups, handler))
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._processQueue, name="csmlog-backup-worker", daemon=True
+                )
+                self._thread.start()
+                atexit.register(self.stop)
+
+    def stop(self):
+        """finishes everything submitted so far, then stops the worker thread"""
+        with self._lock:
+            thread = self._thread
+            if thread is None:
+                return
+
+            self._thread = None
+            atexit.unregister(self.stop)
+
+        self._queue.put(_STOP)
+        thread.join()
+
+    def flush(self):
+        """waits until everything submitted so far has been handled"""
+        if self._thread is not None:
+            self._queue.join()
+
+    def _rotate(self, handler, source, dest):
+        """called (with the handler's rotation lock held) instead of renaming source to dest"""
+        if not self.compression:
+            os.rename(source, dest)
+            self._queue.put(self._retryFailedBackups)
+            return
+
+        # dest is the (compressed) .1 slot. Get the uncompressed data out of the way quickly, compress it later.
+        pending = "%s.%d.%s.pending" % (dest, os.getpid(), uuid.uuid4().hex)
+        os.rename(source, pending)
+        rotationCount = handler.incrementRotationCount()
+        self._queue.put(
+            functools.partial(
+                self._finishCompressedBackup, handler, pending, rotationCount
+            )
+        )
+
+    def _compress(self, source, dest):
+        with open(source, "rb") as src:
+            if fcntl is not None:
+                # wait for writes (from other processes) that started before the rotation
+                fcntl.flock(src.fileno(), fcntl.LOCK_EX)
+
+            if self.compression == COMPRESSION_GZIP:
+                with gzip.open(dest, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+            else:
+                with open(dest, "wb") as dst:
+                    _getZstandard().ZstdCompressor().copy_stream(src, dst)
+
+    def _reportError(self, message):
+        """prints the current exception to stderr (if logging.raiseExceptions), like logging.Handler.handleError()"""
+        if logging.raiseExceptions and sys.stderr:
+            try:
+                sys.stderr.write("--- csmlog %r: %s ---\n" % (self, message))
+                traceback.print_exc(file=sys.stderr)
+            except Exception:
+                pass
+
+    def _finishCompressedBackup(self, handler, pending, rotationCount):
+        self._retryFailedBackups()
+
+        try:
+            self._compressBackup(handler, pending, rotationCount)
+        except Exception:
+            # the uncompressed data is kept... try again next time
+            self._reportError("error compressing rotated backup %s" % pending)
+            self._failedBackups.append((handler, pending, rotationCount))
+
+    def _retryFailedBackups(self):
+        failedBackups = self._failedBackups
+        self._failedBackups = []
+        for handler, pending, rotationCount in failedBackups:
+            if not os.path.exists(pending):
+                # deleted to fit in maxTotalBytes
+                continue
+
+            try:
+                self._compressBackup(handler, pending, rotationCount)
+            except Exception:
+                self._reportError("error compressing rotated backup %s" % pending)
+                self._failedBackups.append((handler, pending, rotationCount))
+
+    def _compressBackup(self, handler, pending, rotationCount):
+        compressed = pending + COMPRESSION_EXTENSIONS[self.compression]
+        try:
+            self._compress(pending, compressed)
+        except BaseException:
+            # keep the uncompressed data instead of losing it
+            if os.path.exists(compressed):
+                os.remove(compressed)
+            raise
+
+        os.remove(pending)
+
+        with handler.rotationLock():
+            # each rotation since this one was submitted moved it back one slot.
+            slot = 1 + handler.getRotationCount() - rotationCount
+            if slot > handler.backupCount:
+                # rotated out already
+                os.remove(compressed)
+                return
+
+            os.replace(
+                compressed,
+                handler.rotation_filename("%s.%d" % (handler.baseFilename, slot)),
+            )
+
+    def _recoverLeftoverBackups(self, handler):
+        """
+        puts rotated files that a process (that is gone) left waiting to be compressed into the oldest free
+            backup slots. Their slots are unknown, but they are older than anything rotated since.
+        """
+        firstSlot = handler.rotation_filename(handler.baseFilename + ".1")
+        leftovers = []
+        for entry in os.scandir(os.path.dirname(firstSlot) or "."):
+            match = PENDING_FILE_REGEX.match(entry.name)
+            if (
+                match
+                and match.group("dest") == os.path.basename(firstSlot)
+                and not _isProcessRunning(int(match.group("pid")))
+            ):
+                try:
+                    leftovers.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    pass
+
+        # newest first, so the oldest ends up furthest back
+        for _, pending in sorted(leftovers, reverse=True):
+            try:
+                backup = pending
+                if self.compression:
+                    backup = pending + COMPRESSION_EXTENSIONS[self.compression]
+                    self._compress(pending, backup)
+                    os.remove(pending)
+
+                with handler.rotationLock():
+                    slot = 1
+                    while slot <= handler.backupCount and os.path.exists(
+                        handler.rotation_filename(
+                            "%s.%d" % (handler.baseFilename, slot)
+                        )
+                    ):
+                        slot += 1
+
+                    if slot > handler.backupCount:
+                        # it would have been rotated out
+                        os.remove(backup)
+                    else:
+                        os.replace(
+                            backup,
+                            handler.rotation_filename(
+                                "%s.%d" % (handler.baseFilename, slot)
+                            ),
+                        )
+            except Exception:
+                self._reportError("error recovering rotated backup %s" % pending)
+
+    def enforceMaxTotalBytes(self):
+        """deletes the oldest backups in logFolder until everything in logFolder fits in maxTotalBytes"""
+        if self.maxTotalBytes is None:
+            return
+
+        # by file name, so every process takes the locks in the same order
+        with self._lock:
+            handlers = sorted(self._handlers, key=lambda h: h.baseFilename)
+
+        # the logging threads (or other processes) rename backups while rotating
+        with contextlib.ExitStack() as stack:
+            for handler in handlers:
+                stack.enter_context(handler.rotationLock())
+            self._deleteOldestBackups()
+
+    def _deleteOldestBackups(self):
+        totalBytes = 0
+        backups = []
+        for entry in os.scandir(self.logFolder):
+            if not entry.is_file():
+                continue
+
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+
+            totalBytes += stat.st_size
+            name = entry.name
+            pendingMatch = PENDING_FILE_REGEX.match(name)
+            if pendingMatch:
+                # waiting to be compressed into its slot
+                name = pendingMatch.group("dest")
+
+            match = BACKUP_FILE_REGEX.match(name)
+            if match:
+                backups.append(
+                    (
+                        stat.st_mtime,
+                        -int(match.group("index")),
+                        entry.path,
+                        stat.st_size,
+                    )
+                )
+
+        # oldest first (higher index is older if the times match)
+        for _, _, path, size in sorted(backups):
+            if totalBytes <= self.maxTotalBytes:
+                break
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            totalBytes -= size
+
+    def _processQueue(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP:
+                    return
+
+                item()
+                self.enforceMaxTotalBytes()
+            except Exception:
+                self._reportError("error handling rotated backups")
+            finally:
+                self._queue.task_done()
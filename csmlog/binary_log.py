@@ -0,0 +1,554 @@
+"""
+This file is part of csmlog. Python logger setup... the way I like it.
+MIT License (2021) - Charles Machalow
+"""
+
+import argparse
+import logging
+import logging.handlers
+import os
+import struct
+import sys
+
+from csmlog.after_fork import registerAfterForkInChild
+from csmlog.backup_worker import openLogFile
+from csmlog.rotating_file_handler import (
+    DEFAULT_BACKUP_COUNT,
+    DEFAULT_MAX_BYTES,
+    _RotationTrackingMixin,
+)
+
+# extension used for binary log files (instead of .txt)
+BINARY_LOG_EXTENSION = ".clog"
+
+# written at the start of every binary log file
+BINARY_LOG_MAGIC = b"CSMLOGB2"
+
+# every frame is: (frame type, session, payload length) then the payload. A session is one writer's string table:
+#   more than one process can append to a file, each with its own string ids.
+_FRAME_HEADER = struct.Struct("<cII")
+
+# defines a string id (for the rest of the file, in its session): (string id) then the utf-8 string
+FRAME_STRING = b"S"
+
+# a log record: _RECORD_HEADER, then the args, then the optional message/exc_text/stack_info strings
+FRAME_RECORD = b"R"
+
+# created, msecs, levelno, process, thread, string ids for: levelname, name, pathname, funcName, threadName, msg
+#   (0 if the message is stored in the record), then lineno, number of args and flags
+_RECORD_HEADER = struct.Struct("<ddIIQIIIIIIIHB")
+_STRING_ID = struct.Struct("<I")
+_LENGTH = struct.Struct("<I")
+
+_MAX_ARGS = 0xFFFF
+
+# the (already rendered) message is in the record instead of being an interned format string
+_FLAG_MESSAGE = 1
+_FLAG_EXC_TEXT = 2
+_FLAG_STACK_INFO = 4
+
+# tags for encoded args
+_ARG_NONE = b"N"
+_ARG_TRUE = b"T"
+_ARG_FALSE = b"F"
+_ARG_INT = b"i"
+_ARG_BIG_INT = b"I"
+_ARG_FLOAT = b"f"
+_ARG_STR = b"s"
+_ARG_BYTES = b"b"
+
+_INT = struct.Struct("<q")
+_FLOAT = struct.Struct("<d")
+
+# types that can be stored as-is and rendered later (with the same result)
+_RAW_ARG_TYPES = frozenset((type(None), bool, int, float, str, bytes))
+
+DECODE_READ_SIZE = 1024 * 1024
+
+
+class BinaryLogError(ValueError):
+    """raised if a binary log file can't be decoded"""
+
+
+class _StringTable(dict):
+    """string id -> string for one session of a file being decoded"""
+
+    def __missing__(self, stringId):
+        # only a corrupt file (or one missing its start) uses an id it never defined
+        raise BinaryLogError("String id %d was used but never defined" % stringId)
+
+
+def _encodeArg(arg, out):
+    argType = type(arg)
+    if arg is None:
+        out.append(_ARG_NONE)
+    elif argType is bool:
+        out.append(_ARG_TRUE if arg else _ARG_FALSE)
+    elif argType is int:
+        if -(2**63) <= arg < 2**63:
+            out.append(_ARG_INT + _INT.pack(arg))
+        else:
+            data = str(arg).encode()
+            out.append(_ARG_BIG_INT + _LENGTH.pack(len(data)) + data)
+    elif argType is float:
+        out.append(_ARG_FLOAT + _FLOAT.pack(arg))
+    elif argType is str:
+        data = _encodeString(arg)
+        out.append(_ARG_STR + _LENGTH.pack(len(data)))
+        out.append(data)
+    else:
+        out.append(_ARG_BYTES + _LENGTH.pack(len(arg)))
+        out.append(arg)
+
+
+def _decodeArgs(data, offset, count):
+    args = []
+    for i in range(count):
+        tag = data[offset : offset + 1]
+        offset += 1
+        if tag == _ARG_NONE:
+            args.append(None)
+        elif tag == _ARG_TRUE:
+            args.append(True)
+        elif tag == _ARG_FALSE:
+            args.append(False)
+        elif tag == _ARG_INT:
+            args.append(_INT.unpack_from(data, offset)[0])
+            offset += _INT.size
+        elif tag == _ARG_FLOAT:
+            args.append(_FLOAT.unpack_from(data, offset)[0])
+            offset += _FLOAT.size
+        else:
+            (length,) = _LENGTH.unpack_from(data, offset)
+            offset += _LENGTH.size
+            value = bytes(data[offset : offset + length])
+            offset += length
+            if tag == _ARG_STR:
+                value = value.decode("utf-8", "surrogatepass")
+            elif tag == _ARG_BIG_INT:
+                value = int(value)
+            elif tag != _ARG_BYTES:
+                raise BinaryLogError("Unknown arg tag: %r" % tag)
+            args.append(value)
+
+    return tuple(args), offset
+
+
+def _encodeString(s):
+    return s.encode("utf-8", "surrogatepass")
+
+
+class BinaryRecordEncoder(object):
+    """
+    Encodes log records into binary frames. Strings (format strings, logger names, paths, etc.) are interned:
+        each is written once (as a string frame) and later records refer to it by id.
+        Primitive args (None, bool, int, float, str, bytes) are stored as-is so the message is only rendered
+        when the log is read. Any other args (or a non-str msg) are rendered now, since they may not
+        exist/render the same way later. Messages without args (like f-strings) are stored in the record
+        instead of being interned, since they are rarely repeated.
+    """
+
+    def __init__(self, formatter=None):
+        # used for exception text
+        self.formatter = formatter or logging.Formatter()
+        self.reset()
+
+        # a forked child writing to the same file needs its own session
+        registerAfterForkInChild(self.reset)
+
+    def reset(self):
+        """forget interned strings and start a new session (must be called when starting a new file)"""
+        self._stringIds = {None: 0}
+
+        # random, so other processes appending to the same file (very likely) use other sessions
+        self.session = struct.unpack("<I", os.urandom(4))[0]
+
+    def _stringId(self, s, out):
+        stringId = self._stringIds.get(s)
+        if stringId is None:
+            stringId = len(self._stringIds)
+            self._stringIds[s] = stringId
+            data = _STRING_ID.pack(stringId) + _encodeString(s)
+            out.append(_FRAME_HEADER.pack(FRAME_STRING, self.session, len(data)))
+            out.append(data)
+        return stringId
+
+    def encode(self, record):
+        """returns the bytes for the record (including any string frames it needs first)"""
+        out = []
+        stringId = self._stringId
+
+        args = record.args
+        if (
+            args
+            and type(record.msg) is str
+            and type(args) is tuple
+            and len(args) <= _MAX_ARGS
+            and all(type(a) in _RAW_ARG_TYPES for a in args)
+        ):
+            msg = record.msg
+            message = None
+        else:
+            msg = None
+            message = _encodeString(record.getMessage())
+            args = ()
+
+        if record.exc_info and not record.exc_text:
+            # same caching as logging.Formatter.format()
+            record.exc_text = self.formatter.formatException(record.exc_info)
+
+        flags = 0
+        extra = []
+        if message is not None:
+            flags |= _FLAG_MESSAGE
+            extra.append(message)
+        if record.exc_text:
+            flags |= _FLAG_EXC_TEXT
+            extra.append(_encodeString(record.exc_text))
+        if record.stack_info:
+            flags |= _FLAG_STACK_INFO
+            extra.append(_encodeString(record.stack_info))
+
+        header = _RECORD_HEADER.pack(
+            record.created,
+            record.msecs,
+            record.levelno,
+            record.process or 0,
+            record.thread or 0,
+            stringId(record.levelname, out),
+            stringId(record.name, out),
+            stringId(record.pathname, out),
+            stringId(record.funcName, out),
+            stringId(record.threadName, out),
+            stringId(msg, out),
+            record.lineno or 0,
+            len(args),
+            flags,
+        )
+
+        payload = [header]
+        for arg in args:
+            _encodeArg(arg, payload)
+        for data in extra:
+            payload.append(_LENGTH.pack(len(data)))
+            payload.append(data)
+
+        payload = b"".join(payload)
+        out.append(_FRAME_HEADER.pack(FRAME_RECORD, self.session, len(payload)))
+        out.append(payload)
+        return b"".join(out)
+
+
+class BinaryRotatingFileHandler(
+    _RotationTrackingMixin, logging.handlers.RotatingFileHandler
+):
+    """
+    A RotatingFileHandler that writes binary frames (see BinaryRecordEncoder) instead of formatted text.
+        Nothing is formatted when logging; use decodeBinaryLogFiles() or csmlog-decode to get the text back.
+        Each file (including rotated backups) starts with its own string table so it can be decoded alone.
+        Each process writing to a file has its own string table (see BinaryRecordEncoder.reset()).
+    """
+
+    def __init__(
+        self,
+        filename,
+        maxBytes=DEFAULT_MAX_BYTES,
+        backupCount=DEFAULT_BACKUP_COUNT,
+        delay=True,
+    ):
+        self.encoder = BinaryRecordEncoder()
+        logging.handlers.RotatingFileHandler.__init__(
+            self,
+            filename,
+            mode="ab",
+            maxBytes=maxBytes,
+            backupCount=backupCount,
+            delay=True,
+        )
+
+        # RotatingFileHandler switches to text append mode if maxBytes is given
+        self.mode = "ab"
+        self.encoding = None
+
+        if not delay:
+            self.stream = self._open()
+
+    def __repr__(self):
+        return "<BinaryRotatingFileHandler %s>" % self.baseFilename
+
+    def setFormatter(self, fmt):
+        logging.handlers.RotatingFileHandler.setFormatter(self, fmt)
+
+        # only used for exception text. Everything else is formatted at decode time.
+        self.encoder.formatter = fmt or logging.Formatter()
+
+    def _open(self):
+        stream = logging.handlers.RotatingFileHandler._open(self)
+
+        # string ids start over in each file
+        self.encoder.reset()
+        if stream.seek(0, 2) == 0:
+            stream.write(BINARY_LOG_MAGIC)
+        return stream
+
+    def _shouldRollover(self, size):
+        if self.maxBytes <= 0:
+            return False
+
+        position = self.stream.tell()
+        return position > len(BINARY_LOG_MAGIC) and position + size >= self.maxBytes
+
+    def emit(self, record):
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+
+            data = self.encoder.encode(record)
+            if self._shouldRollover(len(data)):
+                self.doRollover()
+                if self.stream is None:
+                    self.stream = self._open()
+
+                # the new file has its own string table
+                data = self.encoder.encode(record)
+
+            self.stream.write(data)
+            self.stream.flush()
+        except Exception:
+            # string ids given out for a frame that didn't make it to the file can't be used anymore
+            self.encoder.reset()
+            self.handleError(record)
+
+
+def _newRecord():
+    return logging.LogRecord.__new__(logging.LogRecord)
+
+
+def _getFilenameAndModule(pathname):
+    """same as what logging.LogRecord does"""
+    try:
+        filename = os.path.basename(pathname)
+        return filename, os.path.splitext(filename)[0]
+    except (TypeError, ValueError, AttributeError):
+        return pathname, "Unknown module"
+
+
+def decodeBinaryLogRecords(f):
+    """
+    yields the logging.LogRecords from the given binary log file object (opened for reading bytes).
+        A partial frame at the end of the file (like from a write in progress or a crash) is ignored.
+        Raises BinaryLogError for a frame that can't be decoded (like a record using a string id that was
+        never defined, in a corrupt file).
+    """
+    magic = f.read(len(BINARY_LOG_MAGIC))
+    if magic != BINARY_LOG_MAGIC:
+        raise BinaryLogError("Not a csmlog binary log file (magic: %r)" % magic)
+
+    # session -> string id -> string
+    sessions = {}
+    # (session, pathname string id) -> (filename, module)
+    pathInfo = {}
+    headerSize = _FRAME_HEADER.size
+    unpackFrameHeader = _FRAME_HEADER.unpack_from
+    unpackRecordHeader = _RECORD_HEADER.unpack_from
+    recordHeaderSize = _RECORD_HEADER.size
+
+    data = b""
+    offset = 0
+    while True:
+        chunk = f.read(DECODE_READ_SIZE)
+        if not chunk:
+            return
+
+        data = data[offset:] + chunk
+        offset = 0
+        dataLen = len(data)
+
+        while offset + headerSize <= dataLen:
+            frameType, session, length = unpackFrameHeader(data, offset)
+            start = offset + headerSize
+            end = start + length
+            if end > dataLen:
+                break
+
+            offset = end
+            strings = sessions.get(session)
+            if strings is None:
+                strings = sessions[session] = _StringTable({0: None})
+
+            if frameType == FRAME_RECORD:
+                (
+                    created,
+                    msecs,
+                    levelno,
+                    process,
+                    thread,
+                    levelnameId,
+                    nameId,
+                    pathnameId,
+                    funcNameId,
+                    threadNameId,
+                    msgId,
+                    lineno,
+                    argCount,
+                    flags,
+                ) = unpackRecordHeader(data, start)
+                position = start + recordHeaderSize
+
+                if argCount:
+                    args, position = _decodeArgs(data, position, argCount)
+                else:
+                    args = ()
+
+                msg = strings[msgId]
+                excText = stackInfo = None
+                if flags & _FLAG_MESSAGE:
+                    (textLength,) = _LENGTH.unpack_from(data, position)
+                    position += _LENGTH.size
+                    msg = data[position : position + textLength].decode(
+                        "utf-8", "surrogatepass"
+                    )
+                    position += textLength
+                if flags & _FLAG_EXC_TEXT:
+                    (textLength,) = _LENGTH.unpack_from(data, position)
+                    position += _LENGTH.size
+                    excText = data[position : position + textLength].decode(
+                        "utf-8", "surrogatepass"
+                    )
+                    position += textLength
+                if flags & _FLAG_STACK_INFO:
+                    (textLength,) = _LENGTH.unpack_from(data, position)
+                    position += _LENGTH.size
+                    stackInfo = data[position : position + textLength].decode(
+                        "utf-8", "surrogatepass"
+                    )
+
+                pathname = strings[pathnameId]
+                filenameAndModule = pathInfo.get((session, pathnameId))
+                if filenameAndModule is None:
+                    filenameAndModule = _getFilenameAndModule(pathname)
+                    pathInfo[(session, pathnameId)] = filenameAndModule
+
+                record = _newRecord()
+                record.__dict__.update(
+                    name=strings[nameId],
+                    msg=msg,
+                    args=args,
+                    levelname=strings[levelnameId],
+                    levelno=levelno,
+                    pathname=pathname,
+                    filename=filenameAndModule[0],
+                    module=filenameAndModule[1],
+                    exc_info=None,
+                    exc_text=excText,
+                    stack_info=stackInfo,
+                    lineno=lineno,
+                    funcName=strings[funcNameId],
+                    created=created,
+                    msecs=msecs,
+                    relativeCreated=0.0,
+                    thread=thread,
+                    threadName=strings[threadNameId],
+                    processName=None,
+                    process=process,
+                    taskName=None,
+                )
+                yield record
+            elif frameType == FRAME_STRING:
+                (stringId,) = _STRING_ID.unpack_from(data, start)
+                # a string id can be defined again (by a later writer in the same session)
+                pathInfo.pop((session, stringId), None)
+                strings[stringId] = data[start + _STRING_ID.size : end].decode(
+                    "utf-8", "surrogatepass"
+                )
+            else:
+                raise BinaryLogError("Unknown frame type: %r" % frameType)
+
+
+def decodeBinaryLogFiles(logFile, output, formatter=None, includeBackups=True):
+    """
+    Writes the records of the given binary log file (and optionally its rotated backups, oldest first)
+        to output (a text file object) formatted with the given formatter (defaults to DEFAULT_LOG_FORMAT).
+    Returns the number of records written.
+    """
+    # imported here to avoid circular imports
+    from csmlog import DEFAULT_LOG_FORMAT
+    from csmlog.formatter import FastFormatter
+    from csmlog.log_splitter import getLogFileWithBackups
+
+    if formatter is None:
+        formatter = FastFormatter(DEFAULT_LOG_FORMAT)
+
+    files = getLogFileWithBackups(logFile) if includeBackups else [logFile]
+
+    count = 0
+    lines = []
+    for path in files:
+        with openLogFile(path, binary=True) as f:
+            for record in decodeBinaryLogRecords(f):
+                try:
+                    lines.append(formatter.format(record))
+                except (TypeError, ValueError):
+                    # this would have gone to handleError() when logging a text log
+                    lines.append(
+                        "<csmlog-decode: can't format: msg=%r args=%r>"
+                        % (record.msg, record.args)
+                    )
+
+                count += 1
+                if len(lines) >= 1024:
+                    lines.append("")
+                    output.write("\n".join(lines))
+                    lines = []
+
+    if lines:
+        lines.append("")
+        output.write("\n".join(lines))
+
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Decodes csmlog binary log files (%s) to text"
+        % BINARY_LOG_EXTENSION
+    )
+    parser.add_argument("logFiles", nargs="+", help="path(s) to binary log files")
+    parser.add_argument(
+        "-f",
+        "--format",
+        default=None,
+        help="logging format string to use (defaults to csmlog's DEFAULT_LOG_FORMAT)",
+    )
+    parser.add_argument(
+        "--no-backups",
+        action="store_true",
+        help="don't include rotated backups of the log file(s)",
+    )
+    args = parser.parse_args()
+
+    formatter = None
+    if args.format:
+        from csmlog.formatter import FastFormatter
+
+        formatter = FastFormatter(args.format)
+
+    try:
+        for logFile in args.logFiles:
+            decodeBinaryLogFiles(
+                logFile,
+                sys.stdout,
+                formatter=formatter,
+                includeBackups=not args.no_backups,
+            )
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # like when piped into head
+        sys.stderr.close()
+    except BinaryLogError as ex:
+        sys.stdout.flush()
+        parser.exit(1, "csmlog-decode: %s\n" % ex)
+
+
+if __name__ == "__main__":
+    main()
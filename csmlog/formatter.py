@@ -0,0 +1,211 @@
+"""
+This file is part of csmlog. Python logger setup... the way I like it.
+MIT License (2021) - Charles Machalow
+"""
+
+import logging
+import operator
+import re
+import time
+import weakref
+
+# '%%' or the start of a '%(name)...' field in a '%' style format string
+_PERCENT_FIELD_REGEX = re.compile(r"%%|%\((\w+)\)")
+
+
+# what a formatter that hasn't formatted anything yet remembers (see formatCached())
+_NOT_FORMATTED = (None, None, None, None)
+
+
+def _compilePercentFormat(style):
+    """
+    Turns a '%' style format string like '%(name)s - %(message)s' into a function taking the record's __dict__
+        that does a positional '%s - %s' % (name, message) instead of a lookup by name for each field.
+    Returns None if the format can't be compiled like this (so the normal formatting should be used)
+    """
+    if type(style) is not logging.PercentStyle or getattr(style, "_defaults", None):
+        return None
+
+    fields = []
+
+    def _replace(match):
+        if match.group(1) is None:
+            return "%%"
+
+        fields.append(match.group(1))
+        return "%"
+
+    positionalFmt = _PERCENT_FIELD_REGEX.sub(_replace, style._fmt)
+
+    # a conversion without a field name (like '%s') would mean something different positionally
+    if not fields or positionalFmt.replace("%%", "").count("%") != len(fields):
+        return None
+
+    getter = operator.itemgetter(*fields)
+    if len(fields) == 1:
+        return lambda values: positionalFmt % (getter(values),)
+
+    return lambda values: positionalFmt % getter(values)
+
+
+def _lastFormatted(formatter, record):
+    """returns the string the formatter last formatted if it was for this record (as it is now), otherwise None"""
+    recordRef, msg, args, formatted = getattr(
+        formatter, "_csmlogLastFormatted", _NOT_FORMATTED
+    )
+    if recordRef is not None and recordRef() is record:
+        if record.msg is msg and record.args is args:
+            return formatted
+    return None
+
+
+def _setLastFormatted(formatter, record, formatted):
+    # only a weak reference to the record: it (and its traceback) shouldn't live on in the formatter
+    formatter._csmlogLastFormatted = (
+        weakref.ref(record),
+        record.msg,
+        record.args,
+        formatted,
+    )
+
+
+def formatCached(formatter, record):
+    """
+    Formats the record with the given formatter, unless that formatter just formatted it (for another handler).
+        Returns the formatted string. A record whose msg or args were replaced since is formatted again.
+
+    The cache is kept on the formatter (as the last record it formatted) rather than on the record: adding
+        attributes to a LogRecord can be slower than the formatting that would be saved.
+    """
+    formatted = _lastFormatted(formatter, record)
+    if formatted is not None:
+        return formatted
+
+    formatted = formatter.format(record)
+    _setLastFormatted(formatter, record, formatted)
+    return formatted
+
+
+def formatCachedBytes(formatter, record, terminator, encoding):
+    """
+    Like formatCached(), but returns (formatted + terminator) encoded with the given encoding.
+        The bytes are cached too, for the next handler using the same terminator/encoding.
+    """
+    formatted = formatCached(formatter, record)
+
+    encoded = getattr(formatter, "_csmlogLastEncoded", None)
+    if (
+        encoded is not None
+        and encoded[0] is formatted
+        and encoded[1] == terminator
+        and encoded[2] == encoding
+    ):
+        return encoded[3]
+
+    data = (formatted + terminator).encode(encoding)
+    formatter._csmlogLastEncoded = (formatted, terminator, encoding, data)
+    return data
+
+
+class SharedFormatCacheMixin(object):
+    """
+    Mixin for handlers managed by CSMLogger. Handlers sharing a formatter share the formatted string
+        (and encoded bytes) of each record, so a record is formatted once no matter how many handlers emit it.
+
+    A handler that has its own formatter should set useSharedFormatCache to False. It then always formats records
+        itself and CSMLogger.setFormatter() leaves its formatter alone.
+    """
+
+    useSharedFormatCache = True
+
+    def format(self, record):
+        if not self.useSharedFormatCache:
+            return logging.Handler.format(self, record)
+
+        return formatCached(self.formatter or logging._defaultFormatter, record)
+
+    def formatBytes(self, record, terminator, encoding):
+        """returns (self.format(record) + terminator) encoded with the given encoding"""
+        if not self.useSharedFormatCache:
+            return (self.format(record) + terminator).encode(encoding)
+
+        return formatCachedBytes(
+            self.formatter or logging._defaultFormatter, record, terminator, encoding
+        )
+
+
+class FastFormatter(logging.Formatter):
+    """
+    A logging.Formatter that gives the exact same output, but is faster:
+        - the formatted time is cached for the current second, only the milliseconds are spliced in
+        - '%' style format strings are compiled into a function that formats positionally
+        - a record is only formatted once by a given FastFormatter, even if multiple handlers format it
+            (see formatCached())
+    """
+
+    def __init__(self, *args, **kwargs):
+        logging.Formatter.__init__(self, *args, **kwargs)
+
+        # (second, datefmt, formatted time without milliseconds)
+        self._cachedTime = (None, None, None)
+        self._render = _compilePercentFormat(self._style)
+        self._usesTime = self.usesTime()
+
+        # (weak reference to the record, its msg, its args, formatted string) for the last record formatted
+        #   (see formatCached()). Replaced as a whole, so another thread never sees a record with someone else's
+        #   string.
+        self._csmlogLastFormatted = _NOT_FORMATTED
+
+    def formatTime(self, record, datefmt=None):
+        second = int(record.created)
+        cachedSecond, cachedDatefmt, formattedTime = self._cachedTime
+        if cachedSecond != second or cachedDatefmt != datefmt:
+            formattedTime = time.strftime(
+                datefmt or self.default_time_format, self.converter(second)
+            )
+            self._cachedTime = (second, datefmt, formattedTime)
+
+        if not datefmt and self.default_msec_format:
+            return self.default_msec_format % (formattedTime, record.msecs)
+
+        return formattedTime
+
+    def formatMessage(self, record):
+        if self._render is not None:
+            try:
+                return self._render(record.__dict__)
+            except KeyError:
+                # let the normal path raise the normal error
+                pass
+
+        return logging.Formatter.formatMessage(self, record)
+
+    def format(self, record):
+        """
+        Same as logging.Formatter.format(), but returns the already formatted string if this formatter
+            has just formatted this record.
+        """
+        formatted = _lastFormatted(self, record)
+        if formatted is not None:
+            return formatted
+
+        record.message = record.getMessage()
+        if self._usesTime:
+            record.asctime = self.formatTime(record, self.datefmt)
+
+        s = self.formatMessage(record)
+        if record.exc_info:
+            # cache the traceback text to avoid converting it multiple times
+            if not record.exc_text:
+                record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            if s[-1:] != "\n":
+                s = s + "\n"
+            s = s + record.exc_text
+        if record.stack_info:
+            if s[-1:] != "\n":
+                s = s + "\n"
+            s = s + self.formatStack(record.stack_info)
+
+        _setLastFormatted(self, record, s)
+        return s
@@ -0,0 +1,197 @@
+"""
+This file is part of csmlog. Python logger setup... the way I like it.
+MIT License (2021) - Charles Machalow
+"""
+
+import argparse
+import os
+import re
+
+from csmlog.backup_worker import COMPRESSION_EXTENSIONS, openLogFile
+
+# csmlog's DEFAULT_LOG_FORMAT
+DEFAULT_LOG_FORMAT = "%(asctime)s - %(name)s:%(lineno)d - %(levelname)s - %(message)s"
+
+# split files go in this folder (next to the log file) unless told otherwise
+DEFAULT_SPLIT_FOLDER_NAME = "split"
+
+# a %-style field in a logging format string, like %(name)s or %(levelname)-8s
+_FORMAT_FIELD_REGEX = re.compile(
+    r"%\((?P<key>\w+)\)[#0+ -]*(?:\d+)?(?:\.\d+)?(?P<type>[diouxXeEfFgGcrsa])"
+)
+
+# what an asctime with the default datefmt looks like
+_DEFAULT_ASCTIME_REGEX = r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}"
+
+
+def recordStartRegexFromFormat(logFormat=DEFAULT_LOG_FORMAT, datefmt=None):
+    """
+    returns a regex (for splitLogFile()) matching the start of a record written with the given %-style logging
+        format string: everything before %(message)s, with the logger name in the 'name' group
+    """
+    prefix = logFormat.split("%(message)", 1)[0]
+    if "%(name)" not in prefix:
+        raise ValueError(
+            "can't split by logger with a format that doesn't have %%(name)s before %%(message)s: %s"
+            % logFormat
+        )
+
+    regex = "^"
+    position = 0
+    for match in _FORMAT_FIELD_REGEX.finditer(prefix):
+        regex += re.escape(prefix[position : match.start()].replace("%%", "%"))
+        position = match.end()
+
+        key = match.group("key")
+        if key == "name":
+            regex += "(?P<name>.+?)"
+        elif key == "asctime" and datefmt is None:
+            regex += _DEFAULT_ASCTIME_REGEX
+        elif match.group("type") in "diouxX":
+            regex += r" *-?\d+ *"
+        else:
+            regex += ".*?"
+
+    return regex + re.escape(prefix[position:].replace("%%", "%"))
+
+
+# matches the start of a record written with DEFAULT_LOG_FORMAT
+DEFAULT_RECORD_START_REGEX = recordStartRegexFromFormat()
+
+
+def getLogFileWithBackups(logFile):
+    """returns the given log file and its rotated (possibly compressed) backups, oldest first"""
+    backups = []
+    i = 1
+    while True:
+        for extension in ("",) + tuple(COMPRESSION_EXTENSIONS.values()):
+            backup = "%s.%d%s" % (logFile, i, extension)
+            if os.path.isfile(backup):
+                backups.append(backup)
+                break
+        else:
+            break
+
+        i += 1
+
+    files = list(reversed(backups))
+    if os.path.isfile(logFile):
+        files.append(logFile)
+    return files
+
+
+def splitLogFile(
+    logFile,
+    outputFolder=None,
+    recordStartRegex=DEFAULT_RECORD_START_REGEX,
+    includeBackups=True,
+    overwrite=False,
+):
+    """
+    Splits a consolidated log file (and optionally its rotated backups) into one file per logger name,
+        like what would have been written without consolidateLogFiles. Lines that don't start a new record
+        (like traceback lines) go with the record before them.
+
+    The split files go in outputFolder, by default a 'split' folder next to the log file (so they never
+        replace the per-logger files csmlog writes itself). An existing split file raises FileExistsError
+        unless overwrite is True. If splitting fails, the split files it already wrote are removed.
+
+    recordStartRegex must have a named group: 'name' for the logger name. For a log file written with a
+        format other than DEFAULT_LOG_FORMAT, build it with recordStartRegexFromFormat().
+    Returns a dict of logger name to the path of its split file.
+    """
+    if outputFolder is None:
+        outputFolder = os.path.join(
+            os.path.dirname(os.path.abspath(logFile)), DEFAULT_SPLIT_FOLDER_NAME
+        )
+
+    os.makedirs(outputFolder, exist_ok=True)
+
+    recordStart = re.compile(recordStartRegex)
+    consolidatedName = os.path.splitext(os.path.basename(logFile))[0]
+    files = getLogFileWithBackups(logFile) if includeBackups else [logFile]
+
+    outputs = {}
+    splitFiles = {}
+    try:
+        currentOutput = None
+        for path in files:
+            with openLogFile(path) as f:
+                for line in f:
+                    match = recordStart.match(line)
+                    if match:
+                        name = match.group("name")
+                        if name == consolidatedName:
+                            # the parent logger's own records are only in the consolidated file
+                            currentOutput = None
+                            continue
+
+                        currentOutput = outputs.get(name)
+                        if currentOutput is None:
+                            splitFile = os.path.join(outputFolder, name + ".txt")
+                            currentOutput = open(splitFile, "w" if overwrite else "x")
+                            outputs[name] = currentOutput
+                            splitFiles[name] = splitFile
+
+                    if currentOutput is not None:
+                        currentOutput.write(line)
+    except BaseException:
+        # don't leave part of a split behind
+        for name, output in outputs.items():
+            output.close()
+            os.remove(splitFiles[name])
+        raise
+    finally:
+        for output in outputs.values():
+            output.close()
+
+    return splitFiles
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Splits a consolidated csmlog log file into one file per logger"
+    )
+    parser.add_argument("logFile", help="path to the consolidated log file")
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        default=None,
+        help="folder to write the split files to (defaults to a '%s' folder next to the log file)"
+        % DEFAULT_SPLIT_FOLDER_NAME,
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        default=DEFAULT_LOG_FORMAT,
+        help="logging format string the log file was written with (defaults to csmlog's DEFAULT_LOG_FORMAT)",
+    )
+    parser.add_argument(
+        "--datefmt",
+        default=None,
+        help="logging date format the log file was written with (if not the default)",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="replace split files that already exist",
+    )
+    parser.add_argument(
+        "--no-backups",
+        action="store_true",
+        help="don't include rotated backups of the log file",
+    )
+    args = parser.parse_args()
+
+    for path in splitLogFile(
+        args.logFile,
+        args.output_dir,
+        recordStartRegexFromFormat(args.format, args.datefmt),
+        includeBackups=not args.no_backups,
+        overwrite=args.overwrite,
+    ).values():
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+This file is part of csmlog. Python logger setup... the way I like it.
+MIT License (2021) - Charles Machalow
+"""
+
+
+class RingBuffer(object):
+    """
+    A fixed capacity buffer of the latest bytes written to it. Writing costs the size of the data written (not the
+        size of the buffer) and nothing is reallocated.
+
+    Every byte written gets a sequence number (its offset in everything ever written), so readers can ask for what
+        was written since the last time they looked. Not thread safe: readers and writers should share a lock.
+    """
+
+    def __init__(self, capacity):
+        if capacity <= 0:
+            raise ValueError("capacity must be positive, not %s" % capacity)
+
+        self.capacity = capacity
+        self._data = bytearray(capacity)
+
+        # sequence number of the next byte to be written
+        self._end = 0
+
+    def __repr__(self):
+        return "<RingBuffer %d/%d bytes>" % (len(self), self.capacity)
+
+    def __len__(self):
+        return min(self._end, self.capacity)
+
+    @property
+    def start(self):
+        """sequence number of the oldest byte still in the buffer"""
+        return max(0, self._end - self.capacity)
+
+    @property
+    def end(self):
+        """sequence number of the next byte to be written (the total number of bytes ever written)"""
+        return self._end
+
+    def write(self, data):
+        view = memoryview(data)
+        dataLen = len(view)
+        if dataLen > self.capacity:
+            # only the tail would survive
+            self._end += dataLen - self.capacity
+            view = view[dataLen - self.capacity :]
+            dataLen = self.capacity
+
+        position = self._end % self.capacity
+        firstLen = min(dataLen, self.capacity - position)
+        self._data[position : position + firstLen] = view[:firstLen]
+        if firstLen < dataLen:
+            self._data[: dataLen - firstLen] = view[firstLen:]
+
+        self._end += dataLen
+
+    def views(self, since=None):
+        """
+        Returns a list of (up to 2) memoryviews of the bytes from sequence number since (or the oldest byte still in
+            the buffer) to the end, without copying. The views see later writes, so use them before writing again.
+        """
+        start = self.start
+        if since is None or since < start:
+            since = start
+        if since >= self._end:
+            return []
+
+        data = memoryview(self._data)
+        first = since % self.capacity
+        last = self._end % self.capacity
+        if first < last:
+            return [data[first:last]]
+
+        # wraps around the end of the buffer
+        views = [data[first:]]
+        if last:
+            views.append(data[:last])
+        return views
+
+    def read(self, since=None):
+        """returns (a copy of) the bytes from sequence number since (or the oldest byte still in the buffer) to the end"""
+        return b"".join(self.views(since))
+
+    def lastLines(self, count):
+        """returns (a copy of) the last count lines. An unfinished line at the end counts as a line."""
+        if count <= 0:
+            return b""
+
+        end = self._end
+        if end > self.start and self._data[(end - 1) % self.capacity] == ord(b"\n"):
+            # the line ending at the end of the buffer shouldn't be counted twice
+            end -= 1
+
+        # find the newline before the first wanted line, searching back from the end
+        remaining = count
+        searchEnd = end
+        while True:
+            position = self._rfind(b"\n", searchEnd)
+            if position is None:
+                return self.read()
+
+            remaining -= 1
+            if remaining == 0:
+                return self.read(position + 1)
+
+            searchEnd = position
+
+    def _rfind(self, sub, end):
+        """returns the sequence number of the last sub (a single byte) before sequence number end, or None"""
+        start = self.start
+        if end <= start:
+            return None
+
+        data = self._data
+        first = start % self.capacity
+        length = end - start
+        if first + length <= self.capacity:
+            index = data.rfind(sub, first, first + length)
+            return None if index == -1 else start + (index - first)
+
+        # wrapped: search the part at the beginning of the buffer, then the part at the end
+        index = data.rfind(sub, 0, first + length - self.capacity)
+        if index != -1:
+            return start + (self.capacity - first) + index
+
+        index = data.rfind(sub, first)
+        return None if index == -1 else start + (index - first)
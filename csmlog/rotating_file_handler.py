@@ -0,0 +1,271 @@
+"""
+This file is part of csmlog. Python logger setup... the way I like it.
+MIT License (2021) - Charles Machalow
+"""
+
+import contextlib
+import locale
+import logging
+import logging.handlers
+import os
+
+from csmlog.formatter import SharedFormatCacheMixin
+
+try:
+    import fcntl
+except ImportError:
+    # not on Windows
+    fcntl = None
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 8
+DEFAULT_BACKUP_COUNT = 10
+
+
+def isMultiProcessRotationSupported():
+    """returns True if MultiProcessRotatingFileHandler can be used here (it needs POSIX file locks)"""
+    return fcntl is not None
+
+
+class _RotationTrackingMixin(object):
+    """
+    Keeps count of rotations so work done on backups later (like compressing them on another thread)
+        knows how many slots the backup has moved since
+    """
+
+    _rotationCount = 0
+
+    @contextlib.contextmanager
+    def rotationLock(self):
+        """held while files are being rotated"""
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def getRotationCount(self):
+        return self._rotationCount
+
+    def incrementRotationCount(self):
+        """called during a rotation (with the rotation lock held). Returns the new count"""
+        self._rotationCount += 1
+        return self._rotationCount
+
+
+class RotatingFileHandlerThatWillKeepWorkingOnPermissionErrorDuringRotate(
+    SharedFormatCacheMixin,
+    _RotationTrackingMixin,
+    logging.handlers.RotatingFileHandler,
+):
+    """
+    This class is special, it exists because on Windows, file names can't be changed while files are open.
+        So ultimately we can't rotate if 2 processes are writing to a given log file.
+        The default RotatingFileHandler will just throw the PermissionError and stop writing
+                (since it closed the stream already)
+        By throwing away the PermissionError (since logging it on every log statement would be too much),
+            and using the delay=True parameter to RotatingFileHandler, we will just continue writing to the
+            original file without rotating, via reopening the original file. If the other process closes the file,
+            it will rotate on the next log statement
+
+    For multiple processes writing to one log file on POSIX, see MultiProcessRotatingFileHandler.
+    """
+
+    def rotate(self, source, dest):
+        try:
+            logging.handlers.RotatingFileHandler.rotate(self, source, dest)
+        except PermissionError:
+            pass
+
+
+class MultiProcessRotatingFileHandler(
+    SharedFormatCacheMixin,
+    _RotationTrackingMixin,
+    logging.handlers.RotatingFileHandler,
+):
+    """
+    A RotatingFileHandler that is safe to use from multiple processes writing to the same log file (POSIX only).
+        Each record is written with a single write() to a file opened with O_APPEND, so lines from different
+        processes never tear/overwrite each other.
+        Nothing is written to a file that is already at maxBytes. Instead, an advisory lock on a sidecar .lock file
+        is taken and the file is only rotated if it is still the file at baseFilename (otherwise another process
+        rotated it already and we just reopen baseFilename).
+    """
+
+    def __init__(
+        self,
+        filename,
+        maxBytes=DEFAULT_MAX_BYTES,
+        backupCount=DEFAULT_BACKUP_COUNT,
+        encoding=None,
+        delay=True,
+    ):
+        if fcntl is None:
+            raise NotImplementedError(
+                "MultiProcessRotatingFileHandler is only supported on POSIX systems"
+            )
+
+        self._fd = None
+        self._lockFd = None
+        logging.handlers.RotatingFileHandler.__init__(
+            self,
+            filename,
+            maxBytes=maxBytes,
+            backupCount=backupCount,
+            encoding=encoding,
+            delay=True,
+        )
+        self.lockFilename = self.baseFilename + ".lock"
+
+        # we write bytes ourselves, so use what open() would have used for the text stream
+        self._byteEncoding = self.encoding
+        if self._byteEncoding in (None, "locale"):
+            self._byteEncoding = locale.getpreferredencoding(False)
+
+        if not delay:
+            self._openFd()
+
+    def __repr__(self):
+        return "<MultiProcessRotatingFileHandler %s>" % self.baseFilename
+
+    def _openFd(self):
+        if self._lockFd is None:
+            self._lockFd = os.open(self.lockFilename, os.O_RDWR | os.O_CREAT, 0o644)
+
+        self._fd = os.open(
+            self.baseFilename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+        )
+
+    def _closeFd(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _write(self, data):
+        view = memoryview(data)
+        while view:
+            written = os.write(self._fd, view)
+            view = view[written:]
+
+    def _writeUnlessFull(self, data):
+        """
+        Writes data unless the file is already at maxBytes (in which case it is full or was rotated by
+            another process). Returns True if written.
+        """
+        if self.maxBytes <= 0 or self.backupCount <= 0:
+            self._write(data)
+            return True
+
+        # if something processes rotated files (see RotatedBackupWorker), it takes an exclusive lock on the
+        #   rotated file to wait for any write that started before the file was rotated.
+        lockWrite = self.rotator is not None
+        if lockWrite:
+            fcntl.flock(self._fd, fcntl.LOCK_SH)
+        try:
+            if os.fstat(self._fd).st_size >= self.maxBytes:
+                return False
+
+            self._write(data)
+            return True
+        finally:
+            if lockWrite:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def emit(self, record):
+        try:
+            data = self.formatBytes(record, self.terminator, self._byteEncoding)
+
+            if self._fd is None:
+                self._openFd()
+
+            while not self._writeUnlessFull(data):
+                self.doRollover()
+        except Exception:
+            self.handleError(record)
+
+    @contextlib.contextmanager
+    def rotationLock(self):
+        """held while files are being rotated by any process"""
+        self.acquire()
+        try:
+            # after close() (with backups still being worked on), the lock file is only opened while it is needed
+            temporaryLockFd = self._lockFd is None
+            if temporaryLockFd:
+                self._lockFd = os.open(self.lockFilename, os.O_RDWR | os.O_CREAT, 0o644)
+
+            try:
+                fcntl.flock(self._lockFd, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(self._lockFd, fcntl.LOCK_UN)
+            finally:
+                if temporaryLockFd:
+                    os.close(self._lockFd)
+                    self._lockFd = None
+        finally:
+            self.release()
+
+    def getRotationCount(self):
+        """the rotation count is shared between processes via the lock file (the rotation lock must be held)"""
+        data = os.pread(self._lockFd, 32, 0)
+        return int(data) if data else 0
+
+    def incrementRotationCount(self):
+        rotationCount = self.getRotationCount() + 1
+        os.pwrite(self._lockFd, b"%-31d\n" % rotationCount, 0)
+        return rotationCount
+
+    def doRollover(self):
+        if self._fd is None:
+            # not written to yet (or closed)... the file at baseFilename is the one to check
+            self._openFd()
+
+        fcntl.flock(self._lockFd, fcntl.LOCK_EX)
+        try:
+            try:
+                pathStat = os.stat(self.baseFilename)
+            except FileNotFoundError:
+                pathStat = None
+
+            ourStat = os.fstat(self._fd)
+            self._closeFd()
+
+            # if the file at baseFilename isn't ours anymore, another process already rotated it
+            if (
+                self.backupCount > 0
+                and pathStat is not None
+                and os.path.samestat(pathStat, ourStat)
+                and pathStat.st_size >= self.maxBytes
+            ):
+                self._rotateBackups()
+
+            self._openFd()
+        finally:
+            fcntl.flock(self._lockFd, fcntl.LOCK_UN)
+
+    def _rotateBackups(self):
+        """same as what RotatingFileHandler.doRollover() does to the files (the lock must be held)"""
+        for i in range(self.backupCount - 1, 0, -1):
+            sfn = self.rotation_filename("%s.%d" % (self.baseFilename, i))
+            dfn = self.rotation_filename("%s.%d" % (self.baseFilename, i + 1))
+            if os.path.exists(sfn):
+                if os.path.exists(dfn):
+                    os.remove(dfn)
+                os.rename(sfn, dfn)
+
+        dfn = self.rotation_filename(self.baseFilename + ".1")
+        if os.path.exists(dfn):
+            os.remove(dfn)
+        self.rotate(self.baseFilename, dfn)
+
+    def close(self):
+        self.acquire()
+        try:
+            self._closeFd()
+            if self._lockFd is not None:
+                os.close(self._lockFd)
+                self._lockFd = None
+        finally:
+            self.release()
+
+        logging.handlers.RotatingFileHandler.close(self)
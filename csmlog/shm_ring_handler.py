@@ -0,0 +1,275 @@
+"""
+This file is part of csmlog. Python logger setup... the way I like it.
+MIT License (2021) - Charles Machalow
+"""
+
+import glob
+import logging
+import mmap
+import os
+import re
+import struct
+import tempfile
+import zlib
+
+from csmlog.after_fork import registerAfterForkInChild
+from csmlog.backup_worker import _isProcessRunning
+from csmlog.formatter import SharedFormatCacheMixin
+
+# how many bytes of logs a ring holds (the oldest ones are overwritten after that)
+DEFAULT_SHM_RING_SIZE = 4 * 1024 * 1024
+
+SHM_RING_EXTENSION = ".ring"
+
+# rings are put here if it exists (memory backed on Linux), otherwise in the temp directory
+SHM_DIRECTORY = "/dev/shm"
+
+# the file starts with a header (a cache line), then the ring of data:
+#   magic, capacity of the ring, reserved end, committed end
+# Ends are sequence numbers (counts of every byte ever written). The writer moves the reserved end forward before
+#   overwriting anything, and the committed end once the data is in place. So a reader knows which bytes are
+#   complete (before the committed end) and which may have been overwritten while it was copying them (before the
+#   reserved end - capacity).
+# Each write is a frame: a marker, the crc32 of the data, the sequence number of the frame's first byte, and the
+#   length of the data that follows. There are no memory barriers, so a CPU that reorders memory accesses (like
+#   ARM) may let a reader see the committed end move before the bytes written ahead of it. The reader checks each
+#   frame's sequence number and crc32, and reads a frame that doesn't match again later.
+SHM_RING_MAGIC = b"csmlrng2"
+_HEADER = struct.Struct("<8sQ")
+_END = struct.Struct("<Q")
+_packEnd = _END.pack_into
+_RESERVED_END_OFFSET = 16
+_COMMITTED_END_OFFSET = 24
+SHM_RING_HEADER_SIZE = 64
+
+_FRAME_MARKER = b"\xffCSM"
+_FRAME_HEADER = struct.Struct("<4sIQI")
+_packFrameHeader = _FRAME_HEADER.pack
+SHM_RING_FRAME_HEADER_SIZE = _FRAME_HEADER.size
+
+
+# the process id in an app's ring file name (see getShmRingPath())
+_APP_RING_PID_REGEX = re.compile(r"\.(\d+)%s$" % re.escape(SHM_RING_EXTENSION))
+
+
+def _getAppRingPrefix(appName):
+    directory = SHM_DIRECTORY if os.path.isdir(SHM_DIRECTORY) else tempfile.gettempdir()
+    name = re.sub(r"[^\w.-]", "_", appName)
+    return os.path.join(directory, "csmlog-%s" % name)
+
+
+def getShmRingPath(appName, pid=None):
+    """
+    returns the path of the ring file that live logs for the given app are written to (with shmRingLogging) by
+        the process with the given pid (this process by default). Each process of an app has its own ring.
+    """
+    if pid is None:
+        pid = os.getpid()
+    return "%s.%d%s" % (_getAppRingPrefix(appName), pid, SHM_RING_EXTENSION)
+
+
+def getShmRingPaths(appName):
+    """returns the paths of the app's ring files (from every process that wrote one and didn't clean it up)"""
+    prefix = _getAppRingPrefix(appName)
+    return sorted(
+        path
+        for path in glob.glob(glob.escape(prefix) + ".*" + SHM_RING_EXTENSION)
+        if _APP_RING_PID_REGEX.fullmatch(path[len(prefix) :])
+    )
+
+
+def _removeStaleRings(appName):
+    """removes the app's ring files left behind by processes that are gone (they'd take up memory forever)"""
+    for path in getShmRingPaths(appName):
+        pid = int(_APP_RING_PID_REGEX.search(path).group(1))
+        if not _isProcessRunning(pid):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class ShmRing(object):
+    """
+    A RingBuffer (see csmlog.ring_buffer) kept in a memory mapped file, so other processes can read it while it is
+        written. Writing is a copy into memory: no system calls and no waiting for readers.
+
+    Only one ShmRing (in one process) should write to a file at a time. An existing ring file with the same
+        capacity is written to where it left off, otherwise it is (atomically) replaced by a new one.
+    """
+
+    def __init__(self, path, capacity=DEFAULT_SHM_RING_SIZE):
+        if capacity <= SHM_RING_FRAME_HEADER_SIZE:
+            raise ValueError(
+                "capacity must be more than %d bytes (a frame header), not %s"
+                % (SHM_RING_FRAME_HEADER_SIZE, capacity)
+            )
+
+        self.path = path
+        self.capacity = capacity
+
+        self._file = self._openExisting()
+        if self._file is None:
+            self._file = self._create()
+
+        self._mmapSize = SHM_RING_HEADER_SIZE + capacity
+        self._mmap = mmap.mmap(self._file.fileno(), self._mmapSize)
+
+        # a write that was interrupted (by a crash) is given up on
+        self._end = _END.unpack_from(self._mmap, _COMMITTED_END_OFFSET)[0]
+        _packEnd(self._mmap, _RESERVED_END_OFFSET, self._end)
+
+    def __repr__(self):
+        return "<ShmRing %s (%d bytes)>" % (self.path, self.capacity)
+
+    @property
+    def end(self):
+        """sequence number of the next byte to be written (the total number of bytes ever written)"""
+        return self._end
+
+    def _openExisting(self):
+        try:
+            f = open(self.path, "r+b")
+        except FileNotFoundError:
+            return None
+
+        try:
+            magic, capacity = _HEADER.unpack(f.read(_HEADER.size))
+            if (
+                magic == SHM_RING_MAGIC
+                and capacity == self.capacity
+                and os.fstat(f.fileno()).st_size == SHM_RING_HEADER_SIZE + capacity
+            ):
+                return f
+        except struct.error:
+            pass
+
+        f.close()
+        return None
+
+    def _create(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+
+        # readers never see a partially setup file
+        fd, tempPath = tempfile.mkstemp(dir=directory, suffix=SHM_RING_EXTENSION)
+        try:
+            f = os.fdopen(fd, "r+b")
+            try:
+                f.truncate(SHM_RING_HEADER_SIZE + self.capacity)
+                f.write(_HEADER.pack(SHM_RING_MAGIC, self.capacity))
+                f.flush()
+                os.replace(tempPath, self.path)
+            except BaseException:
+                f.close()
+                raise
+        except BaseException:
+            os.unlink(tempPath)
+            raise
+
+        return f
+
+    def write(self, data):
+        """writes data as one frame. If it doesn't fit in the ring, only its tail is kept."""
+        dataLen = len(data)
+        maxDataLen = self.capacity - SHM_RING_FRAME_HEADER_SIZE
+        if dataLen > maxDataLen:
+            data = memoryview(data)[dataLen - maxDataLen :]
+            dataLen = maxDataLen
+
+        end = self._end
+        newEnd = end + SHM_RING_FRAME_HEADER_SIZE + dataLen
+        _packEnd(self._mmap, _RESERVED_END_OFFSET, newEnd)
+
+        self._copyIn(
+            end, _packFrameHeader(_FRAME_MARKER, zlib.crc32(data), end, dataLen)
+        )
+        self._copyIn(end + SHM_RING_FRAME_HEADER_SIZE, data)
+
+        _packEnd(self._mmap, _COMMITTED_END_OFFSET, newEnd)
+        self._end = newEnd
+
+    def _copyIn(self, start, data):
+        """copies data into the ring at sequence number start"""
+        dataLen = len(data)
+        position = SHM_RING_HEADER_SIZE + start % self.capacity
+        if position + dataLen <= self._mmapSize:
+            self._mmap[position : position + dataLen] = data
+        else:
+            # wraps around the end of the ring
+            data = memoryview(data)
+            firstLen = self._mmapSize - position
+            self._mmap[position:] = data[:firstLen]
+            self._mmap[
+                SHM_RING_HEADER_SIZE : SHM_RING_HEADER_SIZE + dataLen - firstLen
+            ] = data[firstLen:]
+
+    def close(self):
+        """closes the ring. The file is left for readers (and the next writer) to use."""
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap = None
+
+
+class ShmRingHandler(SharedFormatCacheMixin, logging.Handler):
+    """
+    handler to write live logs as text into a ShmRing (by default under /dev/shm, see getShmRingPath()).
+        Run csmlogshm to watch them.
+
+    Logging a record copies it into shared memory: there is no system call per record, and a reader that is
+        behind (or not running) never makes the logging thread wait. Once the ring is full, the oldest records are
+        overwritten.
+
+    Only one process should log to a ring file at a time. If appName is given (instead of a path), the ring is
+        getShmRingPath(appName), so each process (including forked children) writes its own. Rings left behind
+        by the app's processes that are gone are removed. Otherwise, give other processes their own path: a forked
+        child doesn't write to the parent's ring (its records are dropped).
+    """
+
+    def __init__(self, path=None, capacity=DEFAULT_SHM_RING_SIZE, appName=None):
+        if (path is None) == (appName is None):
+            raise ValueError("give either a path or an appName")
+
+        logging.Handler.__init__(self)
+        self.capacity = capacity
+        self.appName = appName
+        if appName is not None:
+            _removeStaleRings(appName)
+            path = getShmRingPath(appName)
+
+        self.path = path
+        self.ring = ShmRing(path, capacity)
+
+        registerAfterForkInChild(self._afterForkInChild)
+
+    def __repr__(self):
+        return "<ShmRingHandler %s>" % self.path
+
+    def _afterForkInChild(self):
+        """called in a forked child: the parent's ring is left to the parent"""
+        ring = self.ring
+        self.ring = None
+        if ring is not None:
+            ring.close()
+
+            if self.appName is not None:
+                self.path = getShmRingPath(self.appName)
+                self.ring = ShmRing(self.path, self.capacity)
+
+    def emit(self, record):
+        ring = self.ring
+        if ring is None:
+            return
+
+        try:
+            ring.write(self.formatBytes(record, "\n", "utf-8"))
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        with self.lock:
+            if self.ring is not None:
+                self.ring.close()
+                self.ring = None
+        logging.Handler.close(self)
@@ -0,0 +1,374 @@
+"""
+This file is part of csmlog. Python logger setup... the way I like it.
+MIT License (2021) - Charles Machalow
+"""
+
+import argparse
+import mmap
+import os
+import sys
+import threading
+import zlib
+
+from csmlog.shm_ring_handler import (
+    _COMMITTED_END_OFFSET,
+    _END,
+    _FRAME_HEADER,
+    _FRAME_MARKER,
+    _HEADER,
+    _RESERVED_END_OFFSET,
+    SHM_RING_FRAME_HEADER_SIZE,
+    SHM_RING_HEADER_SIZE,
+    SHM_RING_MAGIC,
+    getShmRingPaths,
+)
+
+# how long to sleep when there is nothing new in the ring
+DEFAULT_POLL_INTERVAL = 0.01
+
+# how many reads in a row a frame that doesn't check out is read again (it may not all be visible yet) before
+#   it's skipped
+MAX_FRAME_RETRIES = 100
+
+
+class ShmRingReader(object):
+    """
+    Tails the ring file written by a ShmRingHandler. Everything written since the last look is copied out of shared
+        memory at once, so there is no system call per record (just a sleep of pollInterval when idle).
+
+    The writer never waits for the reader: if the reader falls behind by more than the ring's capacity, the
+        overwritten bytes (and what is left of a frame they cut off) are skipped and counted in lostBytes.
+
+    A frame whose sequence number or crc32 doesn't match may not be all visible to this process yet (see
+        csmlog.shm_ring_handler). Reading stops there and it is read again next time. It is skipped (and counted
+        in lostBytes) if it still doesn't match after MAX_FRAME_RETRIES reads.
+
+    By default, reading starts with what is written after the reader opens the ring. With fromStart=True it
+        starts with the oldest data still in the ring. If the writer replaces the file (like with a different
+        capacity), the new file is read from its start.
+    """
+
+    def __init__(self, path, pollInterval=DEFAULT_POLL_INTERVAL, fromStart=False):
+        self.path = path
+        self.pollInterval = pollInterval
+        self.fromStart = fromStart
+
+        # sequence number of the next byte to read
+        self.position = None
+        self.capacity = None
+        self.lostBytes = 0
+
+        self._frameRetries = 0
+        self._file = None
+        self._mmap = None
+        self._fileId = None
+        self.__stop = threading.Event()
+
+    def __repr__(self):
+        return "<ShmRingReader %s>" % self.path
+
+    def requestStop(self):
+        self.__stop.set()
+
+    def shouldStop(self):
+        return self.__stop.is_set()
+
+    def _getFileId(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_dev, stat.st_ino)
+
+    def open(self):
+        """opens the ring file. Returns False if there isn't a ring file at path yet."""
+        self.close()
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return False
+
+        try:
+            magic, capacity = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != SHM_RING_MAGIC:
+                raise ValueError("%s isn't a csmlog ring file" % self.path)
+
+            self._mmap = mmap.mmap(
+                f.fileno(), SHM_RING_HEADER_SIZE + capacity, access=mmap.ACCESS_READ
+            )
+        except BaseException:
+            f.close()
+            raise
+
+        stat = os.fstat(f.fileno())
+        self._fileId = (stat.st_dev, stat.st_ino)
+        self._file = f
+        self.capacity = capacity
+        self._frameRetries = 0
+
+        if self.position is not None or self.fromStart:
+            # reopened after the writer replaced the file, or asked to read everything
+            self.position = 0
+        else:
+            self.position = self._getEnd(_COMMITTED_END_OFFSET)
+
+        return True
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap = None
+            self._file = None
+
+    def _getEnd(self, offset):
+        return _END.unpack_from(self._mmap, offset)[0]
+
+    def _copy(self, start, end):
+        """returns a copy of the bytes from sequence number start to end"""
+        first = SHM_RING_HEADER_SIZE + start % self.capacity
+        last = SHM_RING_HEADER_SIZE + end % self.capacity
+        if first < last or start == end:
+            return self._mmap[first:last]
+
+        # wraps around the end of the ring
+        return self._mmap[first:] + self._mmap[SHM_RING_HEADER_SIZE:last]
+
+    def _getFrameLength(self, data, start, offset):
+        """
+        returns the length of the data in the frame at offset in data (copied from sequence number start on), or
+            None if there isn't a whole frame that checks out there
+        """
+        dataStart = offset + SHM_RING_FRAME_HEADER_SIZE
+        if dataStart > len(data):
+            return None
+
+        marker, crc, sequence, length = _FRAME_HEADER.unpack_from(data, offset)
+        if (
+            marker != _FRAME_MARKER
+            or sequence != start + offset
+            or dataStart + length > len(data)
+            or zlib.crc32(memoryview(data)[dataStart : dataStart + length]) != crc
+        ):
+            return None
+        return length
+
+    def _findFrame(self, data, start, offset):
+        """returns the offset of the first frame that checks out in data from offset on (or len(data))"""
+        while True:
+            offset = data.find(_FRAME_MARKER, offset)
+            if offset == -1:
+                return len(data)
+            if self._getFrameLength(data, start, offset) is not None:
+                return offset
+            offset += 1
+
+    def read(self):
+        """returns the bytes written since the last read (b'' if there is nothing new or no ring file yet)"""
+        if self._mmap is None and not self.open():
+            return b""
+
+        committed = self._getEnd(_COMMITTED_END_OFFSET)
+        if committed < self.position:
+            # a new ring where the old one was
+            self.position = 0
+
+        start = max(self.position, committed - self.capacity)
+        if start >= committed:
+            return b""
+
+        data = self._copy(start, committed)
+
+        # anything the writer may have started overwriting while it was being copied can't be trusted
+        overwritten = self._getEnd(_RESERVED_END_OFFSET) - self.capacity
+        if overwritten > start:
+            data = data[min(overwritten, committed) - start :]
+            start = min(overwritten, committed)
+
+        lost = start - self.position
+        offset = 0
+        if lost > 0:
+            # what may be left of a cut off frame
+            offset = self._findFrame(data, start, 0)
+            lost += offset
+
+        view = memoryview(data)
+        records = []
+        while offset < len(data):
+            length = self._getFrameLength(data, start, offset)
+            if length is None:
+                self._frameRetries += 1
+                if self._frameRetries <= MAX_FRAME_RETRIES:
+                    break
+
+                # it isn't going to check out
+                self._frameRetries = 0
+                nextOffset = self._findFrame(data, start, offset + 1)
+                lost += nextOffset - offset
+                offset = nextOffset
+                continue
+
+            self._frameRetries = 0
+            dataStart = offset + SHM_RING_FRAME_HEADER_SIZE
+            records.append(view[dataStart : dataStart + length])
+            offset = dataStart + length
+
+        self.position = start + offset
+        self.lostBytes += lost
+        return b"".join(records)
+
+    def _writeOutput(self, data):
+        """prints a batch of bytes read from the ring"""
+        sys.stdout.write(data.decode(errors="replace"))
+        sys.stdout.flush()
+
+    def isGone(self):
+        """returns True if the ring file that is open was replaced or removed (by the writer)"""
+        return self._mmap is not None and self._getFileId() != self._fileId
+
+    def poll(self):
+        """
+        like read(), but if the writer replaced the file: returns what was left in the old one and switches to
+            the new one (on the next call)
+        """
+        data = self.read()
+        if not data and self.isGone():
+            data = self.read()
+            self.close()
+        return data
+
+    def readForever(self):
+        try:
+            while not self.shouldStop():
+                data = self.poll()
+                if data:
+                    self._writeOutput(data)
+                    continue
+
+                self.__stop.wait(self.pollInterval)
+        finally:
+            self.close()
+
+
+class ShmRingAppReader(object):
+    """
+    Tails all of an app's rings (each of its processes writes its own, see getShmRingPath()) with a
+        ShmRingReader each. Rings of processes that start later are read from their start, and a ring is let go
+        once it's removed.
+    """
+
+    def __init__(self, appName, pollInterval=DEFAULT_POLL_INTERVAL, fromStart=False):
+        self.appName = appName
+        self.pollInterval = pollInterval
+        self.fromStart = fromStart
+
+        # path -> ShmRingReader
+        self.readers = {}
+        self._found = False
+        self.__stop = threading.Event()
+
+    def __repr__(self):
+        return "<ShmRingAppReader %s>" % self.appName
+
+    @property
+    def lostBytes(self):
+        return sum(reader.lostBytes for reader in self.readers.values())
+
+    def requestStop(self):
+        self.__stop.set()
+
+    def shouldStop(self):
+        return self.__stop.is_set()
+
+    def _findRings(self):
+        for path in getShmRingPaths(self.appName):
+            if path not in self.readers:
+                reader = ShmRingReader(
+                    path, self.pollInterval, self.fromStart or self._found
+                )
+                if reader.open():
+                    self.readers[path] = reader
+        self._found = True
+
+    def read(self):
+        """returns the bytes written (to any of the rings) since the last read"""
+        self._findRings()
+
+        data = []
+        for path, reader in list(self.readers.items()):
+            data.append(reader.poll())
+            if reader._mmap is None:
+                # removed (a replaced file is found again by its path)
+                del self.readers[path]
+        return b"".join(data)
+
+    def _writeOutput(self, data):
+        """prints a batch of bytes read from the rings"""
+        sys.stdout.write(data.decode(errors="replace"))
+        sys.stdout.flush()
+
+    def readForever(self):
+        try:
+            while not self.shouldStop():
+                data = self.read()
+                if data:
+                    self._writeOutput(data)
+                    continue
+
+                self.__stop.wait(self.pollInterval)
+        finally:
+            self.close()
+
+    def close(self):
+        for reader in self.readers.values():
+            reader.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Prints live logs written by csmlog's ShmRingHandler"
+    )
+    parser.add_argument(
+        "app_name",
+        nargs="?",
+        default=None,
+        help="read the rings of this app's processes (like setup(appName, shmRingLogging=True) writes to)",
+    )
+    parser.add_argument("--path", default=None, help="read the ring file at this path")
+    parser.add_argument(
+        "--from-start",
+        action="store_true",
+        help="start with the oldest logs still in the ring instead of new ones",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=DEFAULT_POLL_INTERVAL,
+        help="seconds to sleep when there is nothing new",
+    )
+    args = parser.parse_args()
+
+    if bool(args.app_name) == bool(args.path):
+        parser.error("give either an app name or --path")
+
+    if args.path:
+        r = ShmRingReader(
+            args.path, pollInterval=args.poll_interval, fromStart=args.from_start
+        )
+    else:
+        r = ShmRingAppReader(
+            args.app_name, pollInterval=args.poll_interval, fromStart=args.from_start
+        )
+    try:
+        r.readForever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if r.lostBytes:
+            sys.stderr.write(
+                "%d bytes were overwritten before they could be read\n" % r.lostBytes
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,52 +1,338 @@
-"""
-This file is part of csmlog. Python logger setup... the way I like it.
-MIT License (2019) - Charles Machalow
-"""
-
-import subprocess
-import threading
-import time
-
-
-class LoggedSystemCall(object):
-    """helpful to do a system call and log the output"""
-
-    def __init__(self, logger):
-        self.logger = logger
-
-    def _logIo(self, process):
-        """sends output to the logger (one line at a time) and returns the output"""
-        savedOutput = ""
-        while True:
-            output = process.stdout.readline().decode()
-            if output:
-                savedOutput += output
-                self.logger.debug("<CMD OUTPUT>: %s" % output.rstrip("\n"))
-            else:
-                break
-        return savedOutput
-
-    def check_output(self, cmd, shell=False):
-        """similiar to subprocess.check_output but sends all output to the logger"""
-        self.logger.debug("About to call: %s" % cmd)
-        process = subprocess.Popen(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=shell
-        )
-        output = ""
-        while process.poll() is None:
-            output += self._logIo(process)
-            time.sleep(0.00001)  # yield a bit
-
-        self.logger.debug(".. Exit Code: %d" % process.returncode)
-
-        if process.returncode != 0:
-            raise subprocess.CalledProcessError(process.returncode, cmd, output)
-        return output
-
-    def call(self, cmd, shell=False):
-        """similiar to subprocess.call but sends all output to the logger"""
-        try:
-            self.check_output(cmd, shell=shell)
-            return 0
-        except subprocess.CalledProcessError as ex:
-            return ex.returncode
+"""
+This file is part of csmlog. Python logger setup... the way I like it.
+MIT License (2019) - Charles Machalow
+"""
+
+import functools
+import logging
+import os
+import selectors
+import subprocess
+import threading
+
+# how much is read from the pipe at a time (at most)
+DEFAULT_READ_CHUNK_SIZE = 64 * 1024
+
+# a line longer than this (without a newline) is logged in pieces instead of kept in memory until it ends
+MAX_LOGGED_LINE_SIZE = 1024 * 1024
+
+# stderr lines are logged at this level (by run()) unless told otherwise
+DEFAULT_STDERR_LEVEL = logging.WARNING
+
+# pipes can be waited on with selectors everywhere but Windows
+_PIPES_SELECTABLE = os.name != "nt"
+
+
+class _LineLogger(object):
+    """splits chunks of output into lines and logs each with the given prefix"""
+
+    def __init__(self, log, prefix):
+        self.log = log
+        self.prefix = prefix + ": %s"
+
+        # the end of the last chunk, if it didn't end with a newline
+        self._partial = []
+        self._partialSize = 0
+
+    def feed(self, chunk):
+        lines = chunk.split(b"\n")
+        if len(lines) > 1:
+            self._partial.append(lines[0])
+            lines[0] = b"".join(self._partial)
+            self._partial = []
+            self._partialSize = 0
+
+            log = self.log
+            prefix = self.prefix
+            for i in range(len(lines) - 1):
+                log(prefix, lines[i].decode(errors="replace"))
+
+        if lines[-1]:
+            self._partial.append(lines[-1])
+            self._partialSize += len(lines[-1])
+            if self._partialSize > MAX_LOGGED_LINE_SIZE:
+                self.finish()
+
+    def finish(self):
+        """logs what is left of a line without a newline at the end"""
+        if self._partial:
+            line = b"".join(self._partial)
+            self._partial = []
+            self._partialSize = 0
+            self.log(self.prefix, line.decode(errors="replace"))
+
+
+class _OutputCapture(object):
+    """keeps (if keepOutput) and logs a line at a time (if the logger would log it) what is read from a stream"""
+
+    def __init__(self, logger, level, prefix, keepOutput):
+        self.chunks = [] if keepOutput else None
+
+        # output isn't split into lines if they wouldn't be logged anyways
+        self.lineLogger = None
+        if logger.isEnabledFor(level):
+            self.lineLogger = _LineLogger(functools.partial(logger.log, level), prefix)
+
+    def feed(self, chunk):
+        if self.chunks is not None:
+            self.chunks.append(chunk)
+        if self.lineLogger is not None:
+            self.lineLogger.feed(chunk)
+
+    def finish(self):
+        """returns the output (as bytes) if it was kept, otherwise None"""
+        if self.lineLogger is not None:
+            self.lineLogger.finish()
+        return b"".join(self.chunks) if self.chunks is not None else None
+
+
+class LoggedSystemCall(object):
+    """helpful to do a system call and log the output"""
+
+    def __init__(self, logger, readChunkSize=DEFAULT_READ_CHUNK_SIZE):
+        self.logger = logger
+        self.readChunkSize = readChunkSize
+
+    def _readAll(self, stream, capture):
+        """gives what is read from the stream to the capture until the stream ends"""
+        read1 = stream.read1
+        chunkSize = self.readChunkSize
+
+        # blocks until there is something to read, and returns whatever there is (up to chunkSize)
+        chunk = read1(chunkSize)
+        while chunk:
+            capture.feed(chunk)
+            chunk = read1(chunkSize)
+
+    def _logIo(self, stream, keepOutput=True):
+        """
+        sends output to the logger (one line at a time) until the stream ends.
+            returns the output (as bytes) if keepOutput, otherwise None
+        """
+        capture = _OutputCapture(self.logger, logging.DEBUG, "<CMD OUTPUT>", keepOutput)
+        self._readAll(stream, capture)
+        return capture.finish()
+
+    def _logPipes(self, process, stdoutCapture, stderrCapture):
+        """
+        gives what the process writes to stdout and stderr to the captures, whichever has something, until both
+            end. Neither pipe is left to fill up (which would block the process).
+        """
+        if not _PIPES_SELECTABLE:
+            thread = threading.Thread(
+                target=self._readAll, args=(process.stderr, stderrCapture), daemon=True
+            )
+            thread.start()
+            self._readAll(process.stdout, stdoutCapture)
+            thread.join()
+            return
+
+        chunkSize = self.readChunkSize
+        with selectors.DefaultSelector() as selector:
+            selector.register(process.stdout, selectors.EVENT_READ, stdoutCapture)
+            selector.register(process.stderr, selectors.EVENT_READ, stderrCapture)
+            while selector.get_map():
+                for key, events in selector.select():
+                    # only what is already there is read, so this doesn't block
+                    chunk = os.read(key.fd, chunkSize)
+                    if chunk:
+                        key.data.feed(chunk)
+                    else:
+                        selector.unregister(key.fileobj)
+
+    def check_output(self, cmd, shell=False, keepOutput=True):
+        """
+        similiar to subprocess.check_output but sends all output to the logger.
+            If keepOutput is False, output is only sent to the logger (not kept in memory) and None is returned
+        """
+        self.logger.debug("About to call: %s" % cmd)
+        process = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=shell
+        )
+        with process:
+            output = self._logIo(process.stdout, keepOutput)
+            process.wait()
+
+        if output is not None:
+            output = output.decode(errors="replace")
+
+        self.logger.debug(".. Exit Code: %d" % process.returncode)
+
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd, output)
+        return output
+
+    def run(
+        self,
+        cmd,
+        shell=False,
+        check=False,
+        keepOutput=True,
+        stderrLevel=DEFAULT_STDERR_LEVEL,
+    ):
+        """
+        similiar to subprocess.run (capturing stdout and stderr separately) but sends all output to the logger.
+            stdout lines are logged like check_output() does, stderr lines are logged at stderrLevel as <CMD STDERR>.
+            Returns a subprocess.CompletedProcess with stdout and stderr as str (or None if not keepOutput).
+            If check is True, raises subprocess.CalledProcessError for a non-zero exit code.
+        """
+        self.logger.debug("About to call: %s" % cmd)
+        stdoutCapture = _OutputCapture(
+            self.logger, logging.DEBUG, "<CMD OUTPUT>", keepOutput
+        )
+        stderrCapture = _OutputCapture(
+            self.logger, stderrLevel, "<CMD STDERR>", keepOutput
+        )
+        process = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=shell
+        )
+        with process:
+            self._logPipes(process, stdoutCapture, stderrCapture)
+            process.wait()
+
+        stdout = stdoutCapture.finish()
+        stderr = stderrCapture.finish()
+        if stdout is not None:
+            stdout = stdout.decode(errors="replace")
+            stderr = stderr.decode(errors="replace")
+
+        self.logger.debug(".. Exit Code: %d" % process.returncode)
+
+        if check and process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd, stdout, stderr)
+        return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+
+    def call(self, cmd, shell=False):
+        """similiar to subprocess.call but sends all output to the logger"""
+        try:
+            self.check_output(cmd, shell=shell, keepOutput=False)
+            return 0
+        except subprocess.CalledProcessError as ex:
+            return ex.returncode
+
+
+class AsyncLoggedSystemCall(object):
+    """
+    like LoggedSystemCall, but each method is a coroutine (for asyncio), so many processes can run at once on one
+        event loop. Output is logged a line at a time as it arrives. (Before Python 3.12, asyncio's child watcher
+        may still use a thread per process to wait for it to exit.)
+
+    If timeout (in seconds) passes or the awaiting task is cancelled, the process is killed. A timeout raises
+        subprocess.TimeoutExpired.
+    """
+
+    def __init__(self, logger, readChunkSize=DEFAULT_READ_CHUNK_SIZE):
+        self.logger = logger
+        self.readChunkSize = readChunkSize
+
+    async def _start(self, cmd, shell, stderr):
+        # asyncio is only imported when used (it takes a while to import)
+        import asyncio
+
+        if shell:
+            return await asyncio.create_subprocess_shell(
+                cmd, stdout=subprocess.PIPE, stderr=stderr
+            )
+
+        # like subprocess.Popen, a single program can be given without a list
+        if isinstance(cmd, (str, bytes, os.PathLike)):
+            cmd = [cmd]
+        return await asyncio.create_subprocess_exec(
+            *cmd, stdout=subprocess.PIPE, stderr=stderr
+        )
+
+    async def _readAll(self, stream, capture):
+        """gives what is read from the stream to the capture until the stream ends"""
+        chunkSize = self.readChunkSize
+        chunk = await stream.read(chunkSize)
+        while chunk:
+            capture.feed(chunk)
+            chunk = await stream.read(chunkSize)
+
+    async def _communicate(self, cmd, process, timeout, stdoutCapture, stderrCapture):
+        """reads output into the captures until the process exits. Kills the process on a timeout or cancel."""
+        import asyncio
+
+        readers = [self._readAll(process.stdout, stdoutCapture)]
+        if stderrCapture is not None:
+            readers.append(self._readAll(process.stderr, stderrCapture))
+
+        try:
+            await asyncio.wait_for(asyncio.gather(*readers, process.wait()), timeout)
+        except BaseException as ex:
+            if process.returncode is None:
+                try:
+                    process.kill()
+                except ProcessLookupError:
+                    pass
+                self.logger.debug(".. Killed")
+                await process.wait()
+
+            if isinstance(ex, asyncio.TimeoutError):
+                stdout = stdoutCapture.finish()
+                stderr = stderrCapture.finish() if stderrCapture is not None else None
+                raise subprocess.TimeoutExpired(cmd, timeout, stdout, stderr) from None
+            raise
+
+    async def check_output(self, cmd, shell=False, keepOutput=True, timeout=None):
+        """
+        similiar to subprocess.check_output but sends all output to the logger.
+            If keepOutput is False, output is only sent to the logger (not kept in memory) and None is returned
+        """
+        self.logger.debug("About to call: %s" % cmd)
+        capture = _OutputCapture(self.logger, logging.DEBUG, "<CMD OUTPUT>", keepOutput)
+        process = await self._start(cmd, shell, subprocess.STDOUT)
+        await self._communicate(cmd, process, timeout, capture, None)
+
+        output = capture.finish()
+        if output is not None:
+            output = output.decode(errors="replace")
+
+        self.logger.debug(".. Exit Code: %d" % process.returncode)
+
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd, output)
+        return output
+
+    async def run(
+        self,
+        cmd,
+        shell=False,
+        check=False,
+        keepOutput=True,
+        stderrLevel=DEFAULT_STDERR_LEVEL,
+        timeout=None,
+    ):
+        """
+        similiar to subprocess.run (capturing stdout and stderr separately) but sends all output to the logger.
+            See LoggedSystemCall.run()
+        """
+        self.logger.debug("About to call: %s" % cmd)
+        stdoutCapture = _OutputCapture(
+            self.logger, logging.DEBUG, "<CMD OUTPUT>", keepOutput
+        )
+        stderrCapture = _OutputCapture(
+            self.logger, stderrLevel, "<CMD STDERR>", keepOutput
+        )
+        process = await self._start(cmd, shell, subprocess.PIPE)
+        await self._communicate(cmd, process, timeout, stdoutCapture, stderrCapture)
+
+        stdout = stdoutCapture.finish()
+        stderr = stderrCapture.finish()
+        if stdout is not None:
+            stdout = stdout.decode(errors="replace")
+            stderr = stderr.decode(errors="replace")
+
+        self.logger.debug(".. Exit Code: %d" % process.returncode)
+
+        if check and process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd, stdout, stderr)
+        return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+
+    async def call(self, cmd, shell=False, timeout=None):
+        """similiar to subprocess.call but sends all output to the logger"""
+        try:
+            await self.check_output(cmd, shell=shell, keepOutput=False, timeout=timeout)
+            return 0
+        except subprocess.CalledProcessError as ex:
+            return ex.returncode
@@ -0,0 +1,481 @@
+"""
+This file is part of csmlog. Python logger setup... the way I like it.
+MIT License (2021) - Charles Machalow
+"""
+
+import collections
+import logging
+import socket
+import struct
+import threading
+import time
+
+from csmlog.after_fork import registerAfterForkInChild
+from csmlog.formatter import SharedFormatCacheMixin
+from csmlog.udp_framing import newSenderId
+
+# a connection starts with a hello from the handler: magic, version, sender id. The receiver answers with an ack.
+TCP_HELLO_MAGIC = b"CSMT"
+TCP_VERSION = 1
+TCP_HELLO = struct.Struct("<4sBQ")
+
+# then the handler sends frames: a header (payload length, sequence number) then the payload (records)
+TCP_FRAME_HEADER = struct.Struct("<IQ")
+
+# and the receiver answers with acks: the sequence number of the last frame it has (and every frame before it)
+TCP_ACK = struct.Struct("<Q")
+
+# a frame bigger than this is a protocol error
+MAX_TCP_FRAME_SIZE = 64 * 1024 * 1024
+
+# records are packed into frames of up to this many bytes (a bigger record gets a frame of its own)
+DEFAULT_MAX_FRAME_BYTES = 64 * 1024
+
+# bytes of records that can wait to be sent or acked before logging waits (see blockSeconds)
+DEFAULT_MAX_BUFFER_BYTES = 16 * 1024 * 1024
+
+# how long logging waits for room in a full buffer before dropping the record
+DEFAULT_BLOCK_SECONDS = 1.0
+
+# wait between failed connection attempts, doubling each time up to the max
+DEFAULT_INITIAL_BACKOFF_SECONDS = 0.1
+DEFAULT_MAX_BACKOFF_SECONDS = 5.0
+
+DEFAULT_CONNECT_TIMEOUT_SECONDS = 5.0
+
+# how long flush() and close() (if connected) wait for everything to be acked
+DEFAULT_FLUSH_TIMEOUT_SECONDS = 5.0
+
+
+class TcpHandler(SharedFormatCacheMixin, logging.Handler):
+    """
+    handler to stream live logs over TCP to a TcpHandlerReceiver (see csmlog.tcp_handler_receiver), for logs that
+        shouldn't be lost when the receiver is down or slow.
+
+    Logging a record only adds it to a buffer. A background thread packs buffered records into frames (of up to
+        maxFrameBytes) and sends them without waiting for the receiver's acks in between. Frames are kept until
+        they are acked. If the connection drops, it reconnects (waiting initialBackoffSeconds, doubling up to
+        maxBackoffSeconds, between failed tries) and sends everything that wasn't acked again. The receiver drops
+        frames it already has, so each record is written once, unless the receiver itself restarts.
+
+    If maxBufferBytes of records are waiting to be sent or acked, logging waits for room (backpressure) for up to
+        blockSeconds, then drops the record (see droppedRecords). Once a record is dropped, later ones are dropped
+        without waiting until there is room again, so a receiver that is down doesn't slow every log call.
+        A blockSeconds of None waits as long as it takes.
+
+    flush() waits up to flushTimeout seconds for everything to be acked. So does close(), but only while connected:
+        what can't be sent to a receiver that is down is given up on right away.
+    """
+
+    def __init__(
+        self,
+        ip="127.0.0.1",
+        port=5123,
+        maxFrameBytes=DEFAULT_MAX_FRAME_BYTES,
+        maxBufferBytes=DEFAULT_MAX_BUFFER_BYTES,
+        blockSeconds=DEFAULT_BLOCK_SECONDS,
+        initialBackoffSeconds=DEFAULT_INITIAL_BACKOFF_SECONDS,
+        maxBackoffSeconds=DEFAULT_MAX_BACKOFF_SECONDS,
+        connectTimeout=DEFAULT_CONNECT_TIMEOUT_SECONDS,
+        flushTimeout=DEFAULT_FLUSH_TIMEOUT_SECONDS,
+    ):
+        logging.Handler.__init__(self)
+        self.ip = ip
+        self.port = port
+        self.maxFrameBytes = maxFrameBytes
+        self.maxBufferBytes = maxBufferBytes
+        self.blockSeconds = blockSeconds
+        self.initialBackoffSeconds = initialBackoffSeconds
+        self.maxBackoffSeconds = maxBackoffSeconds
+        self.connectTimeout = connectTimeout
+        self.flushTimeout = flushTimeout
+        self.senderId = newSenderId()
+
+        # counters: records acked by the receiver, records dropped since the buffer stayed full (or the handler was
+        #   closed before they were acked), frames sent (including resent ones), frames resent after a reconnect,
+        #   and connections made
+        self.ackedRecords = 0
+        self.droppedRecords = 0
+        self.sentFrames = 0
+        self.resentFrames = 0
+        self.connections = 0
+
+        self._condition = threading.Condition()
+
+        # encoded records that aren't in a frame yet
+        self._pending = []
+        self._pendingBytes = 0
+
+        # (sequence number, frame, record count) sent or waiting to be sent, until acked
+        self._unacked = collections.deque()
+        self._unackedBytes = 0
+
+        self._nextSequence = 1
+        self._ackedSequence = 0
+
+        # sequence number of the next frame to send on the current connection, and the highest one ever sent
+        self._sendSequence = 1
+        self._highestSentSequence = 0
+
+        self._socket = None
+        self._closed = False
+        self._thread = None
+
+        # True once a record was dropped since the buffer stayed full, until one fits again
+        self._dropping = False
+
+        # True if the last try to connect failed (the receiver is down), until a connection is made
+        self._unreachable = False
+
+        registerAfterForkInChild(self._afterForkInChild)
+
+    def __repr__(self):
+        return "<TcpHandler %s:%s>" % (self.ip, self.port)
+
+    def _afterForkInChild(self):
+        """
+        called in a forked child: it connects as a new sender on the next emit(). Anything buffered is left for the
+            parent to send (the child would send it again otherwise).
+        """
+        # the parent's threads may have been holding the condition when it forked
+        self._condition = threading.Condition()
+        self._thread = None
+
+        # the parent's connection... closing the child's copy doesn't end it for the parent
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+        self._pending = []
+        self._pendingBytes = 0
+        self._unacked = collections.deque()
+        self._unackedBytes = 0
+        self._dropping = False
+        self._unreachable = False
+
+        # the receiver would take the child's frames for ones it already has from the parent
+        self.senderId = newSenderId()
+        self._nextSequence = 1
+        self._ackedSequence = 0
+        self._sendSequence = 1
+        self._highestSentSequence = 0
+
+    def _bufferedBytes(self):
+        return self._pendingBytes + self._unackedBytes
+
+    def emit(self, record):
+        try:
+            msg = self.formatBytes(record, "\n", "utf-8")
+
+            with self._condition:
+                deadline = None
+                if self._dropping:
+                    deadline = 0
+                elif self.blockSeconds is not None:
+                    deadline = time.monotonic() + self.blockSeconds
+
+                # a record bigger than the whole buffer still goes, once everything before it is acked
+                while (
+                    not self._closed
+                    and self._bufferedBytes()
+                    and self._bufferedBytes() + len(msg) > self.maxBufferBytes
+                ):
+                    if deadline is None:
+                        self._condition.wait()
+                        continue
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+
+                if self._closed:
+                    self.droppedRecords += 1
+                    return
+
+                if (
+                    self._bufferedBytes()
+                    and self._bufferedBytes() + len(msg) > self.maxBufferBytes
+                ):
+                    self.droppedRecords += 1
+                    self._dropping = True
+                    return
+
+                self._dropping = False
+                self._pending.append(msg)
+                self._pendingBytes += len(msg)
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._writeLoop, name="csmlog-tcp-writer", daemon=True
+                    )
+                    self._thread.start()
+                elif len(self._pending) == 1:
+                    # the writer may be waiting for something to send
+                    self._condition.notify_all()
+        except Exception:
+            self.handleError(record)
+
+    def _makeFrames(self):
+        """packs the pending records into frames (the condition must be held)"""
+        frame = []
+        frameBytes = 0
+        for msg in self._pending:
+            if frame and frameBytes + len(msg) > self.maxFrameBytes:
+                self._addFrame(frame, frameBytes)
+                frame = []
+                frameBytes = 0
+            frame.append(msg)
+            frameBytes += len(msg)
+
+        if frame:
+            self._addFrame(frame, frameBytes)
+
+        self._pending = []
+        self._pendingBytes = 0
+
+    def _addFrame(self, records, size):
+        sequence = self._nextSequence
+        self._nextSequence += 1
+        header = TCP_FRAME_HEADER.pack(size, sequence)
+        self._unacked.append((sequence, b"".join([header] + records), len(records)))
+        self._unackedBytes += size
+
+    def _handleAck(self, sequence):
+        """forgets frames up to (and including) the acked sequence number (the condition must be held)"""
+        while self._unacked and self._unacked[0][0] <= sequence:
+            frameSequence, frame, recordCount = self._unacked.popleft()
+            self._unackedBytes -= len(frame) - TCP_FRAME_HEADER.size
+            self.ackedRecords += recordCount
+
+        self._ackedSequence = max(self._ackedSequence, sequence)
+        self._condition.notify_all()
+
+    def _isDelivered(self):
+        return not self._pending and not self._unacked
+
+    def _connect(self):
+        """connects and says hello. Returns the socket, or None if the receiver can't be reached."""
+        try:
+            sock = socket.create_connection(
+                (self.ip, self.port), timeout=self.connectTimeout
+            )
+        except OSError:
+            return None
+
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.sendall(TCP_HELLO.pack(TCP_HELLO_MAGIC, TCP_VERSION, self.senderId))
+            ack = _receiveExactly(sock, TCP_ACK.size)
+            sock.settimeout(None)
+        except OSError:
+            sock.close()
+            return None
+
+        if ack is None:
+            sock.close()
+            return None
+
+        with self._condition:
+            self._handleAck(TCP_ACK.unpack(ack)[0])
+
+            # everything not acked (by this or an earlier connection) is sent again
+            self._sendSequence = (
+                self._unacked[0][0] if self._unacked else self._nextSequence
+            )
+            self._socket = sock
+            self._unreachable = False
+            self.connections += 1
+
+        threading.Thread(
+            target=self._ackLoop, args=(sock,), name="csmlog-tcp-acks", daemon=True
+        ).start()
+        return sock
+
+    def _ackLoop(self, sock):
+        """reads acks from the receiver until the connection drops"""
+        data = b""
+        try:
+            while True:
+                received = sock.recv(4096)
+                if not received:
+                    break
+
+                data += received
+                count = len(data) // TCP_ACK.size
+                if count:
+                    # acks are cumulative, only the last one matters
+                    offset = (count - 1) * TCP_ACK.size
+                    sequence = TCP_ACK.unpack_from(data, offset)[0]
+                    data = data[count * TCP_ACK.size :]
+                    with self._condition:
+                        self._handleAck(sequence)
+        except OSError:
+            pass
+        finally:
+            with self._condition:
+                self._disconnect(sock)
+
+    def _disconnect(self, sock):
+        """drops the connection, if it is still the current one (the condition must be held)"""
+        if self._socket is sock:
+            self._socket = None
+            self._condition.notify_all()
+
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+
+    def _sendLoop(self, sock):
+        """sends frames as they are made, until the connection drops or everything is delivered after close()"""
+        while True:
+            with self._condition:
+                while True:
+                    if self._socket is not sock:
+                        return
+
+                    self._makeFrames()
+                    if self._unacked and self._unacked[-1][0] >= self._sendSequence:
+                        break
+
+                    if self._closed and self._isDelivered():
+                        return
+
+                    self._condition.wait()
+
+                frames = [
+                    frame
+                    for sequence, frame, recordCount in self._unacked
+                    if sequence >= self._sendSequence
+                ]
+                firstSequence = self._sendSequence
+                self._sendSequence = self._unacked[-1][0] + 1
+
+                resent = max(
+                    0,
+                    min(self._highestSentSequence, self._sendSequence - 1)
+                    - firstSequence
+                    + 1,
+                )
+                self._highestSentSequence = max(
+                    self._highestSentSequence, self._sendSequence - 1
+                )
+                self.sentFrames += len(frames)
+                self.resentFrames += resent
+
+            try:
+                sock.sendall(b"".join(frames))
+            except OSError:
+                with self._condition:
+                    self._disconnect(sock)
+                return
+
+    def _writeLoop(self):
+        backoff = self.initialBackoffSeconds
+        while True:
+            with self._condition:
+                if self._closed and self._isDelivered():
+                    break
+
+            sock = self._connect()
+            if sock is None:
+                with self._condition:
+                    self._unreachable = True
+                    self._condition.notify_all()
+
+                    # only cut short by close() giving up on what is left
+                    deadline = time.monotonic() + backoff
+                    while not (self._closed and self._isDelivered()):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._condition.wait(remaining)
+
+                backoff = min(backoff * 2, self.maxBackoffSeconds)
+                continue
+
+            backoff = self.initialBackoffSeconds
+            self._sendLoop(sock)
+
+        with self._condition:
+            if self._socket is not None:
+                self._disconnect(self._socket)
+
+    def flush(self, timeout=None):
+        """
+        waits (up to timeout, or flushTimeout, seconds) for everything logged so far to be acked by the receiver.
+            Returns True if it was.
+        """
+        if timeout is None:
+            timeout = self.flushTimeout
+
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            # only what is logged before now
+            if self._pending:
+                self._makeFrames()
+                self._condition.notify_all()
+            lastSequence = self._nextSequence - 1
+
+            while self._ackedSequence < lastSequence:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._thread is None:
+                    return False
+                self._condition.wait(remaining)
+
+            return True
+
+    def close(self):
+        with self._condition:
+            alreadyClosed = self._closed
+            self._closed = True
+            self._condition.notify_all()
+            thread = self._thread
+
+            if not alreadyClosed and thread is not None:
+                # a receiver that is down would make every exit take flushTimeout... only wait while connected
+                #   (or still trying to connect the first time)
+                deadline = time.monotonic() + self.flushTimeout
+                while not self._isDelivered() and not (
+                    self._socket is None and self._unreachable
+                ):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+
+                delivered = self._isDelivered()
+
+        if not alreadyClosed and thread is not None:
+            if delivered:
+                # on its way out
+                thread.join()
+
+            with self._condition:
+                # gives up on what wasn't delivered in time. The writer thread stops once it sees that (it may be
+                #   in the middle of trying to connect).
+                self._thread = None
+                self.droppedRecords += len(self._pending) + sum(
+                    recordCount for sequence, frame, recordCount in self._unacked
+                )
+                self._pending = []
+                self._pendingBytes = 0
+                self._unacked.clear()
+                self._unackedBytes = 0
+                if self._socket is not None:
+                    self._disconnect(self._socket)
+                self._condition.notify_all()
+
+        logging.Handler.close(self)
+
+
+def _receiveExactly(sock, size):
+    """returns size bytes from the socket, or None if it was closed first"""
+    data = b""
+    while len(data) < size:
+        received = sock.recv(size - len(data))
+        if not received:
+            return None
+        data += received
+    return data
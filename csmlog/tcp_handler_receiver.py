@@ -0,0 +1,287 @@
+"""
+This file is part of csmlog. Python logger setup... the way I like it.
+MIT License (2021) - Charles Machalow
+"""
+
+import collections
+import selectors
+import socket
+import threading
+import time
+
+from csmlog.tcp_handler import (
+    MAX_TCP_FRAME_SIZE,
+    TCP_ACK,
+    TCP_FRAME_HEADER,
+    TCP_HELLO,
+    TCP_HELLO_MAGIC,
+    TCP_VERSION,
+)
+from csmlog.udp_framing import DEFAULT_MAX_SENDERS, DEFAULT_SENDER_TIMEOUT_SECONDS
+from csmlog.udp_handler_receiver import UdpHandlerReceiver
+
+# connections that can wait to be accepted
+DEFAULT_LISTEN_BACKLOG = 1024
+
+
+class TcpProtocolError(ValueError):
+    """raised if a connection sends something that isn't from a TcpHandler"""
+
+
+class _TcpConnection(object):
+    def __init__(self, sock, address):
+        self.socket = sock
+        self.address = address
+
+        # set once the hello is received
+        self.senderId = None
+
+        # received bytes that aren't a whole frame yet, and acks that haven't been sent yet
+        self.received = bytearray()
+        self.unsent = bytearray()
+
+
+class TcpHandlerReceiver(UdpHandlerReceiver):
+    """
+    A UdpHandlerReceiver for TcpHandlers: it listens on ip:port for TCP connections instead of receiving UDP
+        datagrams. All connections are handled by one thread sleeping in select/epoll, so hundreds of producers
+        can be connected at once. (Each needs a file descriptor, see ulimit -n.)
+
+    What each connection sends is printed (or, for a subclass, written out by _writeMessages()) a batch at a time,
+        and only then acked. Frames a sender already sent (before reconnecting) are dropped, so each is written
+        once. Sender stats (see getSenderStats()) are per sender id, across its connections. Since nothing that
+        is sent is lost, there are no lostMessages or dropRate stats (what a sender drops is its droppedRecords).
+
+    A sender without a connection for senderTimeout seconds, or beyond the maxSenders that lost theirs most
+        recently, is forgotten. (If it does come back, frames it sent before may be written again.)
+    """
+
+    def __init__(
+        self,
+        ip="127.0.0.1",
+        port=5123,
+        backlog=DEFAULT_LISTEN_BACKLOG,
+        senderTimeout=DEFAULT_SENDER_TIMEOUT_SECONDS,
+        maxSenders=DEFAULT_MAX_SENDERS,
+        **kwargs
+    ):
+        UdpHandlerReceiver.__init__(self, ip=ip, port=port, **kwargs)
+        self.backlog = backlog
+        self.senderTimeout = senderTimeout
+        self.maxSenders = maxSenders
+
+        self._connections = {}
+
+        # sender id -> dict of stats
+        self._senders = {}
+        self._sendersLock = threading.Lock()
+
+        # sender id -> number of its connections that are open
+        self._senderConnections = {}
+
+        # sender id -> when it lost its last connection. In that order.
+        self._idleSenders = collections.OrderedDict()
+
+    def __repr__(self):
+        return "<TcpHandlerReceiver %s:%s>" % (self.ip, self.port)
+
+    def getSenderStats(self):
+        """returns a dict of sender id -> dict of stats for the senders that connected"""
+        with self._sendersLock:
+            return {senderId: dict(stats) for senderId, stats in self._senders.items()}
+
+    def getConnectionCount(self):
+        return len(self._connections)
+
+    def _openSocket(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.receiveBufferSize:
+            self.socket.setsockopt(
+                socket.SOL_SOCKET, socket.SO_RCVBUF, self.receiveBufferSize
+            )
+        self.socket.setblocking(False)
+        self.socket.bind((self.ip, self.port))
+        self.socket.listen(self.backlog)
+
+    def _closeSocket(self):
+        for connection in list(self._connections.values()):
+            connection.socket.close()
+        self._connections = {}
+
+        now = time.monotonic()
+        for senderId in self._senderConnections:
+            self._idleSenders[senderId] = now
+        self._senderConnections = {}
+
+        UdpHandlerReceiver._closeSocket(self)
+
+    def _onReady(self, selector, key, events, buffer):
+        if key.fileobj is self.socket:
+            self._accept(selector)
+            return
+
+        connection = key.data
+        if events & selectors.EVENT_WRITE:
+            self._sendAcks(selector, connection)
+        if events & selectors.EVENT_READ:
+            self._receive(selector, connection, buffer)
+
+    def _accept(self, selector):
+        while True:
+            try:
+                sock, address = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                # like running out of file descriptors... try again on the next wake up
+                return
+
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = _TcpConnection(sock, address)
+            self._connections[sock] = connection
+            selector.register(sock, selectors.EVENT_READ, connection)
+
+    def _dropConnection(self, selector, connection):
+        selector.unregister(connection.socket)
+        del self._connections[connection.socket]
+        connection.socket.close()
+
+        senderId = connection.senderId
+        if senderId is not None:
+            self._senderConnections[senderId] -= 1
+            if not self._senderConnections[senderId]:
+                del self._senderConnections[senderId]
+                self._idleSenders[senderId] = time.monotonic()
+                self._expireSenders()
+
+    def _expireSenders(self):
+        """forgets senders (from the one idle the longest) without a connection for too long, or too many of them"""
+        now = time.monotonic()
+        idleSenders = self._idleSenders
+        while idleSenders:
+            senderId, idleSince = next(iter(idleSenders.items()))
+            if (
+                len(idleSenders) <= self.maxSenders
+                and now - idleSince < self.senderTimeout
+            ):
+                break
+
+            del idleSenders[senderId]
+            with self._sendersLock:
+                del self._senders[senderId]
+
+    def _receive(self, selector, connection, buffer):
+        try:
+            size = connection.socket.recv_into(buffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            size = 0
+
+        if not size:
+            self._dropConnection(selector, connection)
+            return
+
+        connection.received += buffer[:size]
+        try:
+            messages, ack = self._parseFrames(selector, connection)
+        except TcpProtocolError:
+            self._dropConnection(selector, connection)
+            return
+
+        # written out before being acked
+        self._handleMessages(messages)
+        if ack is not None:
+            self._queueAck(selector, connection, ack)
+
+    def _parseFrames(self, selector, connection):
+        """
+        returns ([(sender id, message), ...] for the whole new frames received, the sequence number to ack or None)
+        """
+        data = connection.received
+        offset = 0
+        if connection.senderId is None:
+            if len(data) < TCP_HELLO.size:
+                return [], None
+
+            magic, version, senderId = TCP_HELLO.unpack_from(data)
+            if magic != TCP_HELLO_MAGIC or version != TCP_VERSION:
+                raise TcpProtocolError(
+                    "%s didn't start with a TcpHandler hello" % (connection.address,)
+                )
+
+            connection.senderId = senderId
+            offset = TCP_HELLO.size
+            self._senderConnections[senderId] = (
+                self._senderConnections.get(senderId, 0) + 1
+            )
+            self._idleSenders.pop(senderId, None)
+            with self._sendersLock:
+                stats = self._senders.setdefault(
+                    senderId,
+                    {
+                        "address": connection.address,
+                        "receivedMessages": 0,
+                        "duplicateMessages": 0,
+                        "connections": 0,
+                        "lastSequence": 0,
+                    },
+                )
+                stats["address"] = connection.address
+                stats["connections"] += 1
+
+            # tells the sender what it doesn't have to send again
+            self._queueAck(selector, connection, stats["lastSequence"])
+
+        senderId = connection.senderId
+        messages = []
+        ack = None
+        with self._sendersLock:
+            stats = self._senders[senderId]
+            while len(data) - offset >= TCP_FRAME_HEADER.size:
+                size, sequence = TCP_FRAME_HEADER.unpack_from(data, offset)
+                if size > MAX_TCP_FRAME_SIZE:
+                    raise TcpProtocolError(
+                        "%s sent a %d byte frame" % (connection.address, size)
+                    )
+
+                start = offset + TCP_FRAME_HEADER.size
+                if len(data) - start < size:
+                    break
+
+                if sequence > stats["lastSequence"]:
+                    messages.append((senderId, bytes(data[start : start + size])))
+                    stats["lastSequence"] = sequence
+                    stats["receivedMessages"] += 1
+                else:
+                    # sent again after a reconnect, but already received
+                    stats["duplicateMessages"] += 1
+
+                ack = stats["lastSequence"]
+                offset = start + size
+
+        del data[:offset]
+        return messages, ack
+
+    def _queueAck(self, selector, connection, sequence):
+        connection.unsent += TCP_ACK.pack(sequence)
+        self._sendAcks(selector, connection)
+
+    def _sendAcks(self, selector, connection):
+        try:
+            sent = connection.socket.send(connection.unsent)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            # gone... noticed when reading from it
+            sent = len(connection.unsent)
+        del connection.unsent[:sent]
+
+        # only wait to be able to send if the sender isn't reading its acks as fast as they come
+        events = selectors.EVENT_READ
+        if connection.unsent:
+            events |= selectors.EVENT_WRITE
+        if selector.get_key(connection.socket).events != events:
+            selector.modify(connection.socket, events, connection)
@@ -11,6 +11,7 @@ from csmlog import (
     CSMLogger,
     getCSMLogger,
     close,
+    flush,
     UdpHandlerReceiver,
     LoggedSystemCall,
     setup,
@@ -19,6 +20,30 @@ from csmlog import (
 
 APPNAME = "csmlog_test"
 
+# benchmarks (tests marked with @pytest.mark.benchmark) only run if this environment variable is set (to 1)
+BENCHMARKS_ENVIRONMENT_VARIABLE = "CSMLOG_BENCHMARKS"
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers",
+        "benchmark: times something and prints the results. Skipped unless %s=1"
+        % BENCHMARKS_ENVIRONMENT_VARIABLE,
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    if os.environ.get(BENCHMARKS_ENVIRONMENT_VARIABLE) == "1":
+        return
+
+    # timings depend on the machine (and whatever else it's doing), so they aren't part of the usual run
+    skip = pytest.mark.skip(
+        reason="benchmark (set %s=1 to run it)" % BENCHMARKS_ENVIRONMENT_VARIABLE
+    )
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
 
 @pytest.fixture(scope="function")
 def csmlog():
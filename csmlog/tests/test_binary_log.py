@@ -0,0 +1,381 @@
+import gc
+import io
+import logging
+import os
+import pathlib
+import re
+import subprocess
+import sys
+import time
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from conftest import PARENT_FOLDER, close, getCSMLogger, setup
+
+from csmlog import DEFAULT_LOG_FORMAT, CSMLogger
+from csmlog.async_handler import AsyncForwardingHandler, AsyncHandlerPipeline
+from csmlog.backup_worker import COMPRESSION_GZIP, RotatedBackupWorker
+from csmlog.binary_log import (
+    _FRAME_HEADER,
+    BINARY_LOG_EXTENSION,
+    BINARY_LOG_MAGIC,
+    BinaryLogError,
+    BinaryRotatingFileHandler,
+    decodeBinaryLogFiles,
+    decodeBinaryLogRecords,
+)
+from csmlog.formatter import FastFormatter
+from csmlog.log_splitter import getLogFileWithBackups
+
+BENCHMARK_RECORD_COUNT = 20000
+
+
+class _Unprimitive(object):
+    def __init__(self):
+        self.value = "before"
+
+    def __repr__(self):
+        return "<_Unprimitive %s>" % self.value
+
+
+def _log_everything(logger):
+    """logs a bit of everything. Returns the expected text lines (formatted right away)"""
+    stream = io.StringIO()
+    textHandler = logging.StreamHandler(stream)
+    textHandler.setFormatter(logging.Formatter(DEFAULT_LOG_FORMAT))
+    logger.addHandler(textHandler)
+
+    try:
+        logger.info("hello %s", "world")
+        logger.debug("no args, but a %% sign")
+        logger.warning("ints %d %x %s, floats %.2f %r", 5, 255, 2**70, 3.14159, 0.1)
+        logger.error("None %s, bools %s %d, bytes %r", None, True, False, b"\x00\xff")
+        logger.info("unicode ☃ %s", "☃")
+        logger.info("%(key)s from a dict", {"key": "value"})
+        logger.info(12345)
+
+        obj = _Unprimitive()
+        logger.info("rendered now: %r", obj)
+        obj.value = "after"
+
+        try:
+            raise ValueError("lolcats")
+        except ValueError:
+            logger.exception("exception %d", 1)
+
+        logger.info("stack", stack_info=True)
+        logger.log(55, "custom level")
+    finally:
+        logger.removeHandler(textHandler)
+
+    return stream.getvalue()
+
+
+@pytest.fixture
+def binary_logger(tmp_path):
+    logger = logging.getLogger("csmlog_binary_test")
+    logger.setLevel(1)
+    logger.propagate = False
+
+    handler = BinaryRotatingFileHandler(str(tmp_path / ("test" + BINARY_LOG_EXTENSION)))
+    handler.setFormatter(FastFormatter(DEFAULT_LOG_FORMAT))
+    logger.addHandler(handler)
+    try:
+        yield logger, handler
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+
+
+def test_binary_log_round_trip(binary_logger):
+    logger, handler = binary_logger
+    expected = _log_everything(logger)
+    handler.flush()
+
+    output = io.StringIO()
+    assert decodeBinaryLogFiles(handler.baseFilename, output) == 11
+    assert output.getvalue() == expected
+    assert "<_Unprimitive before>" in expected
+
+
+def test_binary_log_custom_format(binary_logger):
+    logger, handler = binary_logger
+    logger.info("hello %s", "world")
+
+    output = io.StringIO()
+    decodeBinaryLogFiles(
+        handler.baseFilename,
+        output,
+        formatter=FastFormatter("%(levelname)s %(funcName)s %(filename)s %(message)s"),
+    )
+    assert output.getvalue() == (
+        "INFO test_binary_log_custom_format test_binary_log.py hello world\n"
+    )
+
+
+def test_binary_log_appending_process_redefines_strings(tmp_path, binary_logger):
+    logger, handler = binary_logger
+    logger.info("first %s", "process")
+    handler.close()
+
+    # a new handler (like in a new process) starts its own string ids in the same file
+    logger.info("second %s", "process")
+
+    with open(handler.baseFilename, "rb") as f:
+        messages = [r.getMessage() for r in decodeBinaryLogRecords(f)]
+    assert messages == ["first process", "second process"]
+
+
+def test_binary_log_interleaved_writers(tmp_path):
+    # like two processes appending to the same file: each has its own string ids
+    path = str(tmp_path / ("test" + BINARY_LOG_EXTENSION))
+    first = BinaryRotatingFileHandler(path)
+    second = BinaryRotatingFileHandler(path)
+    assert first.encoder.session != second.encoder.session
+    try:
+        for i in range(3):
+            for handler, name in ((first, "first"), (second, "second")):
+                record = logging.LogRecord(
+                    name, logging.INFO, __file__, i, name + " %d", (i,), None
+                )
+                handler.handle(record)
+    finally:
+        first.close()
+        second.close()
+
+    with open(path, "rb") as f:
+        records = list(decodeBinaryLogRecords(f))
+    assert [(r.name, r.getMessage()) for r in records] == [
+        (name, "%s %d" % (name, i)) for i in range(3) for name in ("first", "second")
+    ]
+
+
+def test_binary_log_corrupt_file(binary_logger):
+    logger, handler = binary_logger
+    logger.info("first %s", "record")
+    logger.info("second %s", "record")
+    handler.close()
+
+    # the string frames defining what the last record uses are lost
+    data = pathlib.Path(handler.baseFilename).read_bytes()
+    offset = len(BINARY_LOG_MAGIC)
+    frames = []
+    while offset < len(data):
+        frameType, session, length = _FRAME_HEADER.unpack_from(data, offset)
+        end = offset + _FRAME_HEADER.size + length
+        frames.append(data[offset:end])
+        offset = end
+
+    with pytest.raises(BinaryLogError, match="never defined"):
+        list(decodeBinaryLogRecords(io.BytesIO(BINARY_LOG_MAGIC + frames[-1])))
+
+    corruptFile = pathlib.Path(handler.baseFilename).with_name("corrupt.clog")
+    corruptFile.write_bytes(BINARY_LOG_MAGIC + frames[-1])
+    result = subprocess.run(
+        [sys.executable, "-m", "csmlog.binary_log", str(corruptFile)],
+        cwd=PARENT_FOLDER,
+        capture_output=True,
+    )
+    assert result.returncode == 1
+    assert b"never defined" in result.stderr
+
+
+def test_binary_log_async_handlers_keep_args(tmp_path):
+    pipeline = AsyncHandlerPipeline()
+    forwarder = AsyncForwardingHandler(pipeline)
+    handler = BinaryRotatingFileHandler(str(tmp_path / ("test" + BINARY_LOG_EXTENSION)))
+    forwarder.addTarget(handler)
+
+    logger = logging.getLogger("csmlog_binary_async_test")
+    logger.setLevel(1)
+    logger.propagate = False
+    logger.addHandler(forwarder)
+    pipeline.start()
+    try:
+        logger.info("hello %s %d", "world", 5)
+
+        # may be changed by the caller before the listener thread gets to it, so it's rendered right away
+        obj = _Unprimitive()
+        logger.info("rendered now: %r", obj)
+        obj.value = "after"
+    finally:
+        pipeline.stop()
+        logger.removeHandler(forwarder)
+        handler.close()
+
+    with open(handler.baseFilename, "rb") as f:
+        records = list(decodeBinaryLogRecords(f))
+    assert (records[0].msg, records[0].args) == ("hello %s %d", ("world", 5))
+    assert records[1].getMessage() == "rendered now: <_Unprimitive before>"
+
+
+def test_binary_log_partial_frame_ignored(binary_logger):
+    logger, handler = binary_logger
+    logger.info("complete")
+    logger.info("partial")
+
+    data = pathlib.Path(handler.baseFilename).read_bytes()
+    with io.BytesIO(data[:-3]) as f:
+        assert [r.getMessage() for r in decodeBinaryLogRecords(f)] == ["complete"]
+
+    with pytest.raises(BinaryLogError):
+        list(decodeBinaryLogRecords(io.BytesIO(b"not a binary log")))
+
+
+@pytest.mark.parametrize("compression", [None, COMPRESSION_GZIP])
+def test_binary_log_rotation(tmp_path, compression):
+    logFile = str(tmp_path / ("rotate" + BINARY_LOG_EXTENSION))
+    handler = BinaryRotatingFileHandler(logFile, maxBytes=2048, backupCount=1000)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+
+    worker = None
+    if compression:
+        worker = RotatedBackupWorker(str(tmp_path), compression=compression)
+        worker.attach(handler)
+        worker.start()
+
+    logger = logging.getLogger("csmlog_binary_rotate_test")
+    logger.setLevel(1)
+    logger.propagate = False
+    logger.addHandler(handler)
+    try:
+        for i in range(500):
+            logger.info("record %d from %s", i, "x" * (i % 50))
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+        if worker:
+            worker.stop()
+
+    files = getLogFileWithBackups(logFile)
+    assert len(files) > 10
+    if compression:
+        assert all(f.endswith(".gz") for f in files[:-1])
+
+    # each file can be decoded on its own
+    for path in files:
+        count = decodeBinaryLogFiles(path, io.StringIO(), includeBackups=False)
+        assert count > 0
+
+    output = io.StringIO()
+    decodeBinaryLogFiles(logFile, output, formatter=logging.Formatter("%(message)s"))
+    assert output.getvalue().splitlines() == [
+        "record %d from %s" % (i, "x" * (i % 50)) for i in range(500)
+    ]
+
+
+def test_csmlogger_binary_log_files():
+    setup("csmlog_binary_test", clearLogs=True, binaryLogFiles=True)
+    try:
+        csmlog = getCSMLogger()
+        logger = csmlog.getLogger("child")
+        assert logger.logFile.endswith(
+            "csmlog_binary_test.child" + BINARY_LOG_EXTENSION
+        )
+
+        logger.info("hello %s", "binary")
+        csmlog.flush()
+
+        for logFile in (logger.logFile, csmlog.parentLogger.logFile):
+            output = io.StringIO()
+            decodeBinaryLogFiles(logFile, output)
+            assert re.match(
+                r"^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3} - csmlog_binary_test.child:\d+ - INFO - hello binary\n$",
+                output.getvalue().splitlines(True)[-1],
+            )
+    finally:
+        close()
+
+    with pytest.raises(ValueError):
+        CSMLogger(
+            "csmlog_binary_test", binaryLogFiles=True, multiProcessSafeRotation=True
+        )
+
+
+def test_csmlog_decode_cli(binary_logger):
+    logger, handler = binary_logger
+    expected = _log_everything(logger)
+    handler.flush()
+
+    output = subprocess.check_output(
+        [sys.executable, "-m", "csmlog.binary_log", handler.baseFilename],
+        cwd=PARENT_FOLDER,
+    )
+    assert output.decode() == expected
+
+    output = subprocess.check_output(
+        [
+            sys.executable,
+            "-m",
+            "csmlog.binary_log",
+            "--format",
+            "%(levelname)s: %(message)s",
+            handler.baseFilename,
+        ],
+        cwd=PARENT_FOLDER,
+    )
+    assert output.decode().splitlines()[0] == "INFO: hello world"
+
+
+def _time_logging(logger, count):
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        for i in range(count):
+            logger.info("request %d from %s took %.3fs", i, "127.0.0.1", 0.25)
+        return time.perf_counter() - start
+    finally:
+        gc.enable()
+
+
+@pytest.mark.benchmark
+def test_binary_log_benchmark(tmp_path):
+    logger = logging.getLogger("csmlog_binary_benchmark")
+    logger.setLevel(1)
+    logger.propagate = False
+
+    text = logging.handlers.RotatingFileHandler(
+        str(tmp_path / "bench.txt"), maxBytes=1024 * 1024 * 1024
+    )
+    text.setFormatter(FastFormatter(DEFAULT_LOG_FORMAT))
+    binary = BinaryRotatingFileHandler(
+        str(tmp_path / ("bench" + BINARY_LOG_EXTENSION)), maxBytes=1024 * 1024 * 1024
+    )
+    binary.setFormatter(FastFormatter(DEFAULT_LOG_FORMAT))
+
+    textTime = binaryTime = float("inf")
+    try:
+        for i in range(3):
+            for handler in (text, binary):
+                logger.addHandler(handler)
+                took = _time_logging(logger, BENCHMARK_RECORD_COUNT)
+                logger.removeHandler(handler)
+                if handler is text:
+                    textTime = min(textTime, took)
+                else:
+                    binaryTime = min(binaryTime, took)
+    finally:
+        text.close()
+        binary.close()
+
+    start = time.perf_counter()
+    count = decodeBinaryLogFiles(binary.baseFilename, io.StringIO())
+    decodeTime = time.perf_counter() - start
+
+    print(
+        "%d records: text file: %.3fs, binary file: %.3fs (%.2fx). decoded %d records in %.3fs (%d records/s). "
+        "text file: %d bytes, binary file: %d bytes"
+        % (
+            BENCHMARK_RECORD_COUNT,
+            textTime,
+            binaryTime,
+            textTime / binaryTime,
+            count,
+            decodeTime,
+            count / decodeTime,
+            os.path.getsize(text.baseFilename),
+            os.path.getsize(binary.baseFilename),
+        )
+    )
+    assert binaryTime < textTime
@@ -1,3 +1,4 @@
+import inspect
 import io
 import logging
 import os
@@ -12,12 +13,26 @@ import pytest
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 from conftest import (
     APPNAME,
+    PARENT_FOLDER,
     CSMLogger,
     UdpHandlerReceiver,
     LoggedSystemCall,
     CSMLOG_DEFAULT_SAVE_DIRECTORY,
+    close,
+    flush,
+    getCSMLogger,
+    setup,
 )
 
+from csmlog.async_handler import (
+    AsyncForwardingHandler,
+    AsyncHandlerPipeline,
+    FULL_QUEUE_DROP_BELOW_LEVEL,
+    FULL_QUEUE_DROP_OLDEST,
+)
+from csmlog.log_splitter import recordStartRegexFromFormat, splitLogFile
+from csmlog.rotating_file_handler import MultiProcessRotatingFileHandler
+
 
 def test_get_logger_and_clear_logs(csmlog):
 
@@ -252,3 +267,392 @@ def test_get_default_save_directory_with_name_override(monkeypatch, tmp_path):
 
     # calling a second time doesn't cause an issue.
     assert CSMLogger.getDefaultSaveDirectoryWithName("test123") == str(test123)
+
+
+def test_async_handlers():
+    setup(APPNAME, clearLogs=True, asyncHandlers=True)
+    try:
+        csmlog = getCSMLogger()
+        logger = csmlog.getLogger("async")
+        args = ["world"]
+        logger.debug("hello %s", args)
+
+        # changing the args after the call shouldn't change what gets logged
+        args.append("changed")
+        flush()
+
+        assert "hello ['world']" in pathlib.Path(logger.logFile).read_text()
+        assert (
+            "hello ['world']" in pathlib.Path(csmlog.parentLogger.logFile).read_text()
+        )
+
+        # the real handlers are behind one forwarder per logger
+        assert len(logger.handlers) == 1
+        assert isinstance(logger.handlers[0], AsyncForwardingHandler)
+
+        logger.info("before close")
+    finally:
+        close()
+
+    # close() drains the queue
+    assert "before close" in pathlib.Path(logger.logFile).read_text()
+
+
+def _make_async_pipeline_logger(pipeline, name):
+    forwarder = AsyncForwardingHandler(pipeline)
+    seen = []
+
+    class _RecordingHandler(logging.Handler):
+        def emit(self, record):
+            seen.append((record.getMessage(), threading.current_thread()))
+
+    forwarder.addTarget(_RecordingHandler())
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.setLevel(1)
+    logger.addHandler(forwarder)
+    return logger, forwarder, seen
+
+
+def test_async_handler_pipeline_drop_oldest():
+    pipeline = AsyncHandlerPipeline(maxSize=2, fullQueuePolicy=FULL_QUEUE_DROP_OLDEST)
+    logger, forwarder, seen = _make_async_pipeline_logger(
+        pipeline, "csmlog_drop_oldest"
+    )
+
+    try:
+        # listener isn't started so the queue fills up
+        for i in range(5):
+            logger.debug(str(i))
+
+        assert pipeline.droppedRecords == 3
+
+        pipeline.start()
+        pipeline.stop()
+    finally:
+        logger.removeHandler(forwarder)
+
+    assert [s[0] for s in seen] == ["3", "4"]
+    assert all(s[1] is not threading.current_thread() for s in seen)
+
+
+def test_async_handler_pipeline_drop_below_level():
+    pipeline = AsyncHandlerPipeline(
+        maxSize=1, fullQueuePolicy=FULL_QUEUE_DROP_BELOW_LEVEL, dropLevel=logging.INFO
+    )
+    logger, forwarder, seen = _make_async_pipeline_logger(pipeline, "csmlog_drop_below")
+
+    try:
+        logger.info("kept")
+        logger.debug("dropped")
+        assert pipeline.droppedRecords == 1
+
+        pipeline.start()
+        logger.warning("blocks until there is room")
+        pipeline.stop()
+    finally:
+        logger.removeHandler(forwarder)
+
+    assert [s[0] for s in seen] == ["kept", "blocks until there is room"]
+
+
+def test_async_handler_pipeline_bad_policy():
+    with pytest.raises(ValueError):
+        AsyncHandlerPipeline(fullQueuePolicy="lolcats")
+
+
+def test_consolidate_log_files():
+    setup(APPNAME, clearLogs=True, consolidateLogFiles=True)
+    try:
+        csmlog = getCSMLogger()
+        logger = csmlog.getLogger("mod1")
+        logger2 = csmlog.getLogger("mod2")
+        assert logger.logFile == logger2.logFile == csmlog.parentLogger.logFile
+
+        logger.debug("from mod1")
+        logger2.debug("from mod2")
+        try:
+            raise ValueError("lolcats")
+        except ValueError:
+            logger.exception("exception in mod1")
+        csmlog.parentLogger.info("from parent")
+    finally:
+        close()
+
+    folder = pathlib.Path(csmlog.getDefaultSaveDirectory())
+    assert not (folder / (APPNAME + ".mod1.txt")).exists()
+
+    # each record is written once
+    txt = pathlib.Path(logger.logFile).read_text()
+    assert txt.count("from mod1") == 1
+    assert txt.count("from mod2") == 1
+
+    splitFiles = splitLogFile(logger.logFile)
+    assert sorted(splitFiles) == [APPNAME + ".mod1", APPNAME + ".mod2"]
+
+    mod1 = pathlib.Path(splitFiles[APPNAME + ".mod1"]).read_text()
+    assert "from mod1" in mod1
+    assert "ValueError: lolcats" in mod1
+    assert "from mod2" not in mod1
+    assert "from parent" not in mod1
+
+    mod2 = pathlib.Path(splitFiles[APPNAME + ".mod2"]).read_text()
+    assert "from mod2" in mod2
+    assert "from mod1" not in mod2
+
+    # split files go in their own folder, and aren't replaced unless asked to
+    assert pathlib.Path(splitFiles[APPNAME + ".mod1"]).parent == folder / "split"
+    with pytest.raises(FileExistsError):
+        splitLogFile(logger.logFile)
+    assert splitLogFile(logger.logFile, overwrite=True) == splitFiles
+
+
+def test_split_log_file_with_another_format(tmp_path):
+    fmt = "[%(levelname)-8s] %(name)s (%(process)d): %(message)s"
+    logFile = tmp_path / "app.txt"
+    logFile.write_text(
+        "[INFO    ] app.one (123): first\n"
+        "[ERROR   ] app.two (123): second\n"
+        "Traceback: (not a new record)\n"
+        "[DEBUG   ] app.one (456): third\n"
+    )
+
+    splitFiles = splitLogFile(
+        str(logFile), recordStartRegex=recordStartRegexFromFormat(fmt)
+    )
+    assert pathlib.Path(splitFiles["app.one"]).read_text() == (
+        "[INFO    ] app.one (123): first\n[DEBUG   ] app.one (456): third\n"
+    )
+    assert pathlib.Path(splitFiles["app.two"]).read_text() == (
+        "[ERROR   ] app.two (123): second\nTraceback: (not a new record)\n"
+    )
+
+    # a split that fails partway through doesn't leave part of its output behind
+    pathlib.Path(splitFiles["app.one"]).unlink()
+    with pytest.raises(FileExistsError):
+        splitLogFile(str(logFile), recordStartRegex=recordStartRegexFromFormat(fmt))
+    assert not pathlib.Path(splitFiles["app.one"]).exists()
+    assert pathlib.Path(splitFiles["app.two"]).exists()
+
+    with pytest.raises(ValueError):
+        recordStartRegexFromFormat("%(asctime)s %(message)s")
+
+
+def test_get_logger_is_idempotent(csmlog):
+    logger = csmlog.getLogger("same")
+    stats = csmlog.getLoggerStats()
+
+    for i in range(10):
+        assert csmlog.getLogger("same") is logger
+        assert csmlog.getLogger(os.path.join("some", "folder", "same")) is logger
+
+    newStats = csmlog.getLoggerStats()
+    assert newStats["loggers"] == stats["loggers"]
+    assert newStats["handlers"] == stats["handlers"]
+    assert newStats["getLoggerCalls"] == stats["getLoggerCalls"] + 20
+    assert newStats["getLoggerCacheHits"] == stats["getLoggerCacheHits"] + 20
+
+    logger.debug("only once")
+    assert pathlib.Path(logger.logFile).read_text().count("only once") == 1
+
+
+def test_get_default_save_directory_with_name_is_cached(monkeypatch, tmp_path):
+    monkeypatch.setenv("CSMLOG_DEFAULT_SAVE_DIRECTORY", str(tmp_path / "a"))
+    CSMLogger.clearDefaultSaveDirectoryCache()
+
+    isdirCalls = []
+    realIsdir = os.path.isdir
+
+    def _isdir(path):
+        isdirCalls.append(path)
+        return realIsdir(path)
+
+    monkeypatch.setattr(os.path, "isdir", _isdir)
+
+    for i in range(400):
+        assert CSMLogger.getDefaultSaveDirectoryWithName("cached") == str(
+            tmp_path / "a" / "cached"
+        )
+
+    # only the first call touches the filesystem
+    assert len(isdirCalls) == 1
+
+    # changing the override is a different cache entry
+    monkeypatch.setenv("CSMLOG_DEFAULT_SAVE_DIRECTORY", str(tmp_path / "b"))
+    assert CSMLogger.getDefaultSaveDirectoryWithName("cached") == str(
+        tmp_path / "b" / "cached"
+    )
+    assert (tmp_path / "b" / "cached").is_dir()
+    assert len(isdirCalls) == 2
+
+    CSMLogger.clearDefaultSaveDirectoryCache()
+    CSMLogger.getDefaultSaveDirectoryWithName("cached")
+    assert len(isdirCalls) == 3
+
+
+def test_clear_logs_recreates_cached_folder(csmlog):
+    folder = pathlib.Path(csmlog.getDefaultSaveDirectory())
+    csmlog.clearLogs()
+    assert folder.is_dir()
+
+
+# modules `import csmlog` shouldn't import: they are only needed for some features (or only to read logs)
+LAZY_MODULES = (
+    "gspread",
+    "asyncio",
+    "argparse",
+    "csmlog.backup_worker",
+    "csmlog.binary_log",
+    "csmlog.google_sheets_handler",
+    "csmlog.shm_ring_handler",
+    "csmlog.tcp_handler",
+    "csmlog.tcp_handler_receiver",
+    "csmlog.udp_handler",
+    "csmlog.udp_handler_receiver",
+)
+
+
+def test_import_is_lazy():
+    code = "import sys\nimport csmlog\nprint(sorted(set(%r) & set(sys.modules)))\n" % (
+        LAZY_MODULES,
+    )
+    output = subprocess.check_output(
+        [sys.executable, "-c", code],
+        cwd=PARENT_FOLDER,
+    ).decode()
+    assert output.strip() == "[]"
+
+
+# if `import csmlog` takes longer than this, something slow was probably imported eagerly
+IMPORT_TIME_BUDGET_SECONDS = 0.25
+
+
+@pytest.mark.benchmark
+def test_import_time_budget():
+    code = (
+        "import time\n"
+        "start = time.perf_counter()\n"
+        "import csmlog\n"
+        "print(time.perf_counter() - start)\n"
+    )
+    importTimes = []
+    for i in range(3):
+        output = subprocess.check_output(
+            [sys.executable, "-c", code],
+            cwd=PARENT_FOLDER,
+        ).decode()
+        importTimes.append(float(output))
+
+    print("import csmlog took %.3fs" % min(importTimes))
+    assert min(importTimes) < IMPORT_TIME_BUDGET_SECONDS
+
+
+def test_lazy_attributes():
+    import csmlog
+    from csmlog.tcp_handler import DEFAULT_BLOCK_SECONDS, TcpHandler
+    from csmlog.udp_handler import UDP_LOGGING_TCP
+
+    assert csmlog.TcpHandler is TcpHandler
+    assert csmlog.UDP_LOGGING_TCP == UDP_LOGGING_TCP
+
+    # the default is written out so csmlog.tcp_handler doesn't have to be imported to get it
+    for func in (CSMLogger, setup):
+        parameter = inspect.signature(func).parameters["tcpBlockSeconds"]
+        assert parameter.default == DEFAULT_BLOCK_SECONDS
+
+
+def test_lazy_gsheets_handler():
+    import csmlog
+    from csmlog.google_sheets_handler import GSheetsHandler
+
+    assert csmlog.GSheetsHandler is GSheetsHandler
+
+    with pytest.raises(AttributeError):
+        csmlog.NotARealThing
+
+
+@pytest.mark.skipif(os.name == "nt", reason="POSIX only")
+def test_multi_process_safe_rotation():
+    setup(APPNAME, clearLogs=True, multiProcessSafeRotation=True)
+    try:
+        logger = getCSMLogger().getLogger("mp")
+        assert any(
+            isinstance(h, MultiProcessRotatingFileHandler) for h in logger.handlers
+        )
+        logger.debug("hello multi process")
+        assert "hello multi process" in pathlib.Path(logger.logFile).read_text()
+    finally:
+        close()
+
+
+def test_multi_process_safe_rotation_unsupported(monkeypatch):
+    # like on Windows
+    monkeypatch.setattr("csmlog.rotating_file_handler.fcntl", None)
+    with pytest.warns(RuntimeWarning):
+        setup(APPNAME, clearLogs=True, multiProcessSafeRotation=True)
+    try:
+        logger = getCSMLogger().getLogger("mp")
+        assert not any(
+            isinstance(h, MultiProcessRotatingFileHandler) for h in logger.handlers
+        )
+        logger.debug("hello single process")
+        assert "hello single process" in pathlib.Path(logger.logFile).read_text()
+    finally:
+        close()
+
+
+def test_async_handler_pipeline_after_stop():
+    pipeline = AsyncHandlerPipeline(maxSize=1)
+    logger, forwarder, seen = _make_async_pipeline_logger(pipeline, "csmlog_after_stop")
+
+    try:
+        pipeline.start()
+        pipeline.stop()
+
+        # nothing takes records off the queue anymore... they are handled right away instead of waiting for room
+        for i in range(3):
+            logger.info(str(i))
+    finally:
+        logger.removeHandler(forwarder)
+
+    assert [s[0] for s in seen] == ["0", "1", "2"]
+    assert all(s[1] is threading.current_thread() for s in seen)
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork()")
+def test_async_handler_pipeline_after_fork():
+    pipeline = AsyncHandlerPipeline(maxSize=10)
+    logger, forwarder, seen = _make_async_pipeline_logger(pipeline, "csmlog_fork")
+    pipeline.start()
+
+    try:
+        logger.info("in parent")
+        pipeline.flush()
+
+        pid = os.fork()
+        if pid == 0:
+            # child: more records than the queue holds would hang forever without a listener thread
+            exitCode = 1
+            try:
+                import signal
+
+                signal.alarm(10)
+                del seen[:]
+                for i in range(100):
+                    logger.info("in child %d", i)
+                pipeline.flush()
+                if [s[0] for s in seen] == ["in child %d" % i for i in range(100)]:
+                    exitCode = 0
+                pipeline.stop()
+            finally:
+                os._exit(exitCode)
+
+        assert os.waitpid(pid, 0)[1] == 0
+
+        # the parent's listener is unaffected
+        logger.info("in parent again")
+        pipeline.flush()
+        assert [s[0] for s in seen] == ["in parent", "in parent again"]
+    finally:
+        pipeline.stop()
+        logger.removeHandler(forwarder)
@@ -0,0 +1,228 @@
+import gc
+import io
+import logging
+import os
+import pathlib
+import sys
+import time
+import weakref
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from conftest import CSMLogger
+
+from csmlog import DEFAULT_LOG_FORMAT
+from csmlog.formatter import FastFormatter, SharedFormatCacheMixin, formatCachedBytes
+
+BENCHMARK_RECORD_COUNT = 20000
+
+
+def _make_record(
+    created=None, msg="hello %s", args=("world",), exc_info=None, sinfo=None
+):
+    record = logging.getLogger("csmlog_formatter_test").makeRecord(
+        "csmlog_formatter_test",
+        logging.INFO,
+        "file.py",
+        123,
+        msg,
+        args,
+        exc_info,
+        sinfo=sinfo,
+    )
+    if created is not None:
+        record.created = created
+        record.msecs = int((created - int(created)) * 1000) + 0.0
+    return record
+
+
+def _make_records():
+    try:
+        raise ValueError("lolcats")
+    except ValueError:
+        excInfo = sys.exc_info()
+
+    now = time.time()
+    records = [
+        _make_record(),
+        _make_record(msg="no args", args=()),
+        _make_record(msg="unicode ☃ %d%%", args=(5,)),
+        _make_record(msg="ends with newline\n", args=(), exc_info=excInfo),
+        _make_record(exc_info=excInfo),
+        _make_record(sinfo="Stack (most recent call last):\n  fake"),
+    ]
+
+    # cross some second boundaries
+    for i in range(20):
+        records.append(_make_record(created=int(now) + (i * 0.251)))
+
+    return records
+
+
+@pytest.mark.parametrize(
+    "fmt, datefmt",
+    [
+        (DEFAULT_LOG_FORMAT, None),
+        ("%(created)f", None),
+        ("%(message)s", None),
+        ("%(asctime)s %(levelname)-8s %% %(message)r", None),
+        ("%(asctime)s - %(message)s", "%H:%M:%S"),
+    ],
+)
+def test_fast_formatter_output_matches_logging_formatter(fmt, datefmt):
+    for record in _make_records():
+        expected = logging.Formatter(fmt, datefmt).format(record)
+
+        # start fresh, the traceback text is cached on the record
+        record.exc_text = None
+
+        assert FastFormatter(fmt, datefmt).format(record) == expected
+
+
+def test_fast_formatter_missing_field():
+    with pytest.raises(ValueError):
+        FastFormatter("%(notAField)s").format(_make_record())
+
+
+def test_fast_formatter_other_styles():
+    record = _make_record()
+    assert FastFormatter("{levelname}: {message}", style="{").format(record) == (
+        "INFO: hello world"
+    )
+
+
+def test_fast_formatter_formats_once_per_record():
+    formatter = FastFormatter(DEFAULT_LOG_FORMAT)
+    record = _make_record()
+    first = formatter.format(record)
+
+    assert formatter.format(record) is first
+
+    # a record that was changed since is formatted again
+    record.msg = "changed %s"
+    assert "changed" in formatter.format(record)
+
+
+def test_format_cache_doesnt_keep_record():
+    formatter = FastFormatter(DEFAULT_LOG_FORMAT)
+    try:
+        raise ValueError("lolcats")
+    except ValueError:
+        record = _make_record(exc_info=sys.exc_info())
+
+    formatCachedBytes(formatter, record, "\n", "utf-8")
+    recordRef = weakref.ref(record)
+    del record
+    gc.collect()
+    assert recordRef() is None
+
+
+def test_format_cache_leaves_record_alone():
+    record = _make_record()
+    expected = set(record.__dict__) | {"message", "asctime"}
+
+    formatter = FastFormatter(DEFAULT_LOG_FORMAT)
+    data = formatCachedBytes(formatter, record, "\n", "utf-8")
+    assert formatCachedBytes(formatter, record, "\n", "utf-8") is data
+
+    # same attributes logging.Formatter would add
+    assert set(record.__dict__) == expected
+
+
+def test_default_formatter_is_fast(csmlog):
+    assert isinstance(csmlog.getFormatter(), FastFormatter)
+    csmlog.setFormatter("%(message)s")
+    assert isinstance(csmlog.getFormatter(), FastFormatter)
+
+
+def _time_formatting(formatter, records):
+    # like timeit, don't let a garbage collection land in just one of the runs
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        for record in records:
+            formatter.format(record)
+        return time.perf_counter() - start
+    finally:
+        gc.enable()
+
+
+@pytest.mark.benchmark
+def test_fast_formatter_benchmark():
+    standard = fast = float("inf")
+
+    # interleave the runs so any background noise hits both the same
+    for i in range(5):
+        records = [_make_record() for j in range(BENCHMARK_RECORD_COUNT)]
+        standard = min(
+            standard,
+            _time_formatting(logging.Formatter(DEFAULT_LOG_FORMAT), records),
+        )
+
+        records = [_make_record() for j in range(BENCHMARK_RECORD_COUNT)]
+        fast = min(fast, _time_formatting(FastFormatter(DEFAULT_LOG_FORMAT), records))
+
+    print(
+        "%d records: logging.Formatter: %.3fs, FastFormatter: %.3fs (%.2fx)"
+        % (BENCHMARK_RECORD_COUNT, standard, fast, standard / fast)
+    )
+    assert fast < standard
+
+
+class _CountingFormatter(logging.Formatter):
+    def __init__(self, *args, **kwargs):
+        logging.Formatter.__init__(self, *args, **kwargs)
+        self.formatCalls = 0
+
+    def format(self, record):
+        self.formatCalls += 1
+        return logging.Formatter.format(self, record)
+
+
+def test_record_formatted_once_across_handlers(csmlog):
+    formatter = _CountingFormatter(DEFAULT_LOG_FORMAT)
+    csmlog.setFormatter(formatter)
+    csmlog.enableConsoleLogging(stream=io.StringIO())
+
+    # child file handler, parent file handler, udp handler and console handler
+    logger = csmlog.getLogger("once")
+    formatter.formatCalls = 0
+    logger.info("formatted once")
+    assert formatter.formatCalls == 1
+
+    csmlog.flush()
+    assert "formatted once" in pathlib.Path(logger.logFile).read_text()
+    assert "formatted once" in pathlib.Path(csmlog.parentLogger.logFile).read_text()
+    assert "formatted once" in csmlog.consoleLoggingStream.stream.getvalue()
+
+
+def test_format_cached_bytes():
+    formatter = FastFormatter(DEFAULT_LOG_FORMAT)
+    record = _make_record(msg="unicode ☃", args=())
+
+    data = formatCachedBytes(formatter, record, "\n", "utf-8")
+    assert data == (formatter.format(record) + "\n").encode("utf-8")
+    assert formatCachedBytes(formatter, record, "\n", "utf-8") is data
+
+    # different terminator/encoding/formatter... different bytes
+    assert formatCachedBytes(formatter, record, "\r\n", "utf-8").endswith(b"\r\n")
+    assert formatCachedBytes(formatter, record, "\n", "utf-16") != data
+    assert formatCachedBytes(FastFormatter("%(message)s"), record, "\n", "utf-8") == (
+        "unicode ☃\n".encode("utf-8")
+    )
+
+
+def test_shared_format_cache_opt_out(csmlog):
+    class OwnFormatterHandler(SharedFormatCacheMixin, logging.StreamHandler):
+        useSharedFormatCache = False
+
+    handler = OwnFormatterHandler(io.StringIO())
+    handler.setFormatter(logging.Formatter("own: %(message)s"))
+    csmlog.parentLogger.addHandler(handler)
+
+    # setFormatter() doesn't touch a handler with its own formatter
+    csmlog.setFormatter("shared: %(message)s")
+    csmlog.getLogger("optout").info("hello")
+    assert handler.stream.getvalue() == "own: hello\n"
+    assert handler.formatBytes(_make_record(), "\n", "utf-8") == b"own: hello world\n"
@@ -0,0 +1,127 @@
+import gc
+import os
+import random
+import sys
+import time
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from csmlog.ring_buffer import RingBuffer
+
+BENCHMARK_LINE_COUNT = 20000
+BENCHMARK_BUFFER_SIZE = 1024 * 1024
+
+
+def test_ring_buffer_keeps_latest_bytes():
+    ring = RingBuffer(10)
+    assert ring.read() == b""
+    assert len(ring) == 0
+
+    ring.write(b"hello")
+    assert ring.read() == b"hello"
+
+    ring.write(b" world!")
+    assert ring.read() == b"llo world!"
+    assert (ring.start, ring.end, len(ring)) == (2, 12, 10)
+
+    # wrapped around the end of the buffer
+    assert len(ring.views()) == 2
+
+    # more than fits: only the tail survives
+    ring.write(b"0123456789abc")
+    assert ring.read() == b"3456789abc"
+    assert ring.end == 25
+
+    with pytest.raises(ValueError):
+        RingBuffer(0)
+
+
+def test_ring_buffer_since():
+    ring = RingBuffer(8)
+    ring.write(b"abc")
+    seq = ring.end
+    ring.write(b"def")
+    assert ring.read(seq) == b"def"
+    assert ring.read(ring.end) == b""
+
+    # some of it was overwritten, what's left is returned
+    ring.write(b"ghijkl")
+    assert ring.read(seq) == b"efghijkl"
+
+
+def test_ring_buffer_matches_reference():
+    randomizer = random.Random(5)
+    for capacity in (1, 2, 7, 64):
+        ring = RingBuffer(capacity)
+        everything = b""
+        for i in range(500):
+            data = bytes(
+                randomizer.choice(b"ab\n") for j in range(randomizer.randint(0, 20))
+            )
+            ring.write(data)
+            everything += data
+
+            assert ring.read() == everything[-capacity:]
+            since = randomizer.randint(0, len(everything))
+            assert (
+                ring.read(since) == everything[max(since, len(everything) - capacity) :]
+            )
+
+            kept = everything[-capacity:]
+            count = randomizer.randint(1, 5)
+            assert ring.lastLines(count) == b"".join(kept.splitlines(True)[-count:]), (
+                kept,
+                count,
+            )
+
+
+def test_ring_buffer_last_lines():
+    ring = RingBuffer(100)
+    ring.write(b"one\ntwo\nthree\n")
+    assert ring.lastLines(1) == b"three\n"
+    assert ring.lastLines(2) == b"two\nthree\n"
+    assert ring.lastLines(10) == b"one\ntwo\nthree\n"
+    assert ring.lastLines(0) == b""
+
+    # an unfinished line counts
+    ring.write(b"fo")
+    assert ring.lastLines(2) == b"three\nfo"
+
+
+@pytest.mark.benchmark
+def test_ring_buffer_benchmark():
+    line = b"2021-01-01 00:00:00,000 - csmlog_benchmark:123 - INFO - hello world\n"
+    text = line.decode()
+
+    gc.disable()
+    try:
+        # the old way: append to a str and slice it back down to size
+        start = time.perf_counter()
+        buffer = ""
+        for i in range(BENCHMARK_LINE_COUNT):
+            buffer += text
+            buffer = buffer[-BENCHMARK_BUFFER_SIZE:]
+        stringTime = time.perf_counter() - start
+
+        start = time.perf_counter()
+        ring = RingBuffer(BENCHMARK_BUFFER_SIZE)
+        for i in range(BENCHMARK_LINE_COUNT):
+            ring.write(line)
+        ringTime = time.perf_counter() - start
+    finally:
+        gc.enable()
+
+    assert ring.read().decode() == buffer
+    print(
+        "%d lines into a %d byte buffer: str append and slice: %.3fs, RingBuffer: %.3fs (%.2fx)"
+        % (
+            BENCHMARK_LINE_COUNT,
+            BENCHMARK_BUFFER_SIZE,
+            stringTime,
+            ringTime,
+            stringTime / ringTime,
+        )
+    )
+    assert ringTime < stringTime
@@ -0,0 +1,323 @@
+import gzip
+import logging
+import os
+import pathlib
+import re
+import subprocess
+import sys
+import threading
+import uuid
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from conftest import PARENT_FOLDER
+
+from csmlog.backup_worker import COMPRESSION_GZIP, RotatedBackupWorker, openLogFile
+from csmlog.log_splitter import getLogFileWithBackups
+from csmlog.rotating_file_handler import (
+    MultiProcessRotatingFileHandler,
+    RotatingFileHandlerThatWillKeepWorkingOnPermissionErrorDuringRotate,
+    isMultiProcessRotationSupported,
+)
+
+_needsMultiProcessRotation = pytest.mark.skipif(
+    not isMultiProcessRotationSupported(),
+    reason="MultiProcessRotatingFileHandler is POSIX only",
+)
+
+STRESS_PROCESS_COUNT = 8
+STRESS_RECORDS_PER_PROCESS = 1000
+
+# logs a bunch of records from one process, all to the same file
+_STRESS_SCRIPT = """
+import logging, os, sys
+from csmlog.rotating_file_handler import MultiProcessRotatingFileHandler
+
+logFile, processId, count = sys.argv[1], sys.argv[2], int(sys.argv[3])
+compression = sys.argv[4] if len(sys.argv) > 4 else None
+handler = MultiProcessRotatingFileHandler(logFile, maxBytes=16 * 1024, backupCount=10000)
+
+worker = None
+if compression:
+    from csmlog.backup_worker import RotatedBackupWorker
+
+    worker = RotatedBackupWorker(os.path.dirname(logFile), compression=compression)
+    worker.attach(handler)
+    worker.start()
+handler.setFormatter(logging.Formatter("%(message)s"))
+logger = logging.getLogger("stress")
+logger.addHandler(handler)
+logger.setLevel(1)
+
+for i in range(count):
+    logger.info("START %s %d %s END", processId, i, "x" * (i % 200))
+
+handler.close()
+if worker:
+    worker.stop()
+"""
+
+_STRESS_LINE_REGEX = re.compile(r"^START (\d+) (\d+) (x*) END$")
+
+
+@_needsMultiProcessRotation
+@pytest.mark.parametrize("compression", [None, COMPRESSION_GZIP])
+def test_multiple_processes_writing_and_rotating(tmp_path, compression):
+    logFile = tmp_path / "stress.txt"
+    processes = [
+        subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                _STRESS_SCRIPT,
+                str(logFile),
+                str(processId),
+                str(STRESS_RECORDS_PER_PROCESS),
+            ]
+            + ([compression] if compression else []),
+            cwd=PARENT_FOLDER,
+        )
+        for processId in range(STRESS_PROCESS_COUNT)
+    ]
+    for process in processes:
+        assert process.wait() == 0
+
+    files = getLogFileWithBackups(str(logFile))
+
+    # it should have rotated a bunch
+    assert len(files) > 10
+    if compression:
+        assert all(f.endswith(".gz") for f in files[:-1])
+
+        # every slot got filled
+        assert len(files) == len(list(tmp_path.glob("stress.txt*"))) - 1  # .lock
+
+    seen = set()
+    for path in files:
+        with openLogFile(path) as f:
+            lines = f.read().splitlines()
+
+        for line in lines:
+            match = _STRESS_LINE_REGEX.match(line)
+
+            # no torn or interleaved lines
+            assert match, line
+            processId, i, xs = int(match.group(1)), int(match.group(2)), match.group(3)
+            assert len(xs) == i % 200
+
+            # no duplicates
+            assert (processId, i) not in seen
+            seen.add((processId, i))
+
+    # nothing lost
+    assert len(seen) == STRESS_PROCESS_COUNT * STRESS_RECORDS_PER_PROCESS
+
+
+@_needsMultiProcessRotation
+def test_rotation_keeps_backup_count(tmp_path):
+    logFile = tmp_path / "rotate.txt"
+    handler = MultiProcessRotatingFileHandler(str(logFile), maxBytes=100, backupCount=3)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger = logging.getLogger("csmlog_rotation_test")
+    logger.propagate = False
+    logger.addHandler(handler)
+
+    try:
+        # delayed open
+        assert not logFile.exists()
+
+        for i in range(100):
+            logger.warning("record %d", i)
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+
+    assert getLogFileWithBackups(str(logFile)) == [
+        str(logFile) + ".3",
+        str(logFile) + ".2",
+        str(logFile) + ".1",
+        str(logFile),
+    ]
+    assert "record 99" in logFile.read_text()
+
+
+def _log_with_rotation(handler, name, count):
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.addHandler(handler)
+    try:
+        for i in range(count):
+            logger.warning("record %d", i)
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+
+
+@pytest.mark.parametrize(
+    "handlerClass",
+    [
+        RotatingFileHandlerThatWillKeepWorkingOnPermissionErrorDuringRotate,
+        pytest.param(MultiProcessRotatingFileHandler, marks=_needsMultiProcessRotation),
+    ],
+)
+def test_background_compression_of_backups(tmp_path, handlerClass):
+    logFile = tmp_path / "compress.txt"
+    handler = handlerClass(str(logFile), maxBytes=200, backupCount=5)
+    worker = RotatedBackupWorker(str(tmp_path), compression=COMPRESSION_GZIP)
+    worker.attach(handler)
+    worker.start()
+
+    _log_with_rotation(handler, "csmlog_compression_test", 500)
+    worker.stop()
+
+    files = getLogFileWithBackups(str(logFile))
+    assert files == [str(logFile) + ".%d.gz" % i for i in range(5, 0, -1)] + [
+        str(logFile)
+    ]
+    assert not list(tmp_path.glob("*.pending*"))
+
+    # backups are in the right order and nothing is missing between them
+    numbers = []
+    for path in files:
+        with openLogFile(path) as f:
+            numbers.extend(int(line.split()[1]) for line in f.read().splitlines())
+
+    assert numbers == list(range(numbers[0], 500))
+
+
+def test_max_total_bytes_retention(tmp_path):
+    logFile = tmp_path / "retention.txt"
+    otherLogFile = tmp_path / "retention.other.txt"
+    worker = RotatedBackupWorker(str(tmp_path), maxTotalBytes=1000)
+    worker.start()
+
+    for path in (logFile, otherLogFile):
+        handler = RotatingFileHandlerThatWillKeepWorkingOnPermissionErrorDuringRotate(
+            str(path), maxBytes=100, backupCount=100
+        )
+        worker.attach(handler)
+        _log_with_rotation(handler, "csmlog_retention_test", 200)
+
+    worker.stop()
+
+    assert sum(f.stat().st_size for f in tmp_path.iterdir()) <= 1000
+
+    # newest data is kept, the oldest backups (from the first log file) are deleted first
+    assert "record 199" in logFile.read_text()
+    assert "record 199" in otherLogFile.read_text()
+    assert pathlib.Path(str(otherLogFile) + ".1").is_file()
+    assert not pathlib.Path(str(logFile) + ".1").is_file()
+
+
+def test_max_total_bytes_waits_for_rotations(tmp_path):
+    logFile = tmp_path / "locked.txt"
+    handler = RotatingFileHandlerThatWillKeepWorkingOnPermissionErrorDuringRotate(
+        str(logFile), maxBytes=100, backupCount=100
+    )
+    worker = RotatedBackupWorker(str(tmp_path), maxTotalBytes=1000)
+    worker.attach(handler)
+    _log_with_rotation(handler, "csmlog_retention_lock_test", 200)
+    oldest = pathlib.Path(getLogFileWithBackups(str(logFile))[0])
+
+    # a rotation is going on
+    with handler.rotationLock():
+        thread = threading.Thread(target=worker.enforceMaxTotalBytes)
+        thread.start()
+        thread.join(0.2)
+        assert thread.is_alive()
+        assert oldest.is_file()
+
+    thread.join()
+    assert not oldest.is_file()
+    assert sum(f.stat().st_size for f in tmp_path.iterdir()) <= 1000
+
+
+def test_bad_compression():
+    with pytest.raises(ValueError):
+        RotatedBackupWorker(".", compression="lolcats")
+
+
+@_needsMultiProcessRotation
+def test_failed_compression_is_reported_and_retried(tmp_path, capsys):
+    logFile = tmp_path / "retry.txt"
+    handler = MultiProcessRotatingFileHandler(str(logFile), maxBytes=200, backupCount=5)
+    worker = RotatedBackupWorker(str(tmp_path), compression=COMPRESSION_GZIP)
+    worker.attach(handler)
+
+    realCompress = worker._compress
+    failures = []
+
+    def compressFailingOnce(source, dest):
+        if not failures:
+            failures.append(source)
+            raise OSError("disk full")
+        return realCompress(source, dest)
+
+    worker._compress = compressFailingOnce
+    worker.start()
+    _log_with_rotation(handler, "csmlog_compression_retry_test", 500)
+    worker.stop()
+
+    assert "OSError: disk full" in capsys.readouterr().err
+
+    # tried again on the next rotation, into the slot it has moved to since
+    assert not list(tmp_path.glob("*.pending*"))
+    files = getLogFileWithBackups(str(logFile))
+    assert files == [str(logFile) + ".%d.gz" % i for i in range(5, 0, -1)] + [
+        str(logFile)
+    ]
+    numbers = []
+    for path in files:
+        with openLogFile(path) as f:
+            numbers.extend(int(line.split()[1]) for line in f.read().splitlines())
+    assert numbers == list(range(numbers[0], 500))
+
+    # the handler was closed while backups were still being worked on... no lock file was left open
+    assert handler._lockFd is None
+
+
+@_needsMultiProcessRotation
+def test_leftover_pending_backup_is_recovered(tmp_path):
+    logFile = tmp_path / "leftover.txt"
+    (tmp_path / "leftover.txt.1.gz").write_bytes(gzip.compress(b"newer\n"))
+
+    # left behind by a process that is gone
+    deadPid = subprocess.Popen([sys.executable, "-c", "pass"])
+    deadPid.wait()
+    pending = tmp_path / (
+        "leftover.txt.1.gz.%d.%s.pending" % (deadPid.pid, uuid.uuid4().hex)
+    )
+    pending.write_text("older\n")
+
+    # ...and one that a running process is still working on
+    running = tmp_path / (
+        "leftover.txt.1.gz.%d.%s.pending" % (os.getppid(), uuid.uuid4().hex)
+    )
+    running.write_text("someone else's\n")
+
+    handler = MultiProcessRotatingFileHandler(str(logFile), maxBytes=200, backupCount=5)
+    worker = RotatedBackupWorker(str(tmp_path), compression=COMPRESSION_GZIP)
+    worker.attach(handler)
+    worker.start()
+    worker.stop()
+    handler.close()
+
+    assert [p.name for p in tmp_path.glob("*.pending")] == [running.name]
+    with openLogFile(str(logFile) + ".2.gz") as f:
+        assert f.read() == "older\n"
+
+
+@_needsMultiProcessRotation
+def test_do_rollover_before_writing(tmp_path):
+    logFile = tmp_path / "rollover.txt"
+    logFile.write_text("x" * 200)
+
+    handler = MultiProcessRotatingFileHandler(str(logFile), maxBytes=100, backupCount=2)
+    try:
+        handler.doRollover()
+    finally:
+        handler.close()
+
+    assert pathlib.Path(str(logFile) + ".1").read_text() == "x" * 200
@@ -0,0 +1,391 @@
+import logging
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from conftest import close, getCSMLogger, setup
+
+from csmlog.shm_ring_handler import (
+    SHM_RING_FRAME_HEADER_SIZE,
+    SHM_RING_HEADER_SIZE,
+    ShmRing,
+    ShmRingHandler,
+    getShmRingPath,
+    getShmRingPaths,
+)
+from csmlog.shm_ring_reader import ShmRingAppReader, ShmRingReader
+from csmlog.udp_handler import UdpHandler
+
+pytestmark = pytest.mark.skipif(
+    not sys.platform.startswith("linux"),
+    reason="shared memory rings are only tested on Linux (with /dev/shm)",
+)
+
+BENCHMARK_RECORD_COUNT = 50000
+
+
+def _make_logger(handler, name):
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger = logging.getLogger(name)
+    logger.setLevel(1)
+    logger.propagate = False
+    logger.handlers = [handler]
+    return logger
+
+
+class _CollectingReader(ShmRingReader):
+    """keeps what it reads instead of printing it"""
+
+    def __init__(self, *args, **kwargs):
+        ShmRingReader.__init__(self, *args, **kwargs)
+        self.output = b""
+
+    def _writeOutput(self, data):
+        self.output += data
+
+
+def test_shm_ring_handler_to_reader(tmp_path):
+    path = str(tmp_path / "app.ring")
+    handler = ShmRingHandler(path, capacity=4096)
+    logger = _make_logger(handler, "csmlog_shm_test")
+
+    # the ring is read from where it was when the reader opened it
+    logger.info("before the reader")
+    reader = ShmRingReader(path)
+    try:
+        assert reader.read() == b""
+
+        for i in range(10):
+            logger.info("record %d ☃", i)
+        assert reader.read() == "".join("record %d ☃\n" % i for i in range(10)).encode(
+            "utf-8"
+        )
+        assert reader.read() == b""
+
+        # wraps around the end of the ring
+        for i in range(500):
+            logger.info("wrapping %d", i)
+            assert reader.read() == b"wrapping %d\n" % i
+        assert handler.ring.end > 4096
+        assert reader.lostBytes == 0
+    finally:
+        reader.close()
+        handler.close()
+
+    # the file is left for readers and has the expected size
+    assert os.path.getsize(path) == SHM_RING_HEADER_SIZE + 4096
+
+
+def test_shm_ring_overwrites_instead_of_blocking(tmp_path):
+    path = str(tmp_path / "app.ring")
+    handler = ShmRingHandler(path, capacity=100)
+    logger = _make_logger(handler, "csmlog_shm_overwrite_test")
+    reader = ShmRingReader(path)
+    try:
+        assert reader.read() == b""
+
+        # the reader falls way behind
+        for i in range(100):
+            logger.info("record %03d", i)
+
+        # only whole records that are still in the ring come out
+        data = reader.read()
+        lines = data.decode().splitlines()
+        assert lines == ["record %03d" % i for i in range(100 - len(lines), 100)]
+        assert 0 < len(data) <= 100 - len(lines) * SHM_RING_FRAME_HEADER_SIZE
+        read = len(data) + len(lines) * SHM_RING_FRAME_HEADER_SIZE
+        assert reader.lostBytes + read == handler.ring.end
+
+        # a record bigger than the ring keeps its tail
+        logger.info("x" * 200 + "end")
+        tail = b"x" * (100 - SHM_RING_FRAME_HEADER_SIZE - 4) + b"end\n"
+        assert reader.read() == tail
+        assert reader.lostBytes + read + 100 == handler.ring.end
+
+        logger.info("after")
+        assert reader.read() == b"after\n"
+    finally:
+        reader.close()
+        handler.close()
+
+
+def test_shm_ring_reader_copy_is_checked_against_writer(tmp_path):
+    path = str(tmp_path / "app.ring")
+    ring = ShmRing(path, capacity=200)
+    ring.write(b"a" * 29 + b"\n")
+    reader = ShmRingReader(path)
+    try:
+        assert reader.read() == b""
+
+        # the frame of line k is at sequence numbers 50 + 27k to 77 + 27k
+        for i in range(5):
+            ring.write(b"line %d\n" % i)
+
+        # the writer overwrites (up to sequence number 70, in line 0) what is being copied before the copy is checked
+        realCopy = reader._copy
+
+        def copyThenWrite(start, end):
+            data = realCopy(start, end)
+            ring.write(b"y" * 64 + b"\n")
+            return data
+
+        reader._copy = copyThenWrite
+        data = reader.read()
+        assert data == b"".join(b"line %d\n" % i for i in range(1, 5))
+        assert reader.lostBytes == 77 - 50
+
+        reader._copy = realCopy
+        assert reader.read() == b"y" * 64 + b"\n"
+    finally:
+        reader.close()
+        ring.close()
+
+
+def test_shm_ring_reader_retries_torn_frames(tmp_path, monkeypatch):
+    monkeypatch.setattr("csmlog.shm_ring_reader.MAX_FRAME_RETRIES", 2)
+    path = str(tmp_path / "app.ring")
+    ring = ShmRing(path, capacity=200)
+    reader = ShmRingReader(path)
+    try:
+        assert reader.read() == b""
+        ring.write(b"first\n")
+        start = ring.end
+        ring.write(b"second\n")
+        ring.write(b"third\n")
+
+        # as a reader on a CPU that reorders memory accesses may see it: the committed end moved, but not all of
+        #   the second frame's bytes are there yet
+        position = SHM_RING_HEADER_SIZE + start + SHM_RING_FRAME_HEADER_SIZE
+        ring._mmap[position : position + 1] = b"S"
+        assert reader.read() == b"first\n"
+        assert reader.read() == b""
+
+        ring._mmap[position : position + 1] = b"s"
+        assert reader.read() == b"second\nthird\n"
+        assert reader.lostBytes == 0
+
+        # a frame that never checks out is skipped after a few tries
+        start = ring.end
+        ring.write(b"fourth\n")
+        ring.write(b"fifth\n")
+        ring._mmap[SHM_RING_HEADER_SIZE + start + 8] ^= 0xFF
+        assert reader.read() == b""
+        assert reader.read() == b""
+        assert reader.read() == b"fifth\n"
+        assert reader.lostBytes == SHM_RING_FRAME_HEADER_SIZE + 7
+    finally:
+        reader.close()
+        ring.close()
+
+
+def test_shm_ring_reopened_and_replaced(tmp_path):
+    path = str(tmp_path / "app.ring")
+    ring = ShmRing(path, capacity=1024)
+    ring.write(b"first\n")
+    ring.close()
+
+    # the same capacity continues where it left off
+    ring = ShmRing(path, capacity=1024)
+    assert ring.end == SHM_RING_FRAME_HEADER_SIZE + 6
+    ring.write(b"second\n")
+
+    reader = _CollectingReader(path, pollInterval=0.01, fromStart=True)
+    thread = threading.Thread(target=reader.readForever)
+    thread.start()
+    try:
+        for i in range(500):
+            if reader.output == b"first\nsecond\n":
+                break
+            time.sleep(0.01)
+        assert reader.output == b"first\nsecond\n"
+
+        # a different capacity means a new file, which the reader switches to
+        ring.write(b"last in old\n")
+        ring.close()
+        ring = ShmRing(path, capacity=2048)
+        assert ring.end == 0
+        ring.write(b"new\n")
+
+        expected = b"first\nsecond\nlast in old\nnew\n"
+        for i in range(500):
+            if reader.output == expected:
+                break
+            time.sleep(0.01)
+        assert reader.output == expected
+    finally:
+        reader.requestStop()
+        thread.join()
+        ring.close()
+
+    # nothing left behind but the ring
+    assert os.listdir(tmp_path) == ["app.ring"]
+
+
+def test_shm_ring_reader_without_ring(tmp_path):
+    path = str(tmp_path / "app.ring")
+    reader = ShmRingReader(path)
+    assert reader.read() == b""
+
+    with open(path, "wb") as f:
+        f.write(b"not a ring" * 10)
+    with pytest.raises(ValueError):
+        reader.read()
+
+
+def test_csmlogger_shm_ring_logging():
+    path = getShmRingPath("csmlog_shm_ring_test")
+    assert path.endswith(".%d.ring" % os.getpid())
+    setup("csmlog_shm_ring_test", shmRingLogging=True)
+    try:
+        handlers = [
+            h
+            for h in getCSMLogger().parentLogger.handlers
+            if isinstance(h, ShmRingHandler)
+        ]
+        assert len(handlers) == 1
+        assert handlers[0].path == path
+
+        reader = ShmRingReader(path)
+        try:
+            assert reader.read() == b""
+            getCSMLogger().getLogger("child").info("to the ring")
+            assert reader.read().endswith(b"to the ring\n")
+        finally:
+            reader.close()
+    finally:
+        close()
+        os.remove(path)
+
+
+def _read_until(reader, expected):
+    """reads until the lines read (in any order) are the expected ones"""
+    lines = []
+    for i in range(500):
+        lines.extend(reader.read().decode().splitlines())
+        if sorted(lines) == sorted(expected):
+            break
+        time.sleep(0.01)
+    return sorted(lines)
+
+
+def test_shm_ring_app_reader_and_fork():
+    appName = "csmlog_shm_ring_app_test"
+
+    # left behind by a process that is gone
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    stalePath = getShmRingPath(appName, process.pid)
+    ShmRing(stalePath, 4096).close()
+
+    handler = ShmRingHandler(capacity=4096, appName=appName)
+    assert not os.path.exists(stalePath)
+    assert getShmRingPaths(appName) == [handler.path]
+
+    logger = _make_logger(handler, "csmlog_shm_fork_test")
+    reader = ShmRingAppReader(appName)
+    childPath = None
+    try:
+        assert reader.read() == b""
+        logger.info("in parent")
+        assert _read_until(reader, ["in parent"]) == ["in parent"]
+
+        pid = os.fork()
+        if pid == 0:
+            # child: writes its own ring, not the parent's
+            try:
+                logger.info("in child")
+            finally:
+                os._exit(0 if handler.path == getShmRingPath(appName) else 1)
+
+        assert os.waitpid(pid, 0)[1] == 0
+        childPath = getShmRingPath(appName, pid)
+        logger.info("in parent again")
+
+        # a ring that shows up later is read from its start
+        assert _read_until(reader, ["in parent again", "in child"]) == [
+            "in child",
+            "in parent again",
+        ]
+        assert sorted(reader.readers) == sorted([handler.path, childPath])
+        assert reader.lostBytes == 0
+
+        # let go of once it's removed
+        os.remove(childPath)
+        assert reader.read() == b""
+        assert list(reader.readers) == [handler.path]
+    finally:
+        reader.close()
+        handler.close()
+        os.remove(handler.path)
+        if childPath and os.path.exists(childPath):
+            os.remove(childPath)
+
+
+def test_shm_ring_handler_path_or_app_name(tmp_path):
+    with pytest.raises(ValueError):
+        ShmRingHandler()
+    with pytest.raises(ValueError):
+        ShmRingHandler(str(tmp_path / "app.ring"), appName="csmlog_shm_both")
+
+
+def _timeLogging(makeHandler, name):
+    """returns the best records/s (of a few tries) logged through a handler from makeHandler()"""
+    record = "x" * 100
+    rates = []
+    for i in range(3):
+        handler = makeHandler()
+        logger = _make_logger(handler, name)
+        try:
+            start = time.perf_counter()
+            for i in range(BENCHMARK_RECORD_COUNT):
+                logger.info(record)
+            handler.flush()
+            rates.append(BENCHMARK_RECORD_COUNT / (time.perf_counter() - start))
+        finally:
+            handler.close()
+
+    return max(rates)
+
+
+@pytest.mark.benchmark
+def test_shm_ring_benchmark(tmp_path):
+    path = str(tmp_path / "app.ring")
+    recordBytes = 101
+
+    # udp to a socket that is never read: the kernel drops what doesn't fit
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    try:
+        udpRate = _timeLogging(
+            lambda: UdpHandler(port=sock.getsockname()[1]), "csmlog_shm_benchmark_udp"
+        )
+    finally:
+        sock.close()
+
+    # the reader would be in another process... it reads everything at once afterwards here
+    capacity = BENCHMARK_RECORD_COUNT * (SHM_RING_FRAME_HEADER_SIZE + recordBytes)
+    ShmRing(path, capacity).close()
+    reader = ShmRingReader(path)
+    try:
+        assert reader.read() == b""
+        shmRate = _timeLogging(
+            lambda: ShmRingHandler(path, capacity), "csmlog_shm_benchmark_shm"
+        )
+
+        # only the last try is still in the ring
+        data = reader.read()
+    finally:
+        reader.close()
+
+    print(
+        "%d records of 100 bytes. logged with udp: %d records/s. logged to a shm ring: %d records/s"
+        % (BENCHMARK_RECORD_COUNT, udpRate, shmRate)
+    )
+    assert data == (b"x" * 100 + b"\n") * BENCHMARK_RECORD_COUNT
+    assert reader.lostBytes == 2 * capacity
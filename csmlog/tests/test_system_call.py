@@ -0,0 +1,395 @@
+import asyncio
+import logging
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from conftest import LoggedSystemCall
+
+from csmlog.system_call import AsyncLoggedSystemCall
+
+BENCHMARK_LINE_COUNT = 100000
+
+
+class _CollectingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def messages(self, prefix="<CMD OUTPUT>: "):
+        return [
+            r.getMessage()[len(prefix) :]
+            for r in self.records
+            if r.getMessage().startswith(prefix)
+        ]
+
+
+def _make_logger(name, level=1):
+    handler = _CollectingHandler()
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    logger.propagate = False
+    logger.handlers = [handler]
+    return logger, handler
+
+
+def _python(code):
+    return [sys.executable, "-c", code]
+
+
+def test_check_output_logs_each_line():
+    logger, handler = _make_logger("csmlog_syscall_lines")
+    sysCall = LoggedSystemCall(logger, readChunkSize=7)
+
+    # lines (and a multi byte character) split across reads, and no newline at the end
+    code = "import sys; sys.stdout.write('first line\\nsecond ☃ line\\n\\nno newline')"
+    output = sysCall.check_output(_python(code))
+    assert output == "first line\nsecond ☃ line\n\nno newline"
+    assert handler.messages() == ["first line", "second ☃ line", "", "no newline"]
+    assert handler.records[-1].getMessage() == ".. Exit Code: 0"
+
+
+def test_check_output_large_output():
+    logger, handler = _make_logger("csmlog_syscall_large")
+    sysCall = LoggedSystemCall(logger)
+
+    code = "import sys\nfor i in range(100000): sys.stdout.write('line %d\\n' % i)"
+    output = sysCall.check_output(_python(code))
+    assert output == "".join("line %d\n" % i for i in range(100000))
+    assert handler.messages() == ["line %d" % i for i in range(100000)]
+
+
+def test_check_output_without_keeping_output():
+    logger, handler = _make_logger("csmlog_syscall_no_keep")
+    sysCall = LoggedSystemCall(logger)
+
+    code = "import sys\nfor i in range(10): print('line %d' % i)\nsys.exit(3)"
+    with pytest.raises(subprocess.CalledProcessError) as ex:
+        sysCall.check_output(_python(code), keepOutput=False)
+    assert ex.value.returncode == 3
+    assert ex.value.output is None
+    assert handler.messages() == ["line %d" % i for i in range(10)]
+
+    assert sysCall.check_output(_python("print('hi')"), keepOutput=False) is None
+    assert sysCall.call(_python(code)) == 3
+
+
+def test_check_output_long_line_is_logged_in_pieces(monkeypatch):
+    monkeypatch.setattr("csmlog.system_call.MAX_LOGGED_LINE_SIZE", 100)
+    logger, handler = _make_logger("csmlog_syscall_long_line")
+    sysCall = LoggedSystemCall(logger, readChunkSize=30)
+
+    output = sysCall.check_output(_python("print('x' * 1000)"))
+    assert output == "x" * 1000 + "\n"
+    messages = handler.messages()
+    assert "".join(messages) == "x" * 1000
+    assert all(len(m) <= 130 for m in messages)
+
+
+class _OldLoggedSystemCall(LoggedSystemCall):
+    """how output was captured before: a line at a time, appending to a string, polling for the exit"""
+
+    def check_output(self, cmd, shell=False, keepOutput=True):
+        process = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=shell
+        )
+        output = ""
+        while process.poll() is None:
+            savedOutput = ""
+            while True:
+                line = process.stdout.readline().decode()
+                if line:
+                    savedOutput += line
+                    self.logger.debug("<CMD OUTPUT>: %s" % line.rstrip("\n"))
+                else:
+                    break
+            output += savedOutput
+            time.sleep(0.00001)
+        process.stdout.close()
+        return output
+
+
+@pytest.mark.benchmark
+def test_check_output_benchmark():
+    code = (
+        "import sys\nline = 'x' * 99 + '\\n'\nfor i in range(%d): sys.stdout.write(line)"
+        % BENCHMARK_LINE_COUNT
+    )
+
+    results = []
+    for level in (logging.DEBUG, logging.INFO):
+        logger, handler = _make_logger("csmlog_syscall_benchmark_%d" % level, level)
+        for name, sysCall, keepOutput in (
+            ("old", _OldLoggedSystemCall(logger), True),
+            ("kept", LoggedSystemCall(logger), True),
+            ("not kept", LoggedSystemCall(logger), False),
+        ):
+            # the best of a few tries
+            best = None
+            for i in range(2):
+                handler.records = []
+                start = time.perf_counter()
+                output = sysCall.check_output(_python(code), keepOutput=keepOutput)
+                took = time.perf_counter() - start
+                best = took if best is None else min(best, took)
+                if keepOutput:
+                    assert len(output) == BENCHMARK_LINE_COUNT * 100
+
+            results.append(
+                "%s (%s logged): %.3fs" % (name, logging.getLevelName(level), best)
+            )
+
+    print(
+        "%d MB of output in lines of 100 bytes. %s"
+        % (BENCHMARK_LINE_COUNT * 100 // 1000000, ". ".join(results))
+    )
+
+
+def test_run_separates_stdout_and_stderr():
+    logger, handler = _make_logger("csmlog_syscall_run")
+    sysCall = LoggedSystemCall(logger)
+
+    code = (
+        "import sys\n"
+        "print('out 1', flush=True)\n"
+        "print('err 1', file=sys.stderr, flush=True)\n"
+        "sys.stdout.write('out 2')\n"
+        "sys.stderr.write('err ☃ 2\\n')\n"
+        "sys.exit(2)"
+    )
+    result = sysCall.run(_python(code))
+    assert result.returncode == 2
+    assert result.stdout == "out 1\nout 2"
+    assert result.stderr == "err 1\nerr ☃ 2\n"
+
+    assert handler.messages() == ["out 1", "out 2"]
+    assert handler.messages("<CMD STDERR>: ") == ["err 1", "err ☃ 2"]
+    levels = {r.getMessage(): r.levelno for r in handler.records}
+    assert levels["<CMD OUTPUT>: out 1"] == logging.DEBUG
+    assert levels["<CMD STDERR>: err 1"] == logging.WARNING
+
+    with pytest.raises(subprocess.CalledProcessError) as ex:
+        sysCall.run(_python(code), check=True, stderrLevel=logging.ERROR)
+    assert ex.value.returncode == 2
+    assert ex.value.stderr == "err 1\nerr ☃ 2\n"
+    assert handler.records[-3].getMessage() == "<CMD STDERR>: err ☃ 2"
+    assert handler.records[-3].levelno == logging.ERROR
+
+    result = sysCall.run(_python(code), keepOutput=False)
+    assert result.stdout is None and result.stderr is None
+
+
+def test_output_that_isnt_utf8_keeps_the_exit_code():
+    logger, handler = _make_logger("csmlog_syscall_not_utf8")
+    sysCall = LoggedSystemCall(logger)
+    asyncSysCall = AsyncLoggedSystemCall(logger)
+
+    code = (
+        "import sys\n"
+        "sys.stdout.buffer.write(b'out \\xff\\n')\n"
+        "sys.stderr.buffer.write(b'err \\xfe\\n')\n"
+        "sys.exit(5)"
+    )
+    for result in (
+        sysCall.run(_python(code)),
+        _asyncRun(asyncSysCall.run(_python(code))),
+    ):
+        assert result.returncode == 5
+        assert result.stdout == "out \ufffd\n"
+        assert result.stderr == "err \ufffd\n"
+
+    for checkOutput in (
+        lambda: sysCall.check_output(_python(code)),
+        lambda: _asyncRun(asyncSysCall.check_output(_python(code))),
+    ):
+        with pytest.raises(subprocess.CalledProcessError) as ex:
+            checkOutput()
+        assert ex.value.returncode == 5
+        assert "out \ufffd\n" in ex.value.output
+
+
+@pytest.mark.parametrize("selectable", [True, False])
+def test_run_doesnt_deadlock_on_full_pipes(monkeypatch, selectable):
+    # without selectors (on Windows), stderr is read by a thread
+    monkeypatch.setattr("csmlog.system_call._PIPES_SELECTABLE", selectable)
+    logger, handler = _make_logger("csmlog_syscall_run_full_pipes")
+    sysCall = LoggedSystemCall(logger)
+
+    # far more than a pipe holds on one stream while the other one has nothing
+    code = (
+        "import sys\n"
+        "sys.stderr.write(('e' * 99 + '\\n') * 20001)\n"
+        "sys.stderr.flush()\n"
+        "sys.stdout.write(('o' * 99 + '\\n') * 20000)\n"
+    )
+    result = sysCall.run(_python(code))
+    assert result.returncode == 0
+    assert result.stdout == ("o" * 99 + "\n") * 20000
+    assert result.stderr == ("e" * 99 + "\n") * 20001
+    assert len(handler.messages()) == 20000
+    assert len(handler.messages("<CMD STDERR>: ")) == 20001
+
+
+@pytest.mark.benchmark
+def test_run_benchmark():
+    # interleaved blocks of lines on stdout and stderr
+    code = (
+        "import sys\n"
+        "block = ('x' * 99 + '\\n') * 1000\n"
+        "for i in range(%d):\n"
+        "    sys.stdout.write(block)\n"
+        "    sys.stderr.write(block)\n" % (BENCHMARK_LINE_COUNT // 2000)
+    )
+
+    def timeIt(func):
+        # the best of a few tries
+        best = None
+        for i in range(3):
+            start = time.perf_counter()
+            result = func()
+            took = time.perf_counter() - start
+            best = took if best is None else min(best, took)
+            assert len(result.stdout) == len(result.stderr) == BENCHMARK_LINE_COUNT * 50
+        return best
+
+    baseline = timeIt(lambda: subprocess.run(_python(code), capture_output=True))
+    results = ["subprocess.run: %.3fs" % baseline]
+    took = {}
+    for level in (logging.DEBUG, logging.WARNING, logging.ERROR):
+        logger, handler = _make_logger("csmlog_syscall_run_benchmark_%d" % level, level)
+        sysCall = LoggedSystemCall(logger)
+        took[level] = timeIt(lambda: sysCall.run(_python(code)))
+        results.append(
+            "run (%s logged): %.3fs" % (logging.getLevelName(level), took[level])
+        )
+
+    results.append(
+        "nothing logged / subprocess.run: %.1fx" % (took[logging.ERROR] / baseline)
+    )
+    print(
+        "%d MB of interleaved output in lines of 100 bytes. %s"
+        % (BENCHMARK_LINE_COUNT * 100 // 1000000, ". ".join(results))
+    )
+
+
+def _asyncRun(coroutine):
+    # before Python 3.8, only the proactor event loop can run subprocesses on Windows
+    if os.name == "nt":
+        loop = asyncio.ProactorEventLoop()
+    else:
+        loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_async_check_output_and_call():
+    logger, handler = _make_logger("csmlog_async_syscall")
+    sysCall = AsyncLoggedSystemCall(logger, readChunkSize=7)
+
+    code = "import sys; sys.stdout.write('first line\\nsecond ☃ line\\nno newline')"
+    output = _asyncRun(sysCall.check_output(_python(code)))
+    assert output == "first line\nsecond ☃ line\nno newline"
+    assert handler.messages() == ["first line", "second ☃ line", "no newline"]
+    assert handler.records[0].getMessage().startswith("About to call: ")
+    assert handler.records[-1].getMessage() == ".. Exit Code: 0"
+
+    assert "hi" in _asyncRun(sysCall.check_output("echo hi", shell=True))
+    assert _asyncRun(sysCall.call("exit 4", shell=True)) == 4
+    with pytest.raises(subprocess.CalledProcessError):
+        _asyncRun(sysCall.check_output("easdsadcho hi", shell=True))
+
+    # stdout and stderr separately
+    code = "import sys; print('out'); print('err', file=sys.stderr)"
+    result = _asyncRun(sysCall.run(_python(code)))
+    assert (result.returncode, result.stdout, result.stderr) == (0, "out\n", "err\n")
+    assert handler.records[-2].getMessage() == "<CMD STDERR>: err"
+    assert handler.records[-2].levelno == logging.WARNING
+
+
+def test_async_streams_lines_as_they_arrive():
+    logger, handler = _make_logger("csmlog_async_syscall_streams")
+    sysCall = AsyncLoggedSystemCall(logger)
+
+    async def main():
+        code = "import time\nprint('early', flush=True)\ntime.sleep(60)"
+        task = asyncio.ensure_future(sysCall.check_output(_python(code)))
+        for i in range(500):
+            if handler.messages() == ["early"]:
+                break
+            await asyncio.sleep(0.01)
+        assert handler.messages() == ["early"]
+
+        # cancelling kills the process
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    start = time.monotonic()
+    _asyncRun(main())
+    assert time.monotonic() - start < 30
+    assert handler.records[-1].getMessage() == ".. Killed"
+
+
+def test_async_timeout_kills_process():
+    logger, handler = _make_logger("csmlog_async_syscall_timeout")
+    sysCall = AsyncLoggedSystemCall(logger)
+
+    code = "import time\nprint('before', flush=True)\ntime.sleep(60)"
+    start = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired) as ex:
+        _asyncRun(sysCall.run(_python(code), timeout=1))
+    assert time.monotonic() - start < 30
+    assert ex.value.output == b"before\n"
+    assert ex.value.stderr == b""
+    assert handler.messages() == ["before"]
+    assert handler.records[-1].getMessage() == ".. Killed"
+
+
+@pytest.mark.skipif(os.name == "nt", reason="uses sh")
+def test_async_many_processes_on_one_loop(tmp_path):
+    logger, handler = _make_logger("csmlog_async_syscall_many")
+    sysCall = AsyncLoggedSystemCall(logger)
+    count = 200
+
+    # each process waits until all of them have started, so this only finishes if they run at the same time
+    script = 'touch "%s/$0"; while [ ! -e "%s/go" ]; do sleep 0.2; done; echo $0' % (
+        tmp_path,
+        tmp_path,
+    )
+
+    async def letThemGo():
+        while len(os.listdir(tmp_path)) < count:
+            await asyncio.sleep(0.1)
+        (tmp_path / "go").touch()
+
+    async def main():
+        calls = asyncio.gather(
+            *(
+                sysCall.check_output(["sh", "-c", script, str(i)], timeout=120)
+                for i in range(count)
+            )
+        )
+        await asyncio.wait_for(letThemGo(), 120)
+        return await calls
+
+    outputs = _asyncRun(main())
+    assert outputs == ["%d\n" % i for i in range(count)]
+    assert sorted(handler.messages()) == sorted(str(i) for i in range(count))
+
+
+def test_loggers_have_async_sys_call(csmlog):
+    logger = csmlog.getLogger("async_sys_call")
+    assert isinstance(logger.asyncSysCall, AsyncLoggedSystemCall)
+    assert logger.asyncSysCall.logger is logger
+    assert _asyncRun(logger.asyncSysCall.check_output(_python("print('hi')"))) == (
+        "hi\n"
+    )
@@ -0,0 +1,457 @@
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from conftest import close, getCSMLogger, setup
+
+from csmlog.tcp_handler import (
+    TCP_ACK,
+    TCP_FRAME_HEADER,
+    TCP_HELLO,
+    TCP_HELLO_MAGIC,
+    TCP_VERSION,
+    TcpHandler,
+)
+from csmlog.tcp_handler_receiver import TcpHandlerReceiver
+from csmlog.udp_aggregator import TcpAggregator
+from csmlog.udp_handler import UDP_LOGGING_TCP, UdpHandler
+from csmlog.udp_handler_receiver import UdpHandlerReceiver
+
+BENCHMARK_RECORD_COUNT = 50000
+
+
+class _CollectingReceiver(TcpHandlerReceiver):
+    """keeps what each sender sent instead of printing it"""
+
+    def __init__(self, *args, **kwargs):
+        TcpHandlerReceiver.__init__(self, *args, bufferMaxSize=1024 * 1024, **kwargs)
+        self.output = {}
+
+    def _writeMessages(self, messages):
+        for source, message in messages:
+            self.output[source] = self.output.get(source, b"") + message
+
+
+def _start(receiver):
+    thread = threading.Thread(target=receiver.recieveForever)
+    thread.start()
+    assert receiver.bound.wait(5)
+    return thread
+
+
+def _stop(receiver, thread):
+    receiver.requestStop()
+    thread.join()
+
+
+def _freePort():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _make_logger(handler, name):
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger = logging.getLogger(name)
+    logger.setLevel(1)
+    logger.propagate = False
+    logger.handlers = [handler]
+    return logger
+
+
+def _waitFor(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_tcp_handler_to_receiver():
+    receiver = _CollectingReceiver(port=0)
+    thread = _start(receiver)
+    handler = TcpHandler(port=receiver.socket.getsockname()[1], maxFrameBytes=1000)
+    try:
+        logger = _make_logger(handler, "csmlog_tcp_test")
+        for i in range(1000):
+            logger.info("record %d ☃", i)
+        assert handler.flush()
+
+        expected = "".join("record %d ☃\n" % i for i in range(1000))
+        assert receiver.output[handler.senderId].decode() == expected
+        assert receiver.getBuffer() == expected
+
+        # records are packed into frames
+        assert handler.ackedRecords == 1000
+        assert 10 < handler.sentFrames < 100
+        assert handler.resentFrames == handler.droppedRecords == 0
+
+        stats = receiver.getSenderStats()[handler.senderId]
+        assert stats["receivedMessages"] == handler.sentFrames
+        assert stats["duplicateMessages"] == 0
+        assert stats["connections"] == 1
+    finally:
+        handler.close()
+        _stop(receiver, thread)
+
+
+def test_tcp_handler_reconnects_and_resends():
+    port = _freePort()
+    handler = TcpHandler(port=port, initialBackoffSeconds=0.01, maxBackoffSeconds=0.05)
+    logger = _make_logger(handler, "csmlog_tcp_reconnect_test")
+    try:
+        # nothing is listening yet... kept until something is
+        logger.info("before the receiver")
+        assert not handler.flush(0.2)
+
+        receiver = _CollectingReceiver(port=port)
+        thread = _start(receiver)
+        try:
+            assert handler.flush()
+            logger.info("first receiver")
+            assert handler.flush()
+        finally:
+            _stop(receiver, thread)
+
+        # the receiver is down
+        for i in range(10):
+            logger.info("while down %d", i)
+        assert not handler.flush(0.2)
+
+        receiver2 = _CollectingReceiver(port=port)
+        thread = _start(receiver2)
+        try:
+            assert handler.flush()
+        finally:
+            _stop(receiver2, thread)
+    finally:
+        handler.close()
+
+    assert receiver.output[handler.senderId] == (
+        b"before the receiver\nfirst receiver\n"
+    )
+    assert receiver2.output[handler.senderId] == b"".join(
+        b"while down %d\n" % i for i in range(10)
+    )
+    assert handler.connections == 2
+    assert handler.ackedRecords == 12
+    assert handler.droppedRecords == 0
+
+
+def test_tcp_aggregator_writes_before_acking(tmp_path):
+    receiver = TcpAggregator(str(tmp_path), port=0)
+    thread = _start(receiver)
+    handlers = [TcpHandler(port=receiver.socket.getsockname()[1]) for i in range(2)]
+    try:
+        for i, handler in enumerate(handlers):
+            logger = _make_logger(handler, "csmlog_tcp_aggregator_test_%d" % i)
+            logger.info("from handler %d ☃", i)
+            assert handler.flush()
+
+        # acked, so already written
+        files = receiver.getSourceFiles()
+        for i, handler in enumerate(handlers):
+            path = files[handler.senderId]
+            assert os.path.basename(path) == "127.0.0.1_%016x.log" % handler.senderId
+            with open(path, "rb") as f:
+                assert f.read().decode() == "from handler %d ☃\n" % i
+    finally:
+        for handler in handlers:
+            handler.close()
+        _stop(receiver, thread)
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork()")
+def test_tcp_handler_after_fork():
+    receiver = _CollectingReceiver(port=0)
+    thread = _start(receiver)
+    handler = TcpHandler(port=receiver.socket.getsockname()[1])
+    logger = _make_logger(handler, "csmlog_tcp_fork_test")
+    try:
+        # connected (with the writer thread running) when it forks
+        logger.info("parent1")
+        assert handler.flush()
+        parentSenderId = handler.senderId
+
+        pid = os.fork()
+        if pid == 0:
+            exitCode = 1
+            try:
+                import signal
+
+                signal.alarm(10)
+                logger.info("in child")
+                if handler.flush() and handler.senderId != parentSenderId:
+                    exitCode = 0
+            finally:
+                os._exit(exitCode)
+
+        assert os.waitpid(pid, 0)[1] == 0
+        logger.info("parent2")
+        assert handler.flush()
+    finally:
+        handler.close()
+        _stop(receiver, thread)
+
+    assert receiver.output.pop(parentSenderId) == b"parent1\nparent2\n"
+    assert list(receiver.output.values()) == [b"in child\n"]
+    assert all(
+        stats["duplicateMessages"] == 0 for stats in receiver.getSenderStats().values()
+    )
+
+
+def _connect(port, senderId):
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.sendall(TCP_HELLO.pack(TCP_HELLO_MAGIC, TCP_VERSION, senderId))
+    return sock
+
+
+def _frame(sequence, payload):
+    return TCP_FRAME_HEADER.pack(len(payload), sequence) + payload
+
+
+def _receiveAcks(sock, count):
+    data = b""
+    while len(data) < count * TCP_ACK.size:
+        data += sock.recv(4096)
+    return [
+        TCP_ACK.unpack_from(data, offset)[0]
+        for offset in range(0, len(data), TCP_ACK.size)
+    ]
+
+
+def test_tcp_receiver_drops_frames_it_already_has():
+    receiver = _CollectingReceiver(port=0)
+    thread = _start(receiver)
+    port = receiver.socket.getsockname()[1]
+    try:
+        first = _connect(port, 1234)
+        assert _receiveAcks(first, 1) == [0]
+        first.sendall(_frame(1, b"one\n") + _frame(2, b"two\n"))
+        assert _waitFor(lambda: receiver.output.get(1234) == b"one\ntwo\n")
+
+        # a new connection for the same sender is told what was received, and anything resent is ignored
+        second = _connect(port, 1234)
+        assert _receiveAcks(second, 1) == [2]
+        second.sendall(
+            _frame(1, b"one\n") + _frame(2, b"two\n") + _frame(3, b"three\n")
+        )
+        assert _receiveAcks(second, 1) == [3]
+        assert receiver.output[1234] == b"one\ntwo\nthree\n"
+
+        stats = receiver.getSenderStats()[1234]
+        assert stats["receivedMessages"] == 3
+        assert stats["duplicateMessages"] == 2
+        assert stats["connections"] == 2
+
+        # garbage is hung up on
+        garbage = socket.create_connection(("127.0.0.1", port))
+        garbage.sendall(b"GET / HTTP/1.1\r\n\r\n")
+        garbage.settimeout(5)
+        assert garbage.recv(10) == b""
+        for sock in (first, second, garbage):
+            sock.close()
+    finally:
+        _stop(receiver, thread)
+
+
+def test_tcp_receiver_forgets_idle_senders():
+    receiver = _CollectingReceiver(port=0, senderTimeout=60, maxSenders=2)
+    thread = _start(receiver)
+    port = receiver.socket.getsockname()[1]
+    try:
+        sockets = [_connect(port, senderId) for senderId in range(1, 5)]
+        for sock in sockets:
+            assert _receiveAcks(sock, 1) == [0]
+        assert sorted(receiver.getSenderStats()) == [1, 2, 3, 4]
+
+        # only the 2 senders that lost their connection most recently are kept (along with the connected ones)
+        for sock in sockets[:3]:
+            sock.close()
+        assert _waitFor(lambda: sorted(receiver.getSenderStats()) == [2, 3, 4])
+
+        # a sender that reconnects isn't idle anymore
+        again = _connect(port, 2)
+        assert _receiveAcks(again, 1) == [0]
+        sockets[3].close()
+        assert _waitFor(lambda: receiver.getConnectionCount() == 1)
+        assert sorted(receiver.getSenderStats()) == [2, 3, 4]
+        again.close()
+    finally:
+        _stop(receiver, thread)
+
+
+def test_tcp_handler_backpressure():
+    port = _freePort()
+
+    # waits a bit for room, then drops... and keeps dropping without waiting until there is room
+    handler = TcpHandler(port=port, maxBufferBytes=100, blockSeconds=0.5)
+    logger = _make_logger(handler, "csmlog_tcp_drop_test")
+    try:
+        start = time.monotonic()
+        for i in range(5):
+            logger.info("x" * 39)
+        took = time.monotonic() - start
+        assert 0.5 <= took < 1.0
+        assert handler.droppedRecords == 3
+    finally:
+        # nothing to wait for: the receiver is down
+        start = time.monotonic()
+        handler.close()
+        assert time.monotonic() - start < handler.flushTimeout
+
+    # waits as long as it takes
+    handler = TcpHandler(
+        port=port,
+        maxBufferBytes=100,
+        blockSeconds=None,
+        initialBackoffSeconds=0.01,
+        maxBackoffSeconds=0.05,
+    )
+    logger = _make_logger(handler, "csmlog_tcp_block_test")
+    logged = threading.Event()
+
+    def logStuff():
+        for i in range(10):
+            logger.info("record %d%s", i, "x" * 30)
+        logged.set()
+
+    logThread = threading.Thread(target=logStuff)
+    logThread.start()
+    assert not logged.wait(0.2)
+
+    receiver = _CollectingReceiver(port=port)
+    thread = _start(receiver)
+    try:
+        assert logged.wait(5)
+        logThread.join()
+        assert handler.flush()
+        assert receiver.output[handler.senderId] == b"".join(
+            b"record %d%s\n" % (i, b"x" * 30) for i in range(10)
+        )
+        assert handler.droppedRecords == 0
+    finally:
+        handler.close()
+        _stop(receiver, thread)
+
+
+def test_tcp_receiver_handles_hundreds_of_producers():
+    receiver = _CollectingReceiver(port=0)
+    thread = _start(receiver)
+    port = receiver.socket.getsockname()[1]
+    handlers = []
+    try:
+        for i in range(200):
+            handler = TcpHandler(port=port)
+            handlers.append(handler)
+            logger = _make_logger(handler, "csmlog_tcp_producer_%d" % i)
+            for j in range(10):
+                logger.info("producer %d record %d", i, j)
+
+        assert all(handler.flush() for handler in handlers)
+        assert receiver.getConnectionCount() == 200
+
+        for i, handler in enumerate(handlers):
+            assert receiver.output[handler.senderId] == b"".join(
+                b"producer %d record %d\n" % (i, j) for j in range(10)
+            )
+        assert len(receiver.getSenderStats()) == 200
+    finally:
+        for handler in handlers:
+            handler.close()
+        _stop(receiver, thread)
+
+
+def test_csmlogger_udp_logging_tcp():
+    receiver = _CollectingReceiver(port=5123)
+    thread = _start(receiver)
+    try:
+        setup(
+            "csmlog_tcp_logging_test", udpLogging=UDP_LOGGING_TCP, tcpBlockSeconds=0.5
+        )
+        try:
+            handlers = [
+                h
+                for h in getCSMLogger().parentLogger.handlers
+                if isinstance(h, TcpHandler)
+            ]
+            assert len(handlers) == 1
+            assert handlers[0].blockSeconds == 0.5
+            getCSMLogger().getLogger("child").info("over tcp")
+            assert handlers[0].flush()
+        finally:
+            close()
+
+        assert receiver.getBuffer().endswith("over tcp\n")
+    finally:
+        _stop(receiver, thread)
+
+
+class _CountingUdpReceiver(UdpHandlerReceiver):
+    def __init__(self, *args, **kwargs):
+        UdpHandlerReceiver.__init__(self, *args, bufferMaxSize=1, **kwargs)
+        self.receivedBytes = 0
+
+    def _writeMessages(self, messages):
+        self.receivedBytes += sum(len(message) for source, message in messages)
+
+
+class _CountingTcpReceiver(TcpHandlerReceiver):
+    def __init__(self, *args, **kwargs):
+        TcpHandlerReceiver.__init__(self, *args, bufferMaxSize=1, **kwargs)
+        self.receivedBytes = 0
+
+    def _writeMessages(self, messages):
+        self.receivedBytes += sum(len(message) for source, message in messages)
+
+
+def _measure(receiver, makeHandler, name):
+    """returns (records/s until everything that will arrive has, records received)"""
+    thread = _start(receiver)
+    handler = makeHandler(receiver.socket.getsockname()[1])
+    logger = _make_logger(handler, name)
+    record = "x" * 100
+    try:
+        start = time.perf_counter()
+        for i in range(BENCHMARK_RECORD_COUNT):
+            logger.info(record)
+        handler.flush()
+
+        # udp doesn't know when it is done... wait for it to stop coming in
+        lastReceived = -1
+        while receiver.receivedBytes != lastReceived:
+            lastReceived = receiver.receivedBytes
+            time.sleep(0.05)
+
+        received = receiver.receivedBytes // (len(record) + 1)
+        return received / (time.perf_counter() - start), received
+    finally:
+        handler.close()
+        _stop(receiver, thread)
+
+
+@pytest.mark.benchmark
+def test_tcp_benchmark():
+    udpRate, udpReceived = _measure(
+        _CountingUdpReceiver(port=0),
+        lambda port: UdpHandler(port=port),
+        "csmlog_tcp_benchmark_udp",
+    )
+    tcpRate, tcpReceived = _measure(
+        _CountingTcpReceiver(port=0),
+        lambda port: TcpHandler(port=port),
+        "csmlog_tcp_benchmark_tcp",
+    )
+
+    print(
+        "%d records of 100 bytes. udp: %d received, %d records/s. tcp: %d received, %d records/s"
+        % (BENCHMARK_RECORD_COUNT, udpReceived, udpRate, tcpReceived, tcpRate)
+    )
+    assert tcpReceived == BENCHMARK_RECORD_COUNT
@@ -0,0 +1,227 @@
+import gc
+import logging
+import os
+import pathlib
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from csmlog.log_splitter import getLogFileWithBackups
+from csmlog.udp_aggregator import UdpAggregator
+from csmlog.udp_handler import UdpHandler
+
+BENCHMARK_LINE_COUNT = 200000
+BENCHMARK_SOURCE_COUNT = 10
+BENCHMARK_MAX_DATAGRAM_SIZE = 1472
+
+# the benchmark sends at most this many datagrams more than the aggregator has written
+BENCHMARK_DATAGRAMS_AHEAD = 64
+
+# lines per second the aggregator should receive and write (through its socket)
+BENCHMARK_TARGET_LINES_PER_SECOND = 100000
+
+
+def test_udp_aggregator_files_per_source(tmp_path):
+    aggregator = UdpAggregator(
+        str(tmp_path / "logs"), port=0, receiveBufferSize=1024 * 1024
+    )
+    thread = threading.Thread(target=aggregator.recieveForever)
+    thread.start()
+
+    senders = []
+    handler = None
+    try:
+        assert aggregator.bound.wait(5)
+        port = aggregator.socket.getsockname()[1]
+
+        senders = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for i in range(3)]
+        for sender in senders:
+            sender.bind(("127.0.0.1", 0))
+        senderPorts = [sender.getsockname()[1] for sender in senders]
+        for line in range(100):
+            for index, sender in enumerate(senders):
+                sender.sendto(
+                    b"sender %d line %d\n" % (index, line), ("127.0.0.1", port)
+                )
+
+            # don't overflow the socket's receive buffer
+            if line % 20 == 19:
+                time.sleep(0.01)
+
+        handler = UdpHandler(port=port, maxDatagramSize=100, framed=True)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger = logging.getLogger("csmlog_udp_aggregator_test")
+        logger.propagate = False
+        logger.handlers = [handler]
+        logger.warning("☃" * 100)
+
+        for i in range(50):
+            if len(aggregator.getSourceFiles()) == 4:
+                break
+            time.sleep(0.1)
+    finally:
+        for sender in senders:
+            sender.close()
+        if handler:
+            handler.close()
+        aggregator.requestStop()
+        thread.join()
+
+    files = aggregator.getSourceFiles()
+    for index, senderPort in enumerate(senderPorts):
+        path = files[("127.0.0.1", senderPort)]
+        assert os.path.basename(path) == "127.0.0.1_%d.log" % senderPort
+        assert pathlib.Path(path).read_bytes() == b"".join(
+            b"sender %d line %d\n" % (index, line) for line in range(100)
+        )
+
+    path = files[handler.senderId]
+    assert os.path.basename(path) == "127.0.0.1_%016x.log" % handler.senderId
+    assert pathlib.Path(path).read_text(encoding="utf-8") == "☃" * 100 + "\n"
+
+
+def test_udp_aggregator_rotates(tmp_path):
+    aggregator = UdpAggregator(str(tmp_path), port=0, maxBytes=100, backupCount=100)
+    address = ("10.0.0.1", 1234)
+    lines = [b"line %d\n" % i for i in range(100)]
+    for line in lines:
+        aggregator._handleDatagram(line, address)
+    aggregator.close()
+
+    files = getLogFileWithBackups(aggregator.getSourceFiles()[address])
+    assert len(files) > 5
+    assert all(os.path.getsize(f) <= 100 for f in files)
+    assert b"".join(pathlib.Path(f).read_bytes() for f in files) == b"".join(lines)
+
+
+def test_udp_aggregator_forgets_idle_sources(tmp_path):
+    aggregator = UdpAggregator(str(tmp_path), port=0, maxSources=2)
+    addresses = [("10.0.0.1", port) for port in range(1000, 1005)]
+    for address in addresses:
+        aggregator._handleDatagram(b"first %d\n" % address[1], address)
+
+    # like restarted senders: only the most recent ones are kept (and have a file open)
+    assert list(aggregator.getSourceFiles()) == addresses[-2:]
+    assert aggregator.expiredSources == 3
+    assert sum(f.stream is not None for f in aggregator._files.values()) == 2
+
+    # one that comes back appends to its file
+    aggregator._handleDatagram(b"again\n", addresses[0])
+    aggregator.close()
+    path = aggregator.getSourceFiles()[addresses[0]]
+    assert pathlib.Path(path).read_bytes() == b"first 1000\nagain\n"
+
+    aggregator = UdpAggregator(str(tmp_path), port=0, sourceTimeout=0)
+    aggregator._handleDatagram(b"idle\n", addresses[0])
+    assert aggregator.getSourceFiles() == {}
+    assert pathlib.Path(path).read_bytes() == b"first 1000\nagain\nidle\n"
+
+
+def _make_datagrams(lineCount, sourceCount):
+    """returns a list of (datagram, address) like UdpHandler would send them: full datagrams of whole lines"""
+    datagrams = []
+    batches = [bytearray() for i in range(sourceCount)]
+    for i in range(lineCount):
+        source = i % sourceCount
+        line = (
+            b"2021-01-01 00:00:00,000 - app.%d:123 - INFO - request %d took 0.25s\n"
+            % (
+                source,
+                i,
+            )
+        )
+        if len(batches[source]) + len(line) > BENCHMARK_MAX_DATAGRAM_SIZE:
+            datagrams.append((bytes(batches[source]), ("10.0.0.%d" % source, 5000)))
+            batches[source] = bytearray()
+        batches[source] += line
+
+    for source, batch in enumerate(batches):
+        if batch:
+            datagrams.append((bytes(batch), ("10.0.0.%d" % source, 5000)))
+    return datagrams
+
+
+class _CountingAggregator(UdpAggregator):
+    """lets a benchmark know how many datagrams it has written so far"""
+
+    def __init__(self, *args, **kwargs):
+        UdpAggregator.__init__(self, *args, **kwargs)
+        self.writtenDatagrams = 0
+        self.written = threading.Condition()
+
+    def _writeMessages(self, messages):
+        UdpAggregator._writeMessages(self, messages)
+        with self.written:
+            self.writtenDatagrams += len(messages)
+            self.written.notify_all()
+
+
+@pytest.mark.benchmark
+def test_udp_aggregator_benchmark(tmp_path):
+    datagrams = _make_datagrams(BENCHMARK_LINE_COUNT, BENCHMARK_SOURCE_COUNT)
+    aggregator = _CountingAggregator(
+        str(tmp_path),
+        port=0,
+        maxBytes=4 * 1024 * 1024,
+        receiveBufferSize=4 * 1024 * 1024,
+    )
+    thread = threading.Thread(target=aggregator.recieveForever)
+    thread.start()
+
+    senders = {}
+    try:
+        assert aggregator.bound.wait(5)
+        destination = ("127.0.0.1", aggregator.socket.getsockname()[1])
+        for datagram, address in datagrams:
+            if address not in senders:
+                senders[address] = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        # through the socket, like from real senders. Only so many are sent ahead of what has been written,
+        #   so none are dropped for a full receive buffer.
+        gc.disable()
+        start = time.perf_counter()
+        for index, (datagram, address) in enumerate(datagrams):
+            if index % BENCHMARK_DATAGRAMS_AHEAD == 0:
+                with aggregator.written:
+                    while (
+                        aggregator.writtenDatagrams < index - BENCHMARK_DATAGRAMS_AHEAD
+                    ):
+                        assert aggregator.written.wait(5)
+            senders[address].sendto(datagram, destination)
+
+        with aggregator.written:
+            while aggregator.writtenDatagrams < len(datagrams):
+                assert aggregator.written.wait(5)
+        elapsed = time.perf_counter() - start
+    finally:
+        gc.enable()
+        for sender in senders.values():
+            sender.close()
+        aggregator.requestStop()
+        thread.join()
+
+    written = sum(
+        os.path.getsize(f)
+        for path in aggregator.getSourceFiles().values()
+        for f in getLogFileWithBackups(path)
+    )
+    assert written == sum(len(d) for d, address in datagrams)
+
+    linesPerSecond = BENCHMARK_LINE_COUNT / elapsed
+    print(
+        "%d lines (%d datagrams) from %d sources received and written in %.3fs: %d lines/s, %.1f MB/s"
+        % (
+            BENCHMARK_LINE_COUNT,
+            len(datagrams),
+            BENCHMARK_SOURCE_COUNT,
+            elapsed,
+            linesPerSecond,
+            written / elapsed / 1024 / 1024,
+        )
+    )
+    assert linesPerSecond >= BENCHMARK_TARGET_LINES_PER_SECOND
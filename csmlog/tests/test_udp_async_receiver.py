@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import os
+import socket
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from csmlog.udp_async_receiver import AsyncUdpHandlerReceiver
+from csmlog.udp_handler import UdpHandler
+
+
+async def _take(subscription, count):
+    lines = []
+    async for line in subscription:
+        lines.append(line)
+        if len(lines) == count:
+            break
+    return lines
+
+
+def test_async_receiver_subscribers():
+    async def run():
+        async with AsyncUdpHandlerReceiver(port=0) as receiver:
+            first = receiver.subscribe()
+            second = receiver.subscribe()
+
+            sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                sender.sendto(b"one\ntwo\n", receiver.boundAddress)
+
+                # a line split over datagrams is put back together
+                sender.sendto(b"thr", receiver.boundAddress)
+                sender.sendto("ee ☃\n".encode(), receiver.boundAddress)
+            finally:
+                sender.close()
+
+            expected = ["one", "two", "three ☃"]
+            assert await asyncio.wait_for(_take(first, 3), 5) == expected
+            assert await asyncio.wait_for(_take(second, 3), 5) == expected
+
+            # closing the receiver ends the subscriptions
+            third = receiver.subscribe()
+        assert [line async for line in third] == []
+
+    asyncio.run(run())
+
+
+def test_async_receiver_slow_subscriber_drops_oldest():
+    async def run():
+        async with AsyncUdpHandlerReceiver(port=0) as receiver:
+            slow = receiver.subscribe(maxSize=10)
+
+            async with receiver.subscribe() as fast:
+                for i in range(100):
+                    receiver._handleDatagram(b"line %d\n" % i, None)
+
+                assert await _take(fast, 100) == ["line %d" % i for i in range(100)]
+
+            assert slow.droppedLines == 90
+            assert await _take(slow, 10) == ["line %d" % i for i in range(90, 100)]
+            assert fast.droppedLines == 0
+
+    asyncio.run(run())
+
+
+def test_async_receiver_framed_udp_handler():
+    async def run():
+        async with AsyncUdpHandlerReceiver(port=0) as receiver:
+            handler = UdpHandler(
+                port=receiver.boundAddress[1], maxDatagramSize=100, framed=True
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger = logging.getLogger("csmlog_udp_async_test")
+            logger.propagate = False
+            logger.handlers = [handler]
+
+            async def consume():
+                # async for over the receiver subscribes to it
+                lines = []
+                async for line in receiver:
+                    lines.append(line)
+                    if len(lines) == 2:
+                        return lines
+
+            consumer = asyncio.ensure_future(consume())
+            await asyncio.sleep(0)
+            try:
+                logger.warning("☃" * 1000)
+                logger.warning("small")
+            finally:
+                handler.close()
+
+            assert await asyncio.wait_for(consumer, 5) == ["☃" * 1000, "small"]
+            stats = receiver.getSenderStats()[handler.senderId]
+            assert stats["receivedMessages"] == 2
+            assert stats["dropRate"] == 0
+
+    asyncio.run(run())
+
+
+def test_async_receiver_subscriptions_end_cleanly():
+    async def run():
+        async with AsyncUdpHandlerReceiver(port=0) as receiver:
+            # closing with a full queue doesn't drop a line to make room for the end
+            subscription = receiver.subscribe(maxSize=3)
+            for i in range(3):
+                receiver._handleDatagram(b"line %d\n" % i, None)
+            subscription.close()
+            assert [line async for line in subscription] == [
+                "line 0",
+                "line 1",
+                "line 2",
+            ]
+            assert subscription.droppedLines == 0
+
+            # breaking out of async for over the receiver closes its subscription
+            async def takeOne():
+                async for line in receiver:
+                    return line
+
+            consumer = asyncio.ensure_future(takeOne())
+            await asyncio.sleep(0)
+            assert len(receiver._subscriptions) == 1
+            receiver._handleDatagram(b"only\n", None)
+            assert await asyncio.wait_for(consumer, 5) == "only"
+
+            for i in range(100):
+                if not receiver._subscriptions:
+                    break
+                await asyncio.sleep(0.01)
+            assert receiver._subscriptions == []
+
+    asyncio.run(run())
+
+
+def test_async_receiver_forgets_unfinished_lines():
+    async def run():
+        async with AsyncUdpHandlerReceiver(port=0) as receiver:
+            receiver._reassembler.maxSenders = 2
+            subscription = receiver.subscribe()
+            for port in range(3):
+                receiver._handleDatagram(b"unfinished %d" % port, ("10.0.0.1", port))
+
+            # the oldest sender's line is given out as is
+            assert list(receiver._partialLines) == [("10.0.0.1", 1), ("10.0.0.1", 2)]
+            assert await asyncio.wait_for(subscription.get(), 5) == "unfinished 0"
+
+            receiver._handleDatagram(b" line\n", ("10.0.0.1", 2))
+            assert await asyncio.wait_for(subscription.get(), 5) == "unfinished 2 line"
+
+    asyncio.run(run())
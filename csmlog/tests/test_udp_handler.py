@@ -0,0 +1,644 @@
+import logging
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from conftest import close, getCSMLogger, setup
+
+from csmlog.udp_framing import MAX_SEQUENCE, FrameReassembler, packFrames
+from csmlog.udp_handler import (
+    DEFAULT_UNIX_MAX_DATAGRAM_SIZE,
+    UDP_LOGGING_UNIX,
+    UdpHandler,
+    getUnixSocketPath,
+)
+from csmlog.udp_handler_receiver import UdpHandlerReceiver
+
+
+@pytest.fixture
+def receiving_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(5)
+    try:
+        yield sock
+    finally:
+        sock.close()
+
+
+def _make_logger(handler, name):
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger = logging.getLogger(name)
+    logger.setLevel(1)
+    logger.propagate = False
+    logger.handlers = [handler]
+    return logger
+
+
+def _receive_all(sock, timeout=0.5):
+    """returns the datagrams received until nothing comes in for timeout seconds"""
+    datagrams = []
+    sock.settimeout(timeout)
+    while True:
+        try:
+            datagrams.append(sock.recv(65535))
+        except socket.timeout:
+            return datagrams
+
+
+def test_udp_handler_batches_records(receiving_socket):
+    handler = UdpHandler(port=receiving_socket.getsockname()[1], lingerSeconds=10)
+    logger = _make_logger(handler, "csmlog_udp_batch_test")
+    try:
+        for i in range(1000):
+            logger.info("record %d", i)
+        handler.flush()
+
+        datagrams = _receive_all(receiving_socket)
+        assert b"".join(datagrams).decode() == "".join(
+            "record %d\n" % i for i in range(1000)
+        )
+        assert all(len(d) <= handler.maxDatagramSize for d in datagrams)
+
+        # at least an order of magnitude less sends than records
+        assert len(datagrams) == handler.sentDatagrams
+        assert handler.sentDatagrams * 10 <= handler.sentRecords == 1000
+    finally:
+        handler.close()
+
+
+def test_udp_handler_flush_level_and_linger(receiving_socket):
+    handler = UdpHandler(port=receiving_socket.getsockname()[1], lingerSeconds=0.2)
+    logger = _make_logger(handler, "csmlog_udp_linger_test")
+    try:
+        # sent along with the warning, right away
+        logger.info("info")
+        logger.warning("warning")
+        receiving_socket.settimeout(0.1)
+        assert receiving_socket.recv(65535) == b"info\nwarning\n"
+
+        # sent once the linger time is up
+        start = time.monotonic()
+        logger.info("lingering")
+        receiving_socket.settimeout(5)
+        assert receiving_socket.recv(65535) == b"lingering\n"
+        assert time.monotonic() - start >= 0.15
+    finally:
+        handler.close()
+
+
+def test_udp_handler_large_records_and_no_linger(receiving_socket):
+    handler = UdpHandler(
+        port=receiving_socket.getsockname()[1], maxDatagramSize=100, lingerSeconds=0
+    )
+    logger = _make_logger(handler, "csmlog_udp_large_test")
+    try:
+        logger.info("small")
+        logger.info("x" * 250)
+
+        assert _receive_all(receiving_socket) == [
+            b"small\n",
+            b"x" * 100,
+            b"x" * 100,
+            b"x" * 50 + b"\n",
+        ]
+    finally:
+        handler.close()
+
+
+def test_udp_handler_close_sends_batch(receiving_socket):
+    handler = UdpHandler(port=receiving_socket.getsockname()[1], lingerSeconds=10)
+    logger = _make_logger(handler, "csmlog_udp_close_test")
+    logger.info("sent on close")
+    handler.close()
+
+    assert receiving_socket.recv(65535) == b"sent on close\n"
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork()")
+def test_udp_handler_lingers_after_fork(receiving_socket):
+    handler = UdpHandler(port=receiving_socket.getsockname()[1], lingerSeconds=0.1)
+    logger = _make_logger(handler, "csmlog_udp_fork_test")
+    try:
+        # starts the linger thread
+        logger.info("in parent")
+        assert receiving_socket.recv(65535) == b"in parent\n"
+
+        pid = os.fork()
+        if pid == 0:
+            # child: only the linger thread sends this (it isn't flushed)
+            try:
+                logger.info("in child")
+                time.sleep(1)
+            finally:
+                os._exit(0)
+
+        assert os.waitpid(pid, 0)[1] == 0
+        assert receiving_socket.recv(65535) == b"in child\n"
+    finally:
+        handler.close()
+
+
+def test_frame_reassembler_puts_messages_back_together():
+    message = ("snowman ☃ " * 50).encode()
+    datagrams = packFrames(1234, 0, message, 64)
+    assert len(datagrams) > 10
+    assert all(len(d) <= 64 for d in datagrams)
+
+    # out of order, with a duplicate
+    reassembler = FrameReassembler()
+    received = []
+    for datagram in datagrams[::-1] + datagrams[:1]:
+        received.extend(reassembler.feed(datagram, ("127.0.0.1", 1)))
+
+    assert received == [message]
+    assert received[0].decode() == message.decode()
+
+    # not framed: passed through
+    assert reassembler.feed(b"raw text\n") == [b"raw text\n"]
+
+    stats = reassembler.getSenderStats()[1234]
+    assert stats["receivedMessages"] == 1
+    assert stats["lostMessages"] == 0
+    assert stats["dropRate"] == 0
+
+
+def test_frame_reassembler_counts_lost_messages():
+    reassembler = FrameReassembler(reassemblyTimeout=1)
+
+    def feed(sequence, payload, now=0, maxDatagramSize=100):
+        received = []
+        for datagram in packFrames(7, sequence, payload, maxDatagramSize):
+            received.extend(reassembler.feed(datagram, now=now))
+        return received
+
+    assert feed(0, b"zero") == [b"zero"]
+
+    # 1 and 2 are skipped... lost unless they show up late
+    assert feed(3, b"three") == [b"three"]
+    assert reassembler.getSenderStats()[7]["lostMessages"] == 2
+    assert feed(1, b"one") == [b"one"]
+    assert reassembler.getSenderStats()[7]["lostMessages"] == 1
+
+    # only the first fragment of 4 shows up, it is given up on after the timeout
+    firstFragment = packFrames(7, 4, b"x" * 200, 100)[0]
+    assert reassembler.feed(firstFragment, now=0) == []
+    assert reassembler.getSenderStats()[7]["pendingMessages"] == 1
+    assert feed(5, b"five", now=2) == [b"five"]
+
+    stats = reassembler.getSenderStats()[7]
+    assert stats["pendingMessages"] == 0
+    assert stats["receivedMessages"] == 4
+    assert stats["lostMessages"] == 2
+    assert stats["dropRate"] == 2 / 6
+
+    # sequence numbers wrap around
+    reassembler = FrameReassembler()
+    assert feed(MAX_SEQUENCE - 1, b"almost last") == [b"almost last"]
+    assert feed(MAX_SEQUENCE, b"last") == [b"last"]
+    assert feed(0, b"wrapped") == [b"wrapped"]
+    assert reassembler.getSenderStats()[7]["lostMessages"] == 0
+
+
+def test_frame_reassembler_forgets_idle_senders():
+    reassembler = FrameReassembler(senderTimeout=10, maxSenders=3)
+
+    def feed(senderId, now):
+        # the first fragment of a message, so there is something pending to forget too
+        reassembler.feed(packFrames(senderId, 0, b"x" * 200, 100)[0], now=now)
+
+    feed(1, now=0)
+    feed(2, now=5)
+    feed(1, now=8)
+    assert sorted(reassembler.getSenderStats()) == [1, 2]
+
+    # 2 was heard from least recently, and is idle for too long
+    feed(3, now=16)
+    assert sorted(reassembler.getSenderStats()) == [1, 3]
+    assert reassembler.expiredSenders == 1
+
+    # too many senders: the one heard from least recently goes first
+    feed(4, now=17)
+    feed(5, now=17)
+    assert sorted(reassembler.getSenderStats()) == [3, 4, 5]
+    assert reassembler.expiredSenders == 2
+
+
+def test_framed_udp_handler_to_receiver():
+    receiver = UdpHandlerReceiver(port=0)
+    thread = threading.Thread(target=receiver.recieveForever)
+    thread.start()
+
+    handler = None
+    try:
+        for i in range(100):
+            sock = getattr(receiver, "socket", None)
+            if sock is not None and sock.getsockname()[1] != 0:
+                break
+            time.sleep(0.01)
+
+        handler = UdpHandler(
+            port=receiver.socket.getsockname()[1], maxDatagramSize=100, framed=True
+        )
+        logger = _make_logger(handler, "csmlog_udp_framed_test")
+        logger.info("☃" * 1000)
+        logger.info("small")
+        handler.flush()
+
+        expected = "☃" * 1000 + "\nsmall\n"
+        for i in range(50):
+            if receiver.getBuffer() == expected:
+                break
+            time.sleep(0.1)
+        assert receiver.getBuffer() == expected
+
+        stats = receiver.getSenderStats()[handler.senderId]
+        assert stats["receivedMessages"] == 2
+        assert stats["dropRate"] == 0
+    finally:
+        if handler:
+            handler.close()
+        receiver.requestStop()
+        thread.join()
+
+
+def test_non_blocking_udp_handler(receiving_socket):
+    handler = UdpHandler(port=receiving_socket.getsockname()[1], nonBlocking=True)
+    logger = _make_logger(handler, "csmlog_udp_non_blocking_test")
+    try:
+        for i in range(1000):
+            logger.info("record %d", i)
+        handler.flush()
+
+        assert b"".join(_receive_all(receiving_socket)).decode() == "".join(
+            "record %d\n" % i for i in range(1000)
+        )
+        assert handler.sentRecords == 1000
+        assert handler.droppedRecords == 0
+    finally:
+        handler.close()
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork()")
+def test_non_blocking_udp_handler_after_fork(receiving_socket):
+    handler = UdpHandler(port=receiving_socket.getsockname()[1], nonBlocking=True)
+    logger = _make_logger(handler, "csmlog_udp_non_blocking_fork_test")
+    try:
+        logger.info("in parent")
+        handler.flush()
+        assert receiving_socket.recv(65535) == b"in parent\n"
+
+        pid = os.fork()
+        if pid == 0:
+            # child: flush() would wait forever without a sender thread
+            exitCode = 1
+            try:
+                import signal
+
+                signal.alarm(10)
+                logger.info("in child")
+                handler.flush()
+                if handler.sentRecords == 2:
+                    exitCode = 0
+            finally:
+                os._exit(exitCode)
+
+        assert os.waitpid(pid, 0)[1] == 0
+        assert receiving_socket.recv(65535) == b"in child\n"
+
+        # the parent's sender thread is unaffected
+        logger.info("in parent again")
+        handler.flush()
+        assert receiving_socket.recv(65535) == b"in parent again\n"
+    finally:
+        handler.close()
+
+
+def test_non_blocking_udp_handler_drops_instead_of_blocking(receiving_socket):
+    handler = UdpHandler(
+        port=receiving_socket.getsockname()[1],
+        nonBlocking=True,
+        sendQueueMaxSize=10,
+        lingerSeconds=0,
+    )
+    logger = _make_logger(handler, "csmlog_udp_stuck_test")
+
+    # the sender thread gets stuck sending the first datagram
+    stuck = threading.Event()
+    unstuck = threading.Event()
+    realSendDatagram = handler._sendDatagram
+
+    def stuckSendDatagram(data):
+        stuck.set()
+        unstuck.wait()
+        return realSendDatagram(data)
+
+    handler._sendDatagram = stuckSendDatagram
+    try:
+        logger.info("first")
+        assert stuck.wait(5)
+
+        start = time.monotonic()
+        for i in range(1000):
+            logger.info("record %d", i)
+        assert time.monotonic() - start < 5
+
+        assert handler.droppedRecords == 990
+    finally:
+        unstuck.set()
+        handler.flush()
+        handler.close()
+
+    assert handler.sentRecords == 11
+    assert len(_receive_all(receiving_socket)) == 11
+
+
+def test_non_blocking_udp_handler_drops_on_full_socket_buffer(receiving_socket):
+    class FullSocket(object):
+        def sendto(self, data, address):
+            raise BlockingIOError()
+
+        def close(self):
+            pass
+
+    handler = UdpHandler(port=receiving_socket.getsockname()[1], nonBlocking=True)
+    handler.socket.close()
+    handler.socket = FullSocket()
+    logger = _make_logger(handler, "csmlog_udp_full_socket_test")
+    try:
+        for i in range(100):
+            logger.info("record %d", i)
+        handler.flush()
+
+        assert handler.droppedRecords == 100
+        assert handler.droppedDatagrams == 1
+        assert handler.sentRecords == handler.sentDatagrams == 0
+    finally:
+        handler.close()
+
+
+def test_csmlogger_udp_non_blocking():
+    setup("csmlog_udp_test", udpNonBlocking=True)
+    try:
+        handlers = [
+            h for h in getCSMLogger().parentLogger.handlers if isinstance(h, UdpHandler)
+        ]
+        assert len(handlers) == 1
+        assert handlers[0].nonBlocking
+    finally:
+        close()
+
+
+class _WaitingReceiver(UdpHandlerReceiver):
+    """counts received bytes (instead of printing them), setting an event once enough have come in"""
+
+    def __init__(self, *args, **kwargs):
+        UdpHandlerReceiver.__init__(self, *args, bufferMaxSize=1, **kwargs)
+        self.receivedBytes = 0
+        self.waitForBytes = None
+        self.received = threading.Event()
+
+    def _writeMessages(self, messages):
+        self.receivedBytes += sum(len(message) for source, message in messages)
+        if self.waitForBytes is not None and self.receivedBytes >= self.waitForBytes:
+            self.received.set()
+
+
+_needsUnixSockets = pytest.mark.skipif(
+    not hasattr(socket, "AF_UNIX"), reason="needs unix sockets"
+)
+
+
+def _startReceiver(receiver):
+    thread = threading.Thread(target=receiver.recieveForever)
+    thread.start()
+    assert receiver.bound.wait(5)
+    return thread
+
+
+@_needsUnixSockets
+def test_unix_udp_handler_to_receiver(tmp_path):
+    path = str(tmp_path / "live.sock")
+    receiver = UdpHandlerReceiver(unixSocketPath=path)
+    thread = _startReceiver(receiver)
+
+    handler = UdpHandler(unixSocketPath=path, framed=True)
+    try:
+        assert handler.maxDatagramSize == DEFAULT_UNIX_MAX_DATAGRAM_SIZE
+        assert repr(handler) == "<UdpHandler unix:%s>" % path
+
+        logger = _make_logger(handler, "csmlog_unix_test")
+        for i in range(5):
+            logger.info("record %d", i)
+        logger.info("☃" * 10000)
+        handler.flush()
+
+        expected = "".join("record %d\n" % i for i in range(5)) + "☃" * 10000 + "\n"
+        for i in range(50):
+            if receiver.getBuffer() == expected:
+                break
+            time.sleep(0.1)
+        assert receiver.getBuffer() == expected
+
+        # sent as 1 datagram instead of ~25 (on Linux, where unix datagrams can be that big)
+        if DEFAULT_UNIX_MAX_DATAGRAM_SIZE > len(expected.encode()):
+            assert handler.sentDatagrams == 1
+        assert receiver.getSenderStats()[handler.senderId]["dropRate"] == 0
+    finally:
+        handler.close()
+        receiver.requestStop()
+        thread.join()
+
+    # cleaned up after itself
+    assert not os.path.exists(path)
+
+
+@_needsUnixSockets
+def test_unix_udp_handler_drops_without_receiver(tmp_path):
+    path = str(tmp_path / "live.sock")
+    handler = UdpHandler(unixSocketPath=path, lingerSeconds=0)
+    logger = _make_logger(handler, "csmlog_unix_no_receiver_test")
+    try:
+        # nothing bound to the path
+        logger.info("nobody is listening")
+
+        # a socket file left behind by a receiver that is gone
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        stale.bind(path)
+        stale.close()
+        logger.info("still nobody")
+
+        assert handler.droppedRecords == handler.droppedDatagrams == 2
+        assert handler.sentRecords == 0
+    finally:
+        handler.close()
+
+    # the next receiver replaces the leftover socket file
+    receiver = UdpHandlerReceiver(unixSocketPath=path)
+    thread = _startReceiver(receiver)
+    try:
+        handler = UdpHandler(unixSocketPath=path, lingerSeconds=0)
+        logger = _make_logger(handler, "csmlog_unix_replaced_test")
+        logger.info("listening again")
+        handler.close()
+
+        for i in range(50):
+            if receiver.getBuffer():
+                break
+            time.sleep(0.1)
+        assert receiver.getBuffer() == "listening again\n"
+    finally:
+        receiver.requestStop()
+        thread.join()
+
+
+@_needsUnixSockets
+def test_unix_udp_handler_drops_too_big_datagrams(tmp_path):
+    path = str(tmp_path / "live.sock")
+    receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    receiver.bind(path)
+    receiver.settimeout(5)
+
+    # bigger than any platform lets a unix datagram be
+    handler = UdpHandler(unixSocketPath=path, maxDatagramSize=16 * 1024 * 1024)
+    logger = _make_logger(handler, "csmlog_unix_too_big_test")
+    try:
+        logger.warning("x" * (8 * 1024 * 1024))
+        logger.warning("fits")
+
+        assert handler.droppedRecords == 1
+        assert handler.sentRecords == 1
+        assert receiver.recv(65535) == b"fits\n"
+    finally:
+        handler.close()
+        receiver.close()
+
+
+@_needsUnixSockets
+def test_unix_udp_handler_drops_instead_of_blocking(tmp_path):
+    path = str(tmp_path / "live.sock")
+
+    # bound, but never receives
+    stuck = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    stuck.bind(path)
+
+    handler = UdpHandler(unixSocketPath=path, lingerSeconds=0)
+    logger = _make_logger(handler, "csmlog_unix_stuck_test")
+    try:
+        start = time.monotonic()
+        for i in range(1000):
+            logger.info("record %d", i)
+        assert time.monotonic() - start < 5
+
+        assert handler.sentRecords > 0
+        assert handler.droppedRecords > 0
+        assert handler.sentRecords + handler.droppedRecords == 1000
+    finally:
+        handler.close()
+        stuck.close()
+
+
+@_needsUnixSockets
+def test_csmlogger_udp_logging_unix():
+    setup("csmlog_udp_unix_test", udpLogging=UDP_LOGGING_UNIX)
+    try:
+        handlers = [
+            h for h in getCSMLogger().parentLogger.handlers if isinstance(h, UdpHandler)
+        ]
+        assert len(handlers) == 1
+        assert handlers[0].unixSocketPath == getUnixSocketPath("csmlog_udp_unix_test")
+    finally:
+        close()
+
+    with pytest.raises(ValueError):
+        setup("csmlog_udp_unix_test", udpLogging="carrier pigeon")
+
+
+BENCHMARK_RECORD_COUNT = 20000
+BENCHMARK_ROUND_TRIPS = 200
+
+
+def _measureTransport(name, **kwargs):
+    """
+    returns (records/s received, datagrams sent for them, median seconds from logging a warning to receiving it,
+        dropped records)
+    """
+    receiver = _WaitingReceiver(receiveBufferSize=4 * 1024 * 1024, **kwargs)
+    thread = _startReceiver(receiver)
+    handler = UdpHandler(nonBlocking=True, **kwargs)
+    if "port" in kwargs:
+        handler.port = receiver.socket.getsockname()[1]
+        handler._address = (handler.ip, handler.port)
+
+    logger = _make_logger(handler, name)
+    try:
+        record = "x" * 100
+        recordBytes = len(record) + 1
+
+        start = time.perf_counter()
+        for i in range(BENCHMARK_RECORD_COUNT):
+            logger.info(record)
+            if i % 1000 == 999:
+                # a burst at a time, like a busy app
+                handler.flush()
+        handler.flush()
+
+        # everything that wasn't dropped
+        receiver.waitForBytes = handler.sentRecords * recordBytes
+        if receiver.receivedBytes < receiver.waitForBytes:
+            receiver.received.wait(10)
+        rate = (receiver.receivedBytes // recordBytes) / (time.perf_counter() - start)
+        datagrams = handler.sentDatagrams
+
+        latencies = []
+        for i in range(BENCHMARK_ROUND_TRIPS):
+            receiver.received.clear()
+            receiver.waitForBytes = receiver.receivedBytes + recordBytes
+            start = time.perf_counter()
+            logger.warning(record)
+            if receiver.received.wait(1):
+                latencies.append(time.perf_counter() - start)
+
+        return rate, datagrams, statistics.median(latencies), handler.droppedRecords
+    finally:
+        handler.close()
+        receiver.requestStop()
+        thread.join()
+
+
+@pytest.mark.benchmark
+@_needsUnixSockets
+def test_unix_vs_udp_benchmark(tmp_path):
+    udpRate, udpDatagrams, udpLatency, udpDropped = _measureTransport(
+        "csmlog_udp_benchmark", port=0
+    )
+    unixRate, unixDatagrams, unixLatency, unixDropped = _measureTransport(
+        "csmlog_unix_benchmark", unixSocketPath=str(tmp_path / "live.sock")
+    )
+
+    print(
+        "%d records. udp: %d records/s in %d datagrams (%d dropped), %.1fus latency. "
+        "unix: %d records/s in %d datagrams (%d dropped), %.1fus latency"
+        % (
+            BENCHMARK_RECORD_COUNT,
+            udpRate,
+            udpDatagrams,
+            udpDropped,
+            udpLatency * 1e6,
+            unixRate,
+            unixDatagrams,
+            unixDropped,
+            unixLatency * 1e6,
+        )
+    )
+    assert unixRate > 0
+    assert udpRate > 0
+
+    # bigger datagrams... a fraction of the sends
+    assert unixDatagrams * 10 < udpDatagrams
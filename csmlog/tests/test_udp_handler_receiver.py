@@ -0,0 +1,286 @@
+import io
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from conftest import UdpHandlerReceiver
+
+from csmlog.udp_handler_receiver import MAX_UDP_PACKET_SIZE
+
+BENCHMARK_PACKET_COUNT = 20000
+IDLE_SECONDS = 0.5
+
+
+class _CountingReceiver(UdpHandlerReceiver):
+    """only counts datagrams, to time the receive loop itself"""
+
+    def __init__(self, *args, **kwargs):
+        UdpHandlerReceiver.__init__(self, *args, **kwargs)
+        self.datagrams = 0
+
+    def _handleDatagrams(self, datagrams):
+        self.datagrams += len(datagrams)
+
+
+class _PrintingReceiver(_CountingReceiver):
+    """counts datagrams, but also prints them like normal"""
+
+    def _handleDatagrams(self, datagrams):
+        _CountingReceiver._handleDatagrams(self, datagrams)
+        UdpHandlerReceiver._handleDatagrams(self, datagrams)
+
+
+class _OneAtATimeReceiver(_PrintingReceiver):
+    """receives and prints one datagram per wake up, like UdpHandlerReceiver used to"""
+
+    def _receiveBatch(self, buffer):
+        return UdpHandlerReceiver._receiveBatch(self, buffer[:MAX_UDP_PACKET_SIZE])
+
+
+class _CountingWriter(io.TextIOWrapper):
+    """a line buffered (like a console) text stream to /dev/null that counts writes"""
+
+    def __init__(self):
+        io.TextIOWrapper.__init__(
+            self, open(os.devnull, "wb"), encoding="utf-8", line_buffering=True
+        )
+        self.writes = 0
+        self.text = []
+
+    def write(self, text):
+        self.writes += 1
+        self.text.append(text)
+        return io.TextIOWrapper.write(self, text)
+
+
+class _SpinningReceiver(object):
+    """the receive loop UdpHandlerReceiver used to have (non-blocking recv in a loop), for comparison"""
+
+    def __init__(self, port):
+        self.port = port
+        self.datagrams = 0
+        self._lock = threading.Lock()
+        self._stop = False
+        self.socket = None
+
+    def requestStop(self):
+        with self._lock:
+            self._stop = True
+
+    def shouldStop(self):
+        with self._lock:
+            return self._stop
+
+    def recieveForever(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.socket.bind(("127.0.0.1", self.port))
+        try:
+            while not self.shouldStop():
+                try:
+                    data = self.socket.recv(65535)
+                except socket.error:
+                    continue
+
+                if len(data):
+                    self.datagrams += 1
+        finally:
+            self.socket.close()
+
+
+def _start(receiver):
+    thread = threading.Thread(target=receiver.recieveForever)
+    thread.start()
+
+    for i in range(500):
+        sock = getattr(receiver, "socket", None)
+        if sock is not None and sock.fileno() != -1 and sock.getsockname()[1] != 0:
+            break
+        time.sleep(0.01)
+
+    return thread, receiver.socket.getsockname()[1]
+
+
+def _measure(receiver, payload=b"x" * 100):
+    """returns (process cpu seconds used while idle, packets received per second)"""
+    thread, port = _start(receiver)
+    try:
+        start = time.process_time()
+        time.sleep(IDLE_SECONDS)
+        idleCpu = time.process_time() - start
+
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            start = time.perf_counter()
+            lastCount = -1
+            for i in range(BENCHMARK_PACKET_COUNT):
+                sender.sendto(payload, ("127.0.0.1", port))
+
+                # don't overflow the socket's receive buffer (unless some were dropped already)
+                if i % 100 == 99:
+                    deadline = time.perf_counter() + 1
+                    while (
+                        receiver.datagrams < i - 1000 and time.perf_counter() < deadline
+                    ):
+                        time.sleep(0.0001)
+
+            # wait for the stragglers (some may have been dropped by the kernel)
+            while receiver.datagrams != lastCount:
+                lastCount = receiver.datagrams
+                time.sleep(0.05)
+            elapsed = time.perf_counter() - start
+        finally:
+            sender.close()
+
+        return idleCpu, receiver.datagrams / elapsed
+    finally:
+        receiver.requestStop()
+        thread.join()
+
+
+def test_receiver_stops_right_away():
+    receiver = UdpHandlerReceiver(port=0)
+    thread, port = _start(receiver)
+
+    start = time.monotonic()
+    receiver.requestStop()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert time.monotonic() - start < 1
+
+    # stopping before starting
+    receiver = UdpHandlerReceiver(port=0)
+    receiver.requestStop()
+    receiver.recieveForever()
+
+
+def test_receiver_batch_stops_on_socket_error():
+    class _ResettingSocket(object):
+        """gives one datagram, then fails (like a connection reset on Windows) from then on"""
+
+        def __init__(self):
+            self.calls = 0
+
+        def recvfrom_into(self, buffer, size):
+            self.calls += 1
+            if self.calls > 1:
+                raise ConnectionResetError()
+            buffer[:3] = b"hi\n"
+            return 3, ("127.0.0.1", 1)
+
+    receiver = UdpHandlerReceiver(port=0)
+    receiver.socket = _ResettingSocket()
+    buffer = memoryview(bytearray(receiver.receiveBatchBytes))
+
+    # what was received before the error is kept, without trying again (and again)
+    datagrams = receiver._receiveBatch(buffer)
+    assert [bytes(d) for d, address in datagrams] == [b"hi\n"]
+    assert receiver.socket.calls == 2
+
+
+@pytest.mark.benchmark
+def test_receiver_benchmark():
+    spinIdleCpu, spinRate = _measure(_SpinningReceiver(port=0))
+    idleCpu, rate = _measure(_CountingReceiver(port=0))
+
+    print(
+        "idle for %.1fs: spinning loop used %.3fs of cpu, select loop used %.3fs of cpu. "
+        "packets/s: spinning loop: %d, select loop: %d"
+        % (IDLE_SECONDS, spinIdleCpu, idleCpu, spinRate, rate)
+    )
+    assert idleCpu < spinIdleCpu
+
+
+def test_receiver_buffer_history():
+    receiver = UdpHandlerReceiver(port=0, bufferMaxSize=19)
+    receiver._handleDatagram(b"one\ntwo\n", None)
+    assert receiver.getBuffer() == "one\ntwo\n"
+
+    text, seq = receiver.since()
+    assert (text, seq) == ("one\ntwo\n", 8)
+
+    receiver._handleDatagram("three ☃\nfour\n".encode(), None)
+    assert receiver.since(seq) == ("three ☃\nfour\n", 23)
+    assert receiver.getBuffer(lastN=2) == "three ☃\nfour\n"
+
+    # only the last 19 bytes are kept
+    assert receiver.getBuffer() == "two\nthree ☃\nfour\n"
+    assert receiver.since(0) == (receiver.getBuffer(), 23)
+
+    with receiver.bufferViews(since=seq) as views:
+        assert b"".join(views) == "three ☃\nfour\n".encode()
+
+
+def test_receiver_drains_socket_in_batches(monkeypatch):
+    writer = _CountingWriter()
+    monkeypatch.setattr(sys, "stdout", writer)
+
+    receiver = UdpHandlerReceiver(
+        port=0, bufferMaxSize=1024 * 1024, receiveBufferSize=1024 * 1024
+    )
+    thread, port = _start(receiver)
+    try:
+        assert receiver.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= min(
+            1024 * 1024, _maxReceiveBufferSize()
+        )
+
+        expected = "".join("datagram %d\n" % i for i in range(1000))
+
+        # everything is waiting on the socket by the time the receiver wakes up
+        with receiver.bufferViews():
+            sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                for i in range(1000):
+                    sender.sendto(b"datagram %d\n" % i, ("127.0.0.1", port))
+            finally:
+                sender.close()
+
+        for i in range(50):
+            if receiver.getBuffer() == expected:
+                break
+            time.sleep(0.1)
+        assert receiver.getBuffer() == expected
+    finally:
+        receiver.requestStop()
+        thread.join()
+        writer.close()
+
+    assert "".join(writer.text) == expected
+    assert writer.writes < 10
+
+
+def _maxReceiveBufferSize():
+    """the most SO_RCVBUF can be set to (doubled by the kernel), if it can be found"""
+    try:
+        with open("/proc/sys/net/core/rmem_max") as f:
+            return int(f.read()) * 2
+    except (OSError, ValueError):
+        return 0
+
+
+@pytest.mark.benchmark
+def test_receiver_batch_benchmark(monkeypatch):
+    writer = _CountingWriter()
+    monkeypatch.setattr(sys, "stdout", writer)
+    payload = b"x" * 100 + b"\n"
+    try:
+        oneIdleCpu, oneRate = _measure(_OneAtATimeReceiver(port=0), payload)
+        oneWrites = writer.writes
+
+        writer.writes = 0
+        idleCpu, rate = _measure(_PrintingReceiver(port=0), payload)
+        writes = writer.writes
+    finally:
+        monkeypatch.undo()
+        writer.close()
+
+    print(
+        "printing to a line buffered stream. one datagram at a time: %d packets/s, %d writes. "
+        "batched: %d packets/s, %d writes" % (oneRate, oneWrites, rate, writes)
+    )
+    assert writes < oneWrites
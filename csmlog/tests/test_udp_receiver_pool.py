@@ -0,0 +1,152 @@
+import io
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from csmlog.udp_handler import UdpHandler
+from csmlog.udp_receiver_pool import UdpReceiverPool
+
+pytestmark = pytest.mark.skipif(
+    not hasattr(socket, "SO_REUSEPORT"), reason="UdpReceiverPool needs SO_REUSEPORT"
+)
+
+SENDER_COUNT = 8
+LINES_PER_SENDER = 200
+
+
+class _CollectingStream(io.StringIO):
+    def __init__(self):
+        io.StringIO.__init__(self)
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        with self.lock:
+            return io.StringIO.write(self, text)
+
+
+def test_udp_receiver_pool(monkeypatch):
+    stream = _CollectingStream()
+    monkeypatch.setattr(sys, "stdout", stream)
+
+    pool = UdpReceiverPool(port=0, workers=2, receiveBufferSize=1024 * 1024)
+    thread = threading.Thread(target=pool.recieveForever)
+    thread.start()
+
+    senders = []
+    handler = None
+    try:
+        assert pool.ready.wait(30)
+        address = ("127.0.0.1", pool.boundPort)
+
+        # each sender socket is its own flow, so it sticks to one worker
+        senders = [
+            socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            for i in range(SENDER_COUNT)
+        ]
+        for line in range(LINES_PER_SENDER):
+            for index, sender in enumerate(senders):
+                sender.sendto(b"sender %d line %d\n" % (index, line), address)
+
+            # don't overflow the sockets' receive buffers
+            if line % 20 == 19:
+                time.sleep(0.01)
+
+        handler = UdpHandler(port=pool.boundPort, framed=True)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger = logging.getLogger("csmlog_udp_pool_test")
+        logger.propagate = False
+        logger.handlers = [handler]
+        logger.warning("framed")
+
+        expectedLines = SENDER_COUNT * LINES_PER_SENDER + 1
+        for i in range(100):
+            if stream.getvalue().count("\n") == expectedLines:
+                break
+            time.sleep(0.1)
+    finally:
+        for sender in senders:
+            sender.close()
+        if handler:
+            handler.close()
+        pool.requestStop()
+        thread.join()
+
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == expectedLines
+
+    # each sender's lines are in order
+    for index in range(SENDER_COUNT):
+        prefix = "sender %d " % index
+        assert [l for l in lines if l.startswith(prefix)] == [
+            prefix + "line %d" % line for line in range(LINES_PER_SENDER)
+        ]
+
+    # sender stats are collected from the workers
+    stats = pool.getSenderStats()[handler.senderId]
+    assert stats["receivedMessages"] == 1
+    assert stats["lostMessages"] == 0
+
+
+def test_udp_receiver_pool_output_dir(tmp_path):
+    pool = UdpReceiverPool(
+        port=0, workers=2, receiveBufferSize=1024 * 1024, outputDir=str(tmp_path)
+    )
+    thread = threading.Thread(target=pool.recieveForever)
+    thread.start()
+
+    senders = []
+    try:
+        assert pool.ready.wait(30)
+        address = ("127.0.0.1", pool.boundPort)
+
+        senders = [
+            socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            for i in range(SENDER_COUNT)
+        ]
+        for line in range(LINES_PER_SENDER):
+            for index, sender in enumerate(senders):
+                sender.sendto(b"sender %d line %d\n" % (index, line), address)
+
+            if line % 20 == 19:
+                time.sleep(0.01)
+        ports = [sender.getsockname()[1] for sender in senders]
+
+        expectedSize = sum(
+            len("sender %d line %d\n" % (index, line))
+            for index in range(SENDER_COUNT)
+            for line in range(LINES_PER_SENDER)
+        )
+        for i in range(100):
+            if sum(f.stat().st_size for f in tmp_path.iterdir()) == expectedSize:
+                break
+            time.sleep(0.1)
+    finally:
+        for sender in senders:
+            sender.close()
+        pool.requestStop()
+        thread.join()
+
+    # each worker wrote the files of its own senders
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        "127.0.0.1_%d.log" % port for port in ports
+    )
+    for index, port in enumerate(ports):
+        with open(os.path.join(tmp_path, "127.0.0.1_%d.log" % port)) as f:
+            assert f.read() == "".join(
+                "sender %d line %d\n" % (index, line)
+                for line in range(LINES_PER_SENDER)
+            )
+
+
+def test_udp_receiver_pool_stops_before_starting():
+    pool = UdpReceiverPool(port=0, workers=2)
+    pool.requestStop()
+    pool.recieveForever()
+    assert not pool.ready.is_set()
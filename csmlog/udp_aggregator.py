@@ -0,0 +1,292 @@
+"""
+This file is part of csmlog. Python logger setup... the way I like it.
+MIT License (2021) - Charles Machalow
+"""
+
+import collections
+import logging
+import logging.handlers
+import os
+import re
+import time
+
+from csmlog.rotating_file_handler import (
+    DEFAULT_BACKUP_COUNT,
+    DEFAULT_MAX_BYTES,
+    _RotationTrackingMixin,
+)
+from csmlog.tcp_handler_receiver import TcpHandlerReceiver
+from csmlog.udp_framing import DEFAULT_MAX_SENDERS, DEFAULT_SENDER_TIMEOUT_SECONDS
+from csmlog.udp_handler_receiver import UdpHandlerReceiver
+
+SOURCE_LOG_EXTENSION = ".log"
+
+# files for sources beyond this many are closed (least recently written first) and reopened when needed
+DEFAULT_MAX_OPEN_FILES = 256
+
+# each source file buffers this much before writing (a batch is committed at the end no matter what)
+_FILE_BUFFER_SIZE = 256 * 1024
+
+# characters that don't belong in a file name (like the ':' in an IPv6 address)
+_UNSAFE_FILE_NAME_CHARACTERS_REGEX = re.compile(r"[^\w.-]")
+
+
+class SourceLogFile(_RotationTrackingMixin, logging.handlers.RotatingFileHandler):
+    """
+    A rotating file of the raw bytes received from one source. Rotation (and backup naming) is the same as for
+        RotatingFileHandler, so getLogFileWithBackups() and RotatedBackupWorker work with these files too.
+    """
+
+    def __init__(
+        self, filename, maxBytes=DEFAULT_MAX_BYTES, backupCount=DEFAULT_BACKUP_COUNT
+    ):
+        logging.handlers.RotatingFileHandler.__init__(
+            self,
+            filename,
+            mode="ab",
+            maxBytes=maxBytes,
+            backupCount=backupCount,
+            delay=True,
+        )
+
+        # RotatingFileHandler switches to text append mode if maxBytes is given
+        self.mode = "ab"
+        self.encoding = None
+
+        # time.monotonic() of the last batch written to it (see UdpAggregator)
+        self.lastWritten = None
+
+    def __repr__(self):
+        return "<SourceLogFile %s>" % self.baseFilename
+
+    def _open(self):
+        return open(self.baseFilename, self.mode, buffering=_FILE_BUFFER_SIZE)
+
+    def write(self, data):
+        """writes (buffers) received bytes, rotating first if they would make the file bigger than maxBytes"""
+        with self.lock:
+            if self.stream is None:
+                self.stream = self._open()
+
+            if self.maxBytes > 0:
+                position = self.stream.tell()
+                if position and position + len(data) > self.maxBytes:
+                    self.doRollover()
+                    if self.stream is None:
+                        self.stream = self._open()
+
+            self.stream.write(data)
+
+    def commit(self, fsync=False):
+        """writes out everything buffered so far (and fsyncs it if asked to)"""
+        with self.lock:
+            if self.stream is not None:
+                self.stream.flush()
+                if fsync:
+                    os.fsync(self.stream.fileno())
+
+    def closeStream(self):
+        """closes the file (until the next write reopens it)"""
+        with self.lock:
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+
+
+class UdpAggregator(UdpHandlerReceiver):
+    """
+    A UdpHandlerReceiver that writes what it receives to a rotating file per source in outputDir, instead of
+        printing it. So one receiver can collect logs from many hosts.
+
+    Framed messages (UdpHandler(framed=True)) are filed by the sender id in their header, so they end up in the
+        same file even if the sender's address changes. Raw text is filed by the sender's address.
+        Files are named like <ip>_<sender id or port>.log (or local_<sender id>.log for a unix socket)
+
+    Writes are batched with a group commit: everything received in a wake up (see UdpHandlerReceiver) is
+        written, then each file that was written to is flushed once (and fsynced if fsync is True).
+
+    A source not written to for sourceTimeout seconds, or beyond the maxSources written to most recently, has its
+        file closed and is forgotten (like a restarted sender's old port). If it comes back, it appends to the
+        same file.
+    """
+
+    def __init__(
+        self,
+        outputDir,
+        ip="127.0.0.1",
+        port=5123,
+        maxBytes=DEFAULT_MAX_BYTES,
+        backupCount=DEFAULT_BACKUP_COUNT,
+        fsync=False,
+        maxOpenFiles=DEFAULT_MAX_OPEN_FILES,
+        sourceTimeout=DEFAULT_SENDER_TIMEOUT_SECONDS,
+        maxSources=DEFAULT_MAX_SENDERS,
+        **kwargs
+    ):
+        UdpHandlerReceiver.__init__(self, ip=ip, port=port, **kwargs)
+        self._initOutput(
+            outputDir,
+            maxBytes,
+            backupCount,
+            fsync,
+            maxOpenFiles,
+            sourceTimeout,
+            maxSources,
+        )
+
+    def _initOutput(
+        self,
+        outputDir,
+        maxBytes,
+        backupCount,
+        fsync,
+        maxOpenFiles,
+        sourceTimeout,
+        maxSources,
+    ):
+        self.outputDir = outputDir
+        self.maxBytes = maxBytes
+        self.backupCount = backupCount
+        self.fsync = fsync
+        self.maxOpenFiles = maxOpenFiles
+        self.sourceTimeout = sourceTimeout
+        self.maxSources = maxSources
+
+        # source -> SourceLogFile. In the order they were last written to.
+        self._files = collections.OrderedDict()
+
+        # sources that were forgotten
+        self.expiredSources = 0
+
+        os.makedirs(outputDir, exist_ok=True)
+
+    def __repr__(self):
+        return "<UdpAggregator %s:%s -> %s>" % (self.ip, self.port, self.outputDir)
+
+    def getSourceFiles(self):
+        """returns a dict of source -> path of the file its messages are written to"""
+        return {source: f.baseFilename for source, f in self._files.items()}
+
+    def _getFileName(self, source):
+        if isinstance(source, int):
+            # a sender id, its address is known by the reassembler
+            address = self.getSenderStats().get(source, {}).get("address")
+            suffix = "%016x" % source
+        elif isinstance(source, tuple):
+            address = source
+            suffix = str(source[1])
+        else:
+            # a unix socket sender's path (if it bound to one)
+            address = None
+            suffix = os.path.basename(source) if source else "unknown"
+
+        host = "local"
+        if isinstance(address, tuple):
+            host = str(address[0])
+
+        name = _UNSAFE_FILE_NAME_CHARACTERS_REGEX.sub("-", "%s_%s" % (host, suffix))
+        return os.path.join(self.outputDir, name + SOURCE_LOG_EXTENSION)
+
+    def _getFile(self, source):
+        sourceFile = self._files.get(source)
+        if sourceFile is None:
+            sourceFile = SourceLogFile(
+                self._getFileName(source),
+                maxBytes=self.maxBytes,
+                backupCount=self.backupCount,
+            )
+            self._files[source] = sourceFile
+        else:
+            self._files.move_to_end(source)
+
+        if sourceFile.stream is None:
+            self._closeLeastRecentFiles()
+
+        return sourceFile
+
+    def _writeMessages(self, messages):
+        now = time.monotonic()
+        written = set()
+        for source, message in messages:
+            sourceFile = self._getFile(source)
+            sourceFile.write(message)
+            written.add(sourceFile)
+            sourceFile.lastWritten = now
+
+        # the group commit
+        for sourceFile in written:
+            sourceFile.commit(self.fsync)
+
+        self._expireSources(now)
+
+    def _expireSources(self, now):
+        """closes and forgets sources (from the least recently written to) idle too long or too many of them"""
+        files = self._files
+        while files:
+            source, sourceFile = next(iter(files.items()))
+            if (
+                len(files) <= self.maxSources
+                and now - sourceFile.lastWritten < self.sourceTimeout
+            ):
+                break
+
+            del files[source]
+            try:
+                sourceFile.commit(self.fsync)
+            finally:
+                sourceFile.close()
+            self.expiredSources += 1
+
+    def _closeLeastRecentFiles(self):
+        openFiles = [f for f in self._files.values() if f.stream is not None]
+        for sourceFile in openFiles[: max(0, len(openFiles) - self.maxOpenFiles + 1)]:
+            sourceFile.closeStream()
+
+    def recieveForever(self):
+        try:
+            UdpHandlerReceiver.recieveForever(self)
+        finally:
+            self.close()
+
+    def close(self):
+        """commits and closes all the files"""
+        for sourceFile in self._files.values():
+            try:
+                sourceFile.commit(self.fsync)
+            finally:
+                sourceFile.close()
+
+
+class TcpAggregator(TcpHandlerReceiver, UdpAggregator):
+    """
+    A TcpHandlerReceiver that writes what each sender sends to its own rotating file in outputDir, like
+        UdpAggregator does. Files are named like <ip>_<sender id>.log. A batch is written (and fsynced if fsync
+        is True) before it is acked, so an acked record is on disk.
+    """
+
+    def __init__(
+        self,
+        outputDir,
+        ip="127.0.0.1",
+        port=5123,
+        maxBytes=DEFAULT_MAX_BYTES,
+        backupCount=DEFAULT_BACKUP_COUNT,
+        fsync=False,
+        maxOpenFiles=DEFAULT_MAX_OPEN_FILES,
+        sourceTimeout=DEFAULT_SENDER_TIMEOUT_SECONDS,
+        maxSources=DEFAULT_MAX_SENDERS,
+        **kwargs
+    ):
+        TcpHandlerReceiver.__init__(self, ip=ip, port=port, **kwargs)
+        self._initOutput(
+            outputDir,
+            maxBytes,
+            backupCount,
+            fsync,
+            maxOpenFiles,
+            sourceTimeout,
+            maxSources,
+        )
+
+    def __repr__(self):
+        return "<TcpAggregator %s:%s -> %s>" % (self.ip, self.port, self.outputDir)
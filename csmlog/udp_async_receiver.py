@@ -0,0 +1,225 @@
+"""
+This file is part of csmlog. Python logger setup... the way I like it.
+MIT License (2021) - Charles Machalow
+"""
+
+import asyncio
+import time
+
+from csmlog.udp_framing import FrameReassembler
+
+# lines that can wait for a subscriber before its oldest ones are dropped
+DEFAULT_SUBSCRIBER_QUEUE_MAX_SIZE = 10000
+
+# a partial line (from a record split over raw datagrams) longer than this is given out as is
+DEFAULT_MAX_LINE_BYTES = 1024 * 1024
+
+
+class Subscription(object):
+    """
+    A subscriber's view of the lines received by an AsyncUdpHandlerReceiver. Iterate over it with async for
+        (or await get()). Lines don't include the newline.
+
+    Each subscription has its own queue of up to maxSize lines. A subscriber that falls behind loses its oldest
+        lines (see droppedLines) without slowing down the receiver or any other subscriber.
+    """
+
+    def __init__(self, receiver, maxSize):
+        self.receiver = receiver
+        self.maxSize = maxSize
+        self.droppedLines = 0
+        self._queue = asyncio.Queue(maxsize=maxSize)
+        self._closed = False
+
+        # set once the end of the subscription was gotten
+        self._finished = False
+
+    def __repr__(self):
+        return "<Subscription %d/%d lines waiting, %d dropped>" % (
+            self._queue.qsize(),
+            self.maxSize,
+            self.droppedLines,
+        )
+
+    def _put(self, line):
+        """queues a line, dropping the oldest one if full"""
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.droppedLines += 1
+
+        self._queue.put_nowait(line)
+
+    async def get(self):
+        """returns the next line. Raises StopAsyncIteration once the subscription (or receiver) is closed."""
+        if self._finished or (self._closed and self._queue.empty()):
+            self._finished = True
+            raise StopAsyncIteration
+
+        line = await self._queue.get()
+        if line is None:
+            self._finished = True
+            raise StopAsyncIteration
+
+        return line
+
+    def close(self):
+        """stops getting lines. Lines already queued can still be gotten."""
+        self.receiver._unsubscribe(self)
+        if not self._closed:
+            self._closed = True
+
+            # wakes up a get() waiting for a line. If the queue is full, get() sees it's closed once it's empty.
+            if not self._queue.full():
+                self._queue.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.get()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, excType, excValue, traceback):
+        self.close()
+
+
+class _ReceiverProtocol(asyncio.DatagramProtocol):
+    def __init__(self, receiver):
+        self.receiver = receiver
+
+    def datagram_received(self, data, addr):
+        self.receiver._handleDatagram(data, addr)
+
+    def error_received(self, exc):
+        # like a connection refused from an earlier send... keep receiving
+        pass
+
+
+class AsyncUdpHandlerReceiver(object):
+    """
+    asyncio receiver for live logs from UdpHandler, built on loop.create_datagram_endpoint(). It doesn't need
+        a thread: datagrams are handled by the event loop as they come in.
+
+    Framed messages are put back together (see getSenderStats()) and the text is split into lines. Each
+        subscriber (see subscribe(), or async for over the receiver itself) gets every line through its own
+        bounded queue, so a slow subscriber only drops its own oldest lines. A subscription from async for over
+        the receiver is closed when the loop is done with it (for a break, once the event loop finalizes it);
+        one from subscribe() is kept until it is closed.
+
+    The start of a line that a sender hasn't finished is given out as is once the sender is forgotten (see
+        senderTimeout and maxSenders in FrameReassembler).
+
+    Use it with async with, or await start() and call close().
+    """
+
+    def __init__(
+        self,
+        ip="127.0.0.1",
+        port=5123,
+        subscriberQueueMaxSize=DEFAULT_SUBSCRIBER_QUEUE_MAX_SIZE,
+        maxLineBytes=DEFAULT_MAX_LINE_BYTES,
+    ):
+        self.ip = ip
+        self.port = port
+        self.subscriberQueueMaxSize = subscriberQueueMaxSize
+        self.maxLineBytes = maxLineBytes
+        self.transport = None
+
+        self._subscriptions = []
+        self._reassembler = FrameReassembler()
+
+        # address -> (the start of a line that hasn't been finished yet, when it was received). In that order.
+        self._partialLines = {}
+
+    def __repr__(self):
+        return "<AsyncUdpHandlerReceiver %s:%s>" % (self.ip, self.port)
+
+    @property
+    def boundAddress(self):
+        """the (ip, port) the socket is bound to (useful when port is 0)"""
+        return self.transport.get_extra_info("sockname")[:2]
+
+    async def start(self):
+        loop = asyncio.get_event_loop()
+        self.transport, protocol = await loop.create_datagram_endpoint(
+            lambda: _ReceiverProtocol(self), local_addr=(self.ip, self.port)
+        )
+
+    def close(self):
+        """stops receiving. Subscriptions end after the lines already queued for them."""
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+        for subscription in list(self._subscriptions):
+            subscription.close()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, excType, excValue, traceback):
+        self.close()
+
+    def subscribe(self, maxSize=None):
+        """returns a new Subscription to the lines received from now on, queueing up to maxSize of them"""
+        subscription = Subscription(self, maxSize or self.subscriberQueueMaxSize)
+        self._subscriptions.append(subscription)
+        return subscription
+
+    def _unsubscribe(self, subscription):
+        if subscription in self._subscriptions:
+            self._subscriptions.remove(subscription)
+
+    async def __aiter__(self):
+        subscription = self.subscribe()
+        try:
+            async for line in subscription:
+                yield line
+        finally:
+            subscription.close()
+
+    def getSenderStats(self):
+        """returns a dict of sender id -> dict of stats (including the dropRate) for framed senders"""
+        return self._reassembler.getSenderStats()
+
+    def _handleDatagram(self, datagram, address):
+        now = time.monotonic()
+        for message in self._reassembler.feed(datagram, address, now):
+            # a record may be split over multiple raw datagrams
+            partial = self._partialLines.pop(address, None)
+            if partial:
+                message = partial[0] + message
+
+            lines = message.split(b"\n")
+            partial = lines.pop()
+            if len(partial) > self.maxLineBytes:
+                lines.append(partial)
+            elif partial:
+                self._partialLines[address] = (partial, now)
+
+            for line in lines:
+                self._publish(line.decode(errors="replace"))
+
+        self._expirePartialLines(now)
+
+    def _expirePartialLines(self, now):
+        """gives out unfinished lines of senders (from the least recent) idle too long, or too many of them"""
+        partialLines = self._partialLines
+        reassembler = self._reassembler
+        while partialLines:
+            address, (partial, receivedAt) = next(iter(partialLines.items()))
+            if (
+                len(partialLines) <= reassembler.maxSenders
+                and now - receivedAt < reassembler.senderTimeout
+            ):
+                break
+
+            del partialLines[address]
+            self._publish(partial.decode(errors="replace"))
+
+    def _publish(self, line):
+        for subscription in self._subscriptions:
+            subscription._put(line)
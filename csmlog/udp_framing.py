@@ -0,0 +1,260 @@
+"""
+This file is part of csmlog. Python logger setup... the way I like it.
+MIT License (2021) - Charles Machalow
+"""
+
+import os
+import struct
+import time
+
+# starts every framed datagram. 0xC5 0x10 is never the start of valid UTF-8 text (0x10 isn't a continuation byte),
+#   so framed and raw text datagrams can be told apart.
+FRAME_MAGIC = b"\xc5\x10"
+FRAME_VERSION = 1
+
+# magic, version, sender id, sequence number, fragment index, fragment count
+FRAME_HEADER = struct.Struct("<2sBQIHH")
+
+MAX_SEQUENCE = 0xFFFFFFFF
+MAX_FRAGMENTS = 0xFFFF
+
+# a partially received message is given up on (counted as lost) after this long
+DEFAULT_REASSEMBLY_TIMEOUT_SECONDS = 5.0
+
+# at most this many partially received messages are kept per sender (the oldest are given up on first)
+DEFAULT_MAX_PENDING_MESSAGES = 64
+
+# a sender that hasn't sent anything for this long is forgotten (along with its stats and partial messages)
+DEFAULT_SENDER_TIMEOUT_SECONDS = 600.0
+
+# at most this many senders are kept track of (the ones heard from least recently are forgotten first)
+DEFAULT_MAX_SENDERS = 1024
+
+# skipped sequence numbers are remembered (in case they arrive late) up to this many per sender
+_MAX_MISSING_SEQUENCES = 4096
+
+
+class FramingError(ValueError):
+    """raised if a message can't be framed"""
+
+
+def newSenderId():
+    """returns a random id for a sender (a new one per handler, so a restarted sender starts fresh)"""
+    return struct.unpack("<Q", os.urandom(8))[0]
+
+
+def packFrames(senderId, sequence, payload, maxDatagramSize):
+    """returns the list of datagrams (each at most maxDatagramSize bytes) carrying the given message"""
+    fragmentSize = maxDatagramSize - FRAME_HEADER.size
+    if fragmentSize <= 0:
+        raise FramingError(
+            "maxDatagramSize must be bigger than the %d byte frame header"
+            % FRAME_HEADER.size
+        )
+
+    fragmentCount = max(1, -(-len(payload) // fragmentSize))
+    if fragmentCount > MAX_FRAGMENTS:
+        raise FramingError(
+            "Message of %d bytes needs more than %d fragments"
+            % (len(payload), MAX_FRAGMENTS)
+        )
+
+    datagrams = []
+    for index in range(fragmentCount):
+        offset = index * fragmentSize
+        datagrams.append(
+            FRAME_HEADER.pack(
+                FRAME_MAGIC,
+                FRAME_VERSION,
+                senderId,
+                sequence,
+                index,
+                fragmentCount,
+            )
+            + payload[offset : offset + fragmentSize]
+        )
+    return datagrams
+
+
+def isFramed(datagram):
+    return datagram[:2] == FRAME_MAGIC and len(datagram) >= FRAME_HEADER.size
+
+
+def getSenderId(datagram):
+    """returns the sender id of a framed datagram, or None if it isn't framed"""
+    if not isFramed(datagram):
+        return None
+
+    return FRAME_HEADER.unpack_from(datagram)[2]
+
+
+class _SenderState(object):
+    def __init__(self, address):
+        self.address = address
+        self.lastSeen = None
+        self.nextSequence = None
+        self.receivedMessages = 0
+        self.lostMessages = 0
+
+        # sequence -> (first seen time, fragment count, {fragment index: data})
+        self.pending = {}
+
+        # sequences that were skipped over (counted as lost unless they show up late). Kept in order.
+        self.missing = {}
+
+    def dropRate(self):
+        total = self.receivedMessages + self.lostMessages
+        return self.lostMessages / total if total else 0.0
+
+
+class FrameReassembler(object):
+    """
+    Puts framed messages (see packFrames()) back together and keeps track of lost messages per sender.
+        Datagrams that aren't framed are passed through as-is.
+
+    Senders not heard from for senderTimeout seconds, or beyond the maxSenders heard from most recently, are
+        forgotten (see expiredSenders) so every restarted process doesn't leave its state behind forever.
+    """
+
+    def __init__(
+        self,
+        reassemblyTimeout=DEFAULT_REASSEMBLY_TIMEOUT_SECONDS,
+        maxPendingMessages=DEFAULT_MAX_PENDING_MESSAGES,
+        senderTimeout=DEFAULT_SENDER_TIMEOUT_SECONDS,
+        maxSenders=DEFAULT_MAX_SENDERS,
+    ):
+        self.reassemblyTimeout = reassemblyTimeout
+        self.maxPendingMessages = maxPendingMessages
+        self.senderTimeout = senderTimeout
+        self.maxSenders = maxSenders
+
+        # sender id -> _SenderState. In the order they were last heard from.
+        self._senders = {}
+
+        # datagrams that were framed but not valid (like from an unknown version)
+        self.invalidDatagrams = 0
+
+        # senders that were forgotten
+        self.expiredSenders = 0
+
+    def __repr__(self):
+        return "<FrameReassembler %d senders>" % len(self._senders)
+
+    def feed(self, datagram, address=None, now=None):
+        """
+        Gives the reassembler a received datagram. Returns a list of complete messages (bytes) which may be empty
+            (if the datagram is one fragment of a bigger message).
+        """
+        if not isFramed(datagram):
+            return [bytes(datagram)]
+
+        magic, version, senderId, sequence, index, count = FRAME_HEADER.unpack_from(
+            datagram
+        )
+        if version != FRAME_VERSION or count == 0 or index >= count:
+            self.invalidDatagrams += 1
+            return []
+
+        if now is None:
+            now = time.monotonic()
+
+        sender = self._senders.pop(senderId, None)
+        if sender is None:
+            sender = _SenderState(address)
+        self._senders[senderId] = sender
+        sender.address = address
+        sender.lastSeen = now
+
+        self._expireSenders(now)
+        self._expire(sender, now)
+
+        if not self._track(sender, sequence):
+            # a duplicate or a message that was given up on already
+            return []
+
+        payload = bytes(datagram[FRAME_HEADER.size :])
+        if count == 1:
+            sender.receivedMessages += 1
+            return [payload]
+
+        pendingMessage = sender.pending.get(sequence)
+        if pendingMessage is None:
+            if len(sender.pending) >= self.maxPendingMessages:
+                self._giveUp(sender, next(iter(sender.pending)))
+
+            pendingMessage = (now, count, {})
+            sender.pending[sequence] = pendingMessage
+
+        fragments = pendingMessage[2]
+        fragments[index] = payload
+        if len(fragments) < pendingMessage[1]:
+            return []
+
+        del sender.pending[sequence]
+        sender.receivedMessages += 1
+        return [b"".join(fragments[i] for i in range(pendingMessage[1]))]
+
+    def _track(self, sender, sequence):
+        """updates the expected/missing sequence numbers. Returns False if this message should be ignored"""
+        if sender.nextSequence is None:
+            sender.nextSequence = (sequence + 1) & MAX_SEQUENCE
+            return True
+
+        ahead = (sequence - sender.nextSequence) & MAX_SEQUENCE
+        if ahead < (MAX_SEQUENCE + 1) // 2:
+            # skipped messages are lost (unless they show up later)
+            for i in range(min(ahead, _MAX_MISSING_SEQUENCES)):
+                sender.missing[(sender.nextSequence + i) & MAX_SEQUENCE] = None
+            sender.lostMessages += ahead
+
+            while len(sender.missing) > _MAX_MISSING_SEQUENCES:
+                del sender.missing[next(iter(sender.missing))]
+
+            sender.nextSequence = (sequence + 1) & MAX_SEQUENCE
+            return True
+
+        # behind: either a late message (not lost after all), another fragment of a pending one, or a duplicate
+        if sequence in sender.missing:
+            del sender.missing[sequence]
+            sender.lostMessages -= 1
+            return True
+
+        return sequence in sender.pending
+
+    def _giveUp(self, sender, sequence):
+        del sender.pending[sequence]
+        sender.lostMessages += 1
+
+    def _expire(self, sender, now):
+        for sequence, pendingMessage in list(sender.pending.items()):
+            if now - pendingMessage[0] < self.reassemblyTimeout:
+                # pending messages are in the order they were first seen
+                break
+            self._giveUp(sender, sequence)
+
+    def _expireSenders(self, now):
+        """forgets senders (from the least recently heard from) that have been idle too long or are too many"""
+        senders = self._senders
+        while len(senders) > 1:
+            senderId = next(iter(senders))
+            if (
+                len(senders) <= self.maxSenders
+                and now - senders[senderId].lastSeen < self.senderTimeout
+            ):
+                break
+
+            del senders[senderId]
+            self.expiredSenders += 1
+
+    def getSenderStats(self):
+        """returns a dict of sender id -> dict of stats for messages from that sender"""
+        return {
+            senderId: {
+                "address": sender.address,
+                "receivedMessages": sender.receivedMessages,
+                "lostMessages": sender.lostMessages,
+                "pendingMessages": len(sender.pending),
+                "dropRate": sender.dropRate(),
+            }
+            for senderId, sender in self._senders.items()
+        }
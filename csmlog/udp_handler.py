@@ -3,34 +3,381 @@ This file is part of csmlog. Python logger setup... the way I like it.
 MIT License (2019) - Charles Machalow
 """
 
+import collections
+import errno
 import logging
 import logging.handlers
+import os
+import re
 import socket
+import sys
+import tempfile
+import threading
+import time
 
-MAX_BYTES_PER_SEND = 1024
+from csmlog.after_fork import registerAfterForkInChild
+from csmlog.formatter import SharedFormatCacheMixin
+from csmlog.udp_framing import FRAME_HEADER, MAX_SEQUENCE, newSenderId, packFrames
 
+# 1500 byte (ethernet) MTU - 20 byte IPv4 header - 8 byte UDP header
+DEFAULT_MAX_DATAGRAM_SIZE = 1472
 
-class UdpHandler(logging.StreamHandler):
-    """handler to send live logs as raw text to a UDP socket"""
+# unix sockets have no MTU, but only queue a few datagrams (see /proc/sys/net/unix/max_dgram_qlen)... so make
+#   each of them count. Still fits in a receiver's MAX_UDP_PACKET_SIZE read. Elsewhere (like macOS and the BSDs)
+#   datagrams bigger than net.local.dgram.maxdgram (2048 by default) can't be sent at all.
+DEFAULT_UNIX_MAX_DATAGRAM_SIZE = 65535 if sys.platform.startswith("linux") else 2048
+
+# pass as udpLogging to setup() to send live logs over a unix socket (see getUnixSocketPath()) instead of UDP
+UDP_LOGGING_UNIX = "unix"
+
+# pass as udpLogging to setup() to stream live logs over TCP (see csmlog.tcp_handler) instead of UDP
+UDP_LOGGING_TCP = "tcp"
+
+# how long a partial datagram may wait for more records before being sent
+DEFAULT_LINGER_SECONDS = 0.05
+
+# records at or above this level are sent right away (along with anything waiting)
+DEFAULT_FLUSH_LEVEL = logging.WARNING
+
+# records that can wait to be sent in nonBlocking mode (more are dropped)
+DEFAULT_SEND_QUEUE_MAX_SIZE = 10000
+
+
+def getUnixSocketPath(appName):
+    """returns the path of the unix socket that live logs for the given app are sent to (with UDP_LOGGING_UNIX)"""
+    name = re.sub(r"[^\w.-]", "_", appName)
+    return os.path.join(tempfile.gettempdir(), "csmlog-%s.sock" % name)
+
+
+class UdpHandler(SharedFormatCacheMixin, logging.StreamHandler):
+    """
+    handler to send live logs as raw text to a UDP socket
+
+    Records (newline terminated) are coalesced into datagrams of up to maxDatagramSize bytes. A datagram is sent
+        when the next record wouldn't fit, lingerSeconds after its first record, or right away once a record at or
+        above flushLevel is added. A lingerSeconds of 0 sends each record as soon as it is logged.
+        Records bigger than maxDatagramSize are sent on their own, split into maxDatagramSize pieces.
+
+    If framed is True, each datagram starts with a header (see csmlog.udp_framing) carrying a sender id,
+        sequence number and fragment index/count so the receiver can put split records back together and
+        tell how many messages were lost.
+
+    If nonBlocking is True, emit() only puts the encoded record on a queue (of up to sendQueueMaxSize records)
+        and a background thread batches and sends them with a non-blocking socket. Records that don't fit on the
+        queue, or whose datagram doesn't fit in the socket's buffer, are dropped (see droppedRecords) instead of
+        making the logging thread wait.
+
+    If unixSocketPath is given, datagrams are sent to that AF_UNIX SOCK_DGRAM socket instead of ip:port. Sending
+        never waits for a slow receiver (or fails without one): like with UDP, those datagrams are dropped
+        (and counted). maxDatagramSize defaults to DEFAULT_UNIX_MAX_DATAGRAM_SIZE for a unix socket.
+    """
 
     stream = None
 
-    def __init__(self, ip="127.0.0.1", port=5123):
+    def __init__(
+        self,
+        ip="127.0.0.1",
+        port=5123,
+        maxDatagramSize=None,
+        lingerSeconds=DEFAULT_LINGER_SECONDS,
+        flushLevel=DEFAULT_FLUSH_LEVEL,
+        framed=False,
+        nonBlocking=False,
+        sendQueueMaxSize=DEFAULT_SEND_QUEUE_MAX_SIZE,
+        unixSocketPath=None,
+    ):
+        if maxDatagramSize is None:
+            if unixSocketPath:
+                maxDatagramSize = DEFAULT_UNIX_MAX_DATAGRAM_SIZE
+            else:
+                maxDatagramSize = DEFAULT_MAX_DATAGRAM_SIZE
+
         self.ip = ip
         self.port = port
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.unixSocketPath = unixSocketPath
+        self.maxDatagramSize = maxDatagramSize
+        self.lingerSeconds = lingerSeconds
+        self.flushLevel = flushLevel
+        self.framed = framed
+        self.nonBlocking = nonBlocking
+        self.sendQueueMaxSize = sendQueueMaxSize
+        if unixSocketPath:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._address = unixSocketPath
+
+            # a unix socket would make us wait for a slow receiver, where UDP would drop
+            self.socket.setblocking(False)
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._address = (ip, port)
+            if nonBlocking:
+                self.socket.setblocking(False)
         logging.StreamHandler.__init__(self)
 
+        # counters to see how well records are being batched
+        self.sentRecords = 0
+        self.sentDatagrams = 0
+
+        # counters for what was thrown away: records dropped because the send queue was full (nonBlocking mode)
+        #   or their datagram couldn't be sent right away, and datagrams that couldn't be sent right away
+        self.droppedRecords = 0
+        self.droppedDatagrams = 0
+
+        # framed messages from this handler are told apart from other senders' by the sender id
+        self.senderId = newSenderId()
+        self._sequence = 0
+
+        # how much of a datagram is left for records
+        self._payloadSize = maxDatagramSize
+        if framed:
+            self._payloadSize -= FRAME_HEADER.size
+
+        self._batch = bytearray()
+        self._batchRecords = 0
+        self._batchDeadline = None
+        self._closed = False
+
+        # in nonBlocking mode, the send queue and batch belong to the sender thread (other than adding to the
+        #   queue). Otherwise the batch is guarded by the handler's lock and the thread only sends lingering batches.
+        self._condition = threading.Condition(
+            threading.Lock() if nonBlocking else self.lock
+        )
+        self._sendQueue = collections.deque()
+        self._thread = None
+
+        # a forked child doesn't have our thread
+        registerAfterForkInChild(self._afterForkInChild)
+
     def __repr__(self):
+        if self.unixSocketPath:
+            return "<UdpHandler unix:%s>" % self.unixSocketPath
         return "<UdpHandler %s:%s>" % (self.ip, self.port)
 
-    def emit(self, record):
-        msg = (self.format(record) + "\n").encode()
+    def _afterForkInChild(self):
+        """
+        called in a forked child: the thread is started again on the next emit(). Anything batched or queued is
+            left for the parent to send (the child would send it again otherwise).
+        """
+        # the parent's sender thread may have been holding the lock when it forked
+        self._condition = threading.Condition(
+            threading.Lock() if self.nonBlocking else self.lock
+        )
+        self._sendQueue = collections.deque()
+        self._thread = None
+        self._batch = bytearray()
+        self._batchRecords = 0
+        self._batchDeadline = None
+
+        # the receiver would take the child's messages for (out of order) ones from the parent
+        self.senderId = newSenderId()
+        self._sequence = 0
+
+    def _sendDatagram(self, data):
+        """
+        sends a datagram. Returns False if it was dropped since the socket's buffer is full (in nonBlocking mode
+            or for a unix socket), nothing is receiving on the unix socket, or it's too big for the socket.
+        """
+        try:
+            self.socket.sendto(data, self._address)
+        except (BlockingIOError, FileNotFoundError, ConnectionRefusedError):
+            self.droppedDatagrams += 1
+            return False
+        except OSError as ex:
+            if ex.errno != errno.EMSGSIZE:
+                raise
+
+            # a maxDatagramSize the platform doesn't allow... like UDP, it's lost
+            self.droppedDatagrams += 1
+            return False
+
+        self.sentDatagrams += 1
+        return True
+
+    def _sendMessage(self, data, recordCount):
+        """sends the data (holding recordCount records) in as many datagrams as needed"""
+        if self.framed:
+            sequence = self._sequence
+            self._sequence = (sequence + 1) & MAX_SEQUENCE
+            datagrams = packFrames(self.senderId, sequence, data, self.maxDatagramSize)
+        else:
+            datagrams = [
+                data[offset : offset + self._payloadSize]
+                for offset in range(0, len(data), self._payloadSize)
+            ]
+
+        sent = True
+        for datagram in datagrams:
+            if not self._sendDatagram(datagram):
+                sent = False
+
+        if sent:
+            self.sentRecords += recordCount
+        else:
+            with self._condition:
+                self.droppedRecords += recordCount
+
+    def _sendBatch(self):
+        """sends whatever is batched"""
+        self._batchDeadline = None
+        if not self._batch:
+            return
+
+        batch, recordCount = self._batch, self._batchRecords
+        self._batch = bytearray()
+        self._batchRecords = 0
+        self._sendMessage(batch, recordCount)
+
+    def _addToBatch(self, msg, levelno):
+        """adds an encoded record to the batch, sending what needs to be sent"""
         msgLen = len(msg)
-        offset = 0
+        if len(self._batch) + msgLen > self._payloadSize:
+            self._sendBatch()
+
+        if msgLen > self._payloadSize:
+            # too big for one datagram, send it on its own
+            self._sendMessage(msg, 1)
+        else:
+            self._batch += msg
+            self._batchRecords += 1
 
-        # make sure we send all
-        while offset < msgLen:
-            offset += self.socket.sendto(
-                msg[offset : offset + MAX_BYTES_PER_SEND], (self.ip, self.port)
+        if levelno >= self.flushLevel or self.lingerSeconds <= 0:
+            self._sendBatch()
+        elif self._batch and self._batchDeadline is None:
+            self._batchDeadline = time.monotonic() + self.lingerSeconds
+            return True
+
+        return False
+
+    def _startThread(self):
+        """starts the sender/linger thread if needed (the condition must be held)"""
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._sendLoop if self.nonBlocking else self._lingerLoop,
+                name="csmlog-udp-sender",
+                daemon=True,
             )
+            self._thread.start()
+
+    def _lingerLoop(self):
+        with self._condition:
+            while not self._closed:
+                if self._batchDeadline is None:
+                    self._condition.wait()
+                    continue
+
+                remaining = self._batchDeadline - time.monotonic()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+
+                try:
+                    self._sendBatch()
+                except Exception:
+                    # the records in the batch are lost, keep going for the next ones.
+                    pass
+
+    def _sendLoop(self):
+        while True:
+            with self._condition:
+                while not self._sendQueue and not self._closed:
+                    if self._batchDeadline is None:
+                        self._condition.wait()
+                        continue
+
+                    remaining = self._batchDeadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+
+                items = self._sendQueue
+                self._sendQueue = collections.deque()
+                closed = self._closed
+
+            for msg, levelno in items:
+                try:
+                    if msg is None:
+                        # a flush request
+                        self._sendBatch()
+                        levelno.set()
+                    else:
+                        self._addToBatch(msg, levelno)
+                except Exception:
+                    pass
+
+            try:
+                if self._batchDeadline is not None and (
+                    closed or self._batchDeadline <= time.monotonic()
+                ):
+                    self._sendBatch()
+            except Exception:
+                pass
+
+            if closed and not items:
+                return
+
+    def emit(self, record):
+        try:
+            msg = self.formatBytes(record, "\n", "utf-8")
+
+            if not self.nonBlocking:
+                if self._addToBatch(msg, record.levelno):
+                    self._startThread()
+                    self._condition.notify()
+                return
+
+            with self._condition:
+                if self._closed or len(self._sendQueue) >= self.sendQueueMaxSize:
+                    self.droppedRecords += 1
+                    return
+
+                self._sendQueue.append((msg, record.levelno))
+                self._startThread()
+                self._condition.notify()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        """sends any batched records now (in nonBlocking mode: waits for everything queued so far to be sent)"""
+        if not self.nonBlocking:
+            with self.lock:
+                self._sendBatch()
+            return
+
+        with self._condition:
+            if self._thread is None or self._closed:
+                return
+
+            # the sender thread handles this after everything queued before it
+            flushed = threading.Event()
+            self._sendQueue.append((None, flushed))
+            self._condition.notify()
+
+        flushed.wait()
+
+    def close(self):
+        if self.nonBlocking:
+            with self._condition:
+                alreadyClosed = self._closed
+                self._closed = True
+                self._condition.notify()
+        else:
+            with self.lock:
+                alreadyClosed = self._closed
+                if not alreadyClosed:
+                    try:
+                        self._sendBatch()
+                    except OSError:
+                        pass
+
+                    self._closed = True
+                    self._condition.notify()
+
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            # in nonBlocking mode, the thread sends everything that was queued before exiting
+            thread.join()
+
+        if not alreadyClosed:
+            self.socket.close()
+
+        logging.StreamHandler.close(self)
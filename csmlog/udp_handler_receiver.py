@@ -3,71 +3,438 @@ This file is part of csmlog. Python logger setup... the way I like it.
 MIT License (2019) - Charles Machalow
 """
 
+import argparse
+import contextlib
+import os
+import selectors
 import socket
+import stat
 import sys
 import threading
 
+from csmlog.ring_buffer import RingBuffer
+from csmlog.udp_framing import FrameReassembler, getSenderId
+
 MAX_UDP_PACKET_SIZE = 65535
 
+# datagrams are received (back to back) into a preallocated buffer of this size. A batch ends when the socket
+#   has nothing left to give, or there isn't room for another max size datagram.
+DEFAULT_RECEIVE_BATCH_BYTES = 1024 * 1024
+
+# on Windows, a signal (like ctrl-c) doesn't interrupt select()... so wake up once in a while to let it be handled.
+#   Everywhere else it does, so an idle receiver can sleep until something happens.
+_SELECT_TIMEOUT_SECONDS = 0.5 if os.name == "nt" else None
+
 
 class UdpHandlerReceiver(object):
-    """receiver to print live logs as raw text from a UDP socket"""
+    """
+    receiver to print live logs as raw text from a UDP socket
+
+    Framed datagrams (from a UdpHandler with framed=True) are put back together before being printed, and lost
+        messages are counted per sender (see getSenderStats()). Raw text datagrams are printed as they come.
+
+    recieveForever() sleeps in select/epoll until a datagram comes in or requestStop() is called, so an idle
+        receiver doesn't use any CPU. (On Windows, it also wakes up every half second so ctrl-c works.)
+
+    The last bufferMaxSize bytes received are kept in a RingBuffer for getBuffer()/since()/bufferViews().
+
+    Each time it wakes up, everything waiting on the socket is received (with recvfrom_into, into a preallocated
+        buffer of receiveBatchBytes) and printed in one write. If receiveBufferSize is given, the socket's
+        SO_RCVBUF is set to it, so bursts the receiver can't keep up with are held by the kernel instead of dropped.
+        (The kernel may double or cap it, see /proc/sys/net/core/rmem_max.)
+
+    If reusePort is True, the socket is bound with SO_REUSEPORT so multiple receivers can share the port
+        (see csmlog.udp_receiver_pool).
 
-    def __init__(self, ip="127.0.0.1", port=5123, bufferMaxSize=MAX_UDP_PACKET_SIZE):
+    If unixSocketPath is given, an AF_UNIX SOCK_DGRAM socket is bound to that path (replacing a leftover socket
+        file from a receiver that didn't clean up) instead of ip:port. The path is removed when done.
+    """
+
+    def __init__(
+        self,
+        ip="127.0.0.1",
+        port=5123,
+        bufferMaxSize=MAX_UDP_PACKET_SIZE,
+        receiveBufferSize=None,
+        receiveBatchBytes=DEFAULT_RECEIVE_BATCH_BYTES,
+        reusePort=False,
+        unixSocketPath=None,
+    ):
         self.ip = ip
         self.port = port
         self.bufferMaxSize = bufferMaxSize
+        self.receiveBufferSize = receiveBufferSize
+        self.receiveBatchBytes = max(receiveBatchBytes, MAX_UDP_PACKET_SIZE)
+        self.reusePort = reusePort
+        self.unixSocketPath = unixSocketPath
+
+        # set once recieveForever() has bound the socket
+        self.bound = threading.Event()
 
-        self.__stop = False
+        self.__stop = threading.Event()
         self.__lock = threading.Lock()
-        self.__buffer = ""
+
+        # written to by requestStop() to wake up recieveForever()
+        self.__wakeUpWriter = None
+
+        self.__buffer = RingBuffer(bufferMaxSize)
+        self.__reassembler = FrameReassembler()
 
     def __repr__(self):
+        if self.unixSocketPath:
+            return "<UdpHandlerReceiver unix:%s>" % self.unixSocketPath
         return "<UdpHandlerReceiver %s:%s>" % (self.ip, self.port)
 
     def _appendToBuffer(self, data):
         with self.__lock:
-            self.__buffer += data
+            self.__buffer.write(data)
 
-            # chop buffer to latest x items
-            self.__buffer = self.__buffer[-self.bufferMaxSize :]
+    @staticmethod
+    def _decode(data):
+        # the oldest data in the buffer may start in the middle of a multi-byte character
+        start = 0
+        while start < len(data) and start < 3 and 0x80 <= data[start] < 0xC0:
+            start += 1
+        return bytes(data[start:]).decode(errors="replace")
 
-    def getBuffer(self):
+    def getBuffer(self, lastN=None):
+        """returns the received text still in the buffer (or just the last lastN lines of it)"""
         with self.__lock:
-            return self.__buffer
+            if lastN is None:
+                data = self.__buffer.read()
+            else:
+                data = self.__buffer.lastLines(lastN)
+
+        return self._decode(data)
+
+    def since(self, seq=0):
+        """
+        returns (the text received since sequence number seq, the sequence number to pass next time).
+            Sequence numbers count every byte received. If some of what was received since seq is no longer
+            in the buffer, only what is left is returned.
+        """
+        with self.__lock:
+            data = self.__buffer.read(seq)
+            return self._decode(data), self.__buffer.end
+
+    @contextlib.contextmanager
+    def bufferViews(self, since=None):
+        """
+        yields a list of memoryviews of the received bytes (since sequence number since) without copying them.
+            New data isn't added to the buffer until this exits, so don't hold on to it for long.
+        """
+        with self.__lock:
+            yield self.__buffer.views(since)
 
     def requestStop(self):
+        self.__stop.set()
+
         with self.__lock:
-            self.__stop = True
+            if self.__wakeUpWriter is not None:
+                try:
+                    self.__wakeUpWriter.send(b"\0")
+                except OSError:
+                    # already has a pending wake up (or is closing)
+                    pass
 
     def shouldStop(self):
+        return self.__stop.is_set()
+
+    def getSenderStats(self):
+        """returns a dict of sender id -> dict of stats (including the dropRate) for framed senders"""
         with self.__lock:
-            return self.__stop
+            return self.__reassembler.getSenderStats()
 
-    def recieveForever(self):
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    def _handleDatagram(self, datagram, address):
+        self._handleDatagrams([(datagram, address)])
+
+    def _handleDatagrams(self, datagrams):
+        """handles a batch of (datagram, address) received together. The datagrams may be memoryviews."""
+        with self.__lock:
+            messages = []
+            for datagram, address in datagrams:
+                senderId = getSenderId(datagram)
+                source = address if senderId is None else senderId
+                for message in self.__reassembler.feed(datagram, address):
+                    messages.append((source, message))
+
+        self._handleMessages(messages)
+
+    def _handleMessages(self, messages):
+        """keeps a batch of (source, message) in the buffer, then writes them out"""
+        if not messages:
+            return
+
+        with self.__lock:
+            for source, message in messages:
+                self.__buffer.write(message)
+
+        self._writeMessages(messages)
+
+    def _writeMessages(self, messages):
+        """
+        handles a batch of (source, message) received together. The source is the sender id for framed messages,
+            otherwise the sender's address.
+        """
+        self._writeOutput(b"".join(message for source, message in messages))
+
+    def _writeOutput(self, data):
+        """prints a batch of received bytes"""
+        # a raw datagram may end in the middle of a multi-byte character
+        sys.stdout.write(data.decode(errors="replace"))
+        sys.stdout.flush()
+
+    def _receiveBatch(self, buffer):
+        """
+        receives datagrams until the socket has none left (or the buffer is full).
+            Returns a list of (memoryview of buffer, address).
+        """
+        datagrams = []
+        offset = 0
+        while len(buffer) - offset >= MAX_UDP_PACKET_SIZE:
+            try:
+                size, address = self.socket.recvfrom_into(
+                    buffer[offset:], MAX_UDP_PACKET_SIZE
+                )
+            except (BlockingIOError, InterruptedError):
+                break
+            except socket.error:
+                # like a connection reset (on Windows) for an earlier send. Trying again right away could spin
+                #   forever on an error that doesn't go away: the selector says when there is more to receive.
+                break
+
+            if size:
+                datagrams.append((buffer[offset : offset + size], address))
+                offset += size
+
+        return datagrams
+
+    def _bindUnixSocket(self):
+        try:
+            if stat.S_ISSOCK(os.stat(self.unixSocketPath).st_mode):
+                # left behind by a receiver that didn't get to clean up
+                os.unlink(self.unixSocketPath)
+        except FileNotFoundError:
+            pass
+
+        self.socket.bind(self.unixSocketPath)
+
+    def _openSocket(self):
+        """creates and binds self.socket"""
+        family = socket.AF_UNIX if self.unixSocketPath else socket.AF_INET
+        self.socket = socket.socket(family, socket.SOCK_DGRAM)
+        if self.receiveBufferSize:
+            self.socket.setsockopt(
+                socket.SOL_SOCKET, socket.SO_RCVBUF, self.receiveBufferSize
+            )
+        if self.reusePort:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.socket.setblocking(False)
-        self.socket.bind((self.ip, self.port))
+        if self.unixSocketPath:
+            self._bindUnixSocket()
+        else:
+            self.socket.bind((self.ip, self.port))
+
+    def _onReady(self, selector, key, events, buffer):
+        """handles a socket registered with the selector being ready (by default, only self.socket is)"""
+        datagrams = self._receiveBatch(buffer)
+        if datagrams:
+            self._handleDatagrams(datagrams)
+
+    def _closeSocket(self):
+        self.socket.close()
+        del self.socket
+
+        if self.unixSocketPath:
+            try:
+                os.unlink(self.unixSocketPath)
+            except FileNotFoundError:
+                pass
+
+    def recieveForever(self):
+        self._openSocket()
+        self.bound.set()
+
+        buffer = memoryview(bytearray(self.receiveBatchBytes))
+
+        wakeUpReader, wakeUpWriter = socket.socketpair()
+        wakeUpReader.setblocking(False)
+        wakeUpWriter.setblocking(False)
+        with self.__lock:
+            self.__wakeUpWriter = wakeUpWriter
+
+        selector = selectors.DefaultSelector()
+        selector.register(self.socket, selectors.EVENT_READ)
+        selector.register(wakeUpReader, selectors.EVENT_READ)
         try:
             while not self.shouldStop():
-                # don't block to make this easier to ctrl-c
-                try:
-                    data = self.socket.recv(MAX_UDP_PACKET_SIZE).decode()
-                except socket.error:
-                    continue
+                for key, events in selector.select(_SELECT_TIMEOUT_SECONDS):
+                    if key.fileobj is wakeUpReader:
+                        # woken up by requestStop()
+                        continue
 
-                if len(data):
-                    self._appendToBuffer(data)
-                    sys.stdout.write(data)
+                    self._onReady(selector, key, events, buffer)
 
         finally:
-            self.socket.close()
-            del self.socket
+            with self.__lock:
+                self.__wakeUpWriter = None
+
+            selector.close()
+            wakeUpReader.close()
+            wakeUpWriter.close()
+            self._closeSocket()
+            self.bound.clear()
+
+
+def _printSenderStats(senderStats, stream):
+    for senderId, stats in senderStats.items():
+        line = "sender %016x (%s): %d messages received" % (
+            senderId,
+            stats["address"],
+            stats["receivedMessages"],
+        )
+        if "lostMessages" in stats:
+            line += ", %d lost (%.2f%% dropped)" % (
+                stats["lostMessages"],
+                stats["dropRate"] * 100,
+            )
+        stream.write(line + "\n")
+
+
+def _getAggregatorKwargs(args):
+    """returns the UdpAggregator keyword arguments given on the command line"""
+    kwargs = {"fsync": args.fsync}
+    if args.max_bytes is not None:
+        kwargs["maxBytes"] = args.max_bytes
+    if args.backup_count is not None:
+        kwargs["backupCount"] = args.backup_count
+    return kwargs
 
 
 def main():
-    u = UdpHandlerReceiver()
-    u.recieveForever()
+    parser = argparse.ArgumentParser(
+        description="Prints live logs sent by csmlog's UdpHandler"
+    )
+    parser.add_argument("--ip", default="127.0.0.1", help="ip to listen on")
+    parser.add_argument("--port", type=int, default=5123, help="port to listen on")
+    parser.add_argument(
+        "--receive-buffer-size",
+        type=int,
+        default=None,
+        help="SO_RCVBUF for the socket in bytes (bigger means less drops during bursts)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of worker processes sharing the port with SO_REUSEPORT (each sender sticks to one)",
+    )
+    parser.add_argument(
+        "--output-dir",
+        default=None,
+        help="write what each sender sends to its own rotating file in this directory instead of printing it",
+    )
+    parser.add_argument(
+        "--max-bytes",
+        type=int,
+        default=None,
+        help="with --output-dir: size to rotate each file at",
+    )
+    parser.add_argument(
+        "--backup-count",
+        type=int,
+        default=None,
+        help="with --output-dir: rotated backups to keep of each file",
+    )
+    parser.add_argument(
+        "--fsync",
+        action="store_true",
+        help="with --output-dir: fsync the files after writing each batch",
+    )
+    parser.add_argument(
+        "--unix-socket",
+        default=None,
+        help="receive on this unix socket (see UdpHandler(unixSocketPath=...)) instead of --ip/--port",
+    )
+    parser.add_argument(
+        "--app-name",
+        default=None,
+        help="receive on the unix socket for this app (like setup(appName, udpLogging=UDP_LOGGING_UNIX) sends to)",
+    )
+    parser.add_argument(
+        "--tcp",
+        action="store_true",
+        help="accept TcpHandler connections on --ip/--port instead of receiving UDP",
+    )
+    args = parser.parse_args()
+
+    if args.tcp and (args.workers > 1 or args.unix_socket or args.app_name):
+        parser.error("--tcp can't be used with --workers, --unix-socket or --app-name")
+
+    unixSocketPath = args.unix_socket
+    if args.app_name:
+        from csmlog.udp_handler import getUnixSocketPath
+
+        unixSocketPath = getUnixSocketPath(args.app_name)
+
+    if unixSocketPath and args.workers > 1:
+        parser.error("a unix socket can't be shared by --workers")
+
+    if args.tcp and args.output_dir:
+        from csmlog.udp_aggregator import TcpAggregator
+
+        u = TcpAggregator(
+            args.output_dir,
+            ip=args.ip,
+            port=args.port,
+            receiveBufferSize=args.receive_buffer_size,
+            **_getAggregatorKwargs(args)
+        )
+    elif args.tcp:
+        from csmlog.tcp_handler_receiver import TcpHandlerReceiver
+
+        u = TcpHandlerReceiver(
+            ip=args.ip, port=args.port, receiveBufferSize=args.receive_buffer_size
+        )
+    elif args.workers > 1:
+        from csmlog.udp_receiver_pool import UdpReceiverPool
+
+        kwargs = {}
+        if args.output_dir:
+            kwargs = _getAggregatorKwargs(args)
+
+        u = UdpReceiverPool(
+            ip=args.ip,
+            port=args.port,
+            workers=args.workers,
+            receiveBufferSize=args.receive_buffer_size,
+            outputDir=args.output_dir,
+            **kwargs
+        )
+    elif args.output_dir:
+        from csmlog.udp_aggregator import UdpAggregator
+
+        u = UdpAggregator(
+            args.output_dir,
+            ip=args.ip,
+            port=args.port,
+            receiveBufferSize=args.receive_buffer_size,
+            unixSocketPath=unixSocketPath,
+            **_getAggregatorKwargs(args)
+        )
+    else:
+        u = UdpHandlerReceiver(
+            ip=args.ip,
+            port=args.port,
+            receiveBufferSize=args.receive_buffer_size,
+            unixSocketPath=unixSocketPath,
+        )
+    try:
+        u.recieveForever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        _printSenderStats(u.getSenderStats(), sys.stderr)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,241 @@
+"""
+This file is part of csmlog. Python logger setup... the way I like it.
+MIT License (2021) - Charles Machalow
+"""
+
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import socket
+import sys
+import threading
+
+from csmlog.udp_aggregator import UdpAggregator
+from csmlog.udp_handler_receiver import UdpHandlerReceiver
+
+# what a worker process sends to the pool: (kind, value)
+_READY = "ready"
+_OUTPUT = "output"
+_SENDER_STATS = "senderStats"
+
+
+class _WorkerConnection(object):
+    """a worker's end of the pipe to the pool (sent to from more than one thread)"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = threading.Lock()
+
+    def send(self, kind, value):
+        with self.lock:
+            self.connection.send((kind, value))
+
+
+class _WorkerReceiver(UdpHandlerReceiver):
+    """a UdpHandlerReceiver (in a worker process) that sends what it receives to the pool instead of printing it"""
+
+    def __init__(self, workerConnection, *args, **kwargs):
+        UdpHandlerReceiver.__init__(self, *args, **kwargs)
+        self.workerConnection = workerConnection
+
+    def _writeOutput(self, data):
+        self.workerConnection.send(_OUTPUT, data)
+
+
+def _runWorker(
+    connection, stopEvent, ip, port, receiveBufferSize, outputDir, aggregatorKwargs
+):
+    # ctrl-c goes to the whole process group. The pool tells the workers when to stop.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    workerConnection = _WorkerConnection(connection)
+    if outputDir is None:
+        # only the pool keeps what was received
+        receiver = _WorkerReceiver(
+            workerConnection,
+            ip=ip,
+            port=port,
+            bufferMaxSize=1,
+            receiveBufferSize=receiveBufferSize,
+            reusePort=True,
+        )
+    else:
+        # each sender sticks to one worker, so the worker can write that sender's file itself
+        receiver = UdpAggregator(
+            outputDir,
+            ip=ip,
+            port=port,
+            bufferMaxSize=1,
+            receiveBufferSize=receiveBufferSize,
+            reusePort=True,
+            **aggregatorKwargs
+        )
+
+    def _readyThenWaitForStop():
+        receiver.bound.wait()
+        workerConnection.send(_READY, None)
+
+        stopEvent.wait()
+        receiver.requestStop()
+
+    threading.Thread(target=_readyThenWaitForStop, daemon=True).start()
+    try:
+        receiver.recieveForever()
+        workerConnection.send(_SENDER_STATS, receiver.getSenderStats())
+    finally:
+        connection.close()
+
+
+class UdpReceiverPool(object):
+    """
+    Receives live logs like UdpHandlerReceiver, but with workers processes that each bind their own socket to the
+        same port with SO_REUSEPORT. The kernel spreads senders (by source address and port) across the sockets,
+        so receiving and reassembling scales with cores while each sender sticks to one worker.
+
+    What the workers receive is printed by the pool as one stream. Each sender's output stays in order, but
+        output from different senders may be interleaved differently than it was sent.
+
+    If outputDir is given, each worker is a UdpAggregator instead: it writes what its senders send to their
+        own files in outputDir directly (nothing goes through the pool). The other keyword arguments (like
+        maxBytes, backupCount and fsync) are passed to UdpAggregator.
+
+    A port of 0 picks a free port (see boundPort once ready is set). Sender stats are collected from the
+        workers as they stop.
+    """
+
+    def __init__(
+        self,
+        ip="127.0.0.1",
+        port=5123,
+        workers=None,
+        receiveBufferSize=None,
+        outputDir=None,
+        **aggregatorKwargs
+    ):
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise ValueError("SO_REUSEPORT isn't supported on this platform")
+
+        self.ip = ip
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.receiveBufferSize = receiveBufferSize
+        self.outputDir = outputDir
+        self.aggregatorKwargs = aggregatorKwargs
+
+        # set once every worker has bound its socket
+        self.ready = threading.Event()
+        self.boundPort = None
+
+        self.__lock = threading.Lock()
+        self.__senderStats = {}
+
+        # workers can't be stopped by the usual socket wake up, since they are in other processes
+        self.__context = multiprocessing.get_context("spawn")
+        self.__stopEvent = self.__context.Event()
+
+    def __repr__(self):
+        return "<UdpReceiverPool %s:%s (%d workers)>" % (
+            self.ip,
+            self.port,
+            self.workers,
+        )
+
+    def requestStop(self):
+        self.__stopEvent.set()
+
+    def shouldStop(self):
+        return self.__stopEvent.is_set()
+
+    def getSenderStats(self):
+        """returns a dict of sender id -> dict of stats for framed senders, from the workers that stopped"""
+        with self.__lock:
+            return dict(self.__senderStats)
+
+    def _writeOutput(self, data):
+        """prints a batch of bytes received by a worker"""
+        sys.stdout.write(data.decode(errors="replace"))
+        sys.stdout.flush()
+
+    def _receiveFromWorkers(self, connections, placeholder):
+        """handles what the workers send until all of them are done (the list of connections is emptied)"""
+        readyWorkers = 0
+        while connections:
+            for connection in multiprocessing.connection.wait(connections):
+                try:
+                    kind, value = connection.recv()
+                except EOFError:
+                    # a worker that exits before being told to stop failed... stop the rest too
+                    connections.remove(connection)
+                    self.__stopEvent.set()
+                    continue
+
+                if kind == _OUTPUT:
+                    self._writeOutput(value)
+                elif kind == _SENDER_STATS:
+                    with self.__lock:
+                        self.__senderStats.update(value)
+                elif kind == _READY:
+                    readyWorkers += 1
+                    if readyWorkers == self.workers:
+                        if placeholder is not None:
+                            placeholder.close()
+                        self.ready.set()
+
+    def recieveForever(self):
+        if self.shouldStop():
+            return
+
+        placeholder = None
+        port = self.port
+        if port == 0:
+            # holds the picked port until the workers have it
+            placeholder = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            placeholder.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            placeholder.bind((self.ip, 0))
+            port = placeholder.getsockname()[1]
+        self.boundPort = port
+
+        connections = []
+        processes = []
+        try:
+            for i in range(self.workers):
+                reader, writer = self.__context.Pipe(duplex=False)
+                process = self.__context.Process(
+                    target=_runWorker,
+                    args=(
+                        writer,
+                        self.__stopEvent,
+                        self.ip,
+                        port,
+                        self.receiveBufferSize,
+                        self.outputDir,
+                        self.aggregatorKwargs,
+                    ),
+                    name="csmlog-udp-worker-%d" % i,
+                    daemon=True,
+                )
+                process.start()
+                writer.close()
+                connections.append(reader)
+                processes.append(process)
+
+            # a signal (like ctrl-c) interrupts this too
+            self._receiveFromWorkers(connections, placeholder)
+        finally:
+            self.__stopEvent.set()
+            try:
+                # the workers send what they have left (and their sender stats) before exiting
+                self._receiveFromWorkers(connections, None)
+            finally:
+                for connection in connections:
+                    connection.close()
+                for process in processes:
+                    process.join()
+                if placeholder is not None:
+                    placeholder.close()
+                self.ready.clear()
+
+        failed = [p.name for p in processes if p.exitcode]
+        if failed:
+            raise RuntimeError("UDP receiver worker(s) failed: %s" % ", ".join(failed))
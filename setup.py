@@ -20,7 +20,7 @@ setup(
     version=version,
     packages=["csmlog"],
     license="MIT License",
-    python_requires=">=3.6",
+    python_requires=">=3.7",
     long_description=open("README.md").read(),
     long_description_content_type="text/markdown",
     classifiers=[
@@ -33,5 +33,13 @@ setup(
     include_package_data=True,
     # gspread<6 to keep py 3.7 support.
     install_requires=["six", "gspread<6.0.0"],
-    entry_points={"console_scripts": ["csmlogudp = csmlog.udp_handler_receiver:main"]},
+    extras_require={"zstd": ["zstandard"]},
+    entry_points={
+        "console_scripts": [
+            "csmlogudp = csmlog.udp_handler_receiver:main",
+            "csmlogsplit = csmlog.log_splitter:main",
+            "csmlog-decode = csmlog.binary_log:main",
+            "csmlogshm = csmlog.shm_ring_reader:main",
+        ]
+    },
 )